@@ -0,0 +1,115 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, sys, glob, time, mmap, signal, argparse, ctypes, ctypes.util
+
+# Keeps the volumes of a BLAST database mapped for the length of a batch session, so
+# the blastn runs of every classify call on the node find them in the page cache. Run
+#   python -m CONSTAX2_qiime_plugin._blast_pin -d training_files/<db>__BLAST
+# and stop it with Ctrl-C or SIGTERM once the session is over.
+
+_PAGE = mmap.PAGESIZE
+
+def _blast_db_files(db):
+    # Every file of the database, including the volumes behind a .nal alias
+    paths = glob.glob(F"{db}.*") + glob.glob(F"{db}_[0-9]*.*")
+    return sorted([path for path in paths if os.path.isfile(path) and os.path.getsize(path) > 0])
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_ubyte)]
+        return libc
+    except (OSError, AttributeError, TypeError):
+        return None
+
+_libc = _load_libc()
+
+def _resident_bytes(path):
+    # Bytes of the file in the page cache, from mincore over a fresh read-only mapping,
+    # or None where mincore is not available
+    size = os.path.getsize(path)
+    if _libc is None or size == 0:
+        return None
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            return None
+        try:
+            pages = (size + _PAGE - 1) // _PAGE
+            vec = (ctypes.c_ubyte * pages)()
+            if _libc.mincore(addr, size, vec) != 0:
+                return None
+            resident = sum([page & 1 for page in vec])
+        finally:
+            _libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    return min(resident * _PAGE, size)
+
+def _residency(db):
+    # (resident bytes, total bytes) over the files of the database
+    resident = total = 0
+    for path in _blast_db_files(db):
+        in_cache = _resident_bytes(path)
+        if in_cache is None:
+            return None, None
+        resident += in_cache
+        total += os.path.getsize(path)
+    return resident, total
+
+def _residency_report(db):
+    resident, total = _residency(db)
+    if total is None:
+        return F"BLAST database {db}: residency not available on this platform"
+    if total == 0:
+        return F"BLAST database {db}: no files found"
+    return F"BLAST database {db}: {resident / 2**20:.0f} of {total / 2**20:.0f} MB resident ({100 * resident / total:.1f}%)"
+
+def _pin(db, block_size=1 << 24):
+    # Map every file, ask the kernel to read it ahead and fault it in by reading it
+    # through. The mappings are returned and stay in place as long as they are held.
+    maps = []
+    for path in _blast_db_files(db):
+        with open(path, "rb") as ifile:
+            mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_WILLNEED)
+        for start in range(0, len(mm), block_size):
+            mm[start:start + block_size]
+        maps.append(mm)
+    return maps
+
+def _hold(db, interval=600):
+    maps = _pin(db)
+    print(F"Pinned {len(maps)} files")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            print(_residency_report(db), flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for mm in maps:
+            mm.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep a BLAST database resident in the page cache for a batch of classify runs")
+    parser.add_argument("-d", "--db", required=True, help="BLAST database prefix, the blast_database of the training result")
+    parser.add_argument("-i", "--interval", type=float, default=600, help="Seconds between residency reports")
+    parser.add_argument("-r", "--report", action="store_true", help="Only report how much of the database is resident")
+    args = parser.parse_args()
+    if args.report:
+        print(_residency_report(args.db))
+    else:
+        _hold(args.db, args.interval)
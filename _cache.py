@@ -0,0 +1,66 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import hashlib, json, os, glob, subprocess, threading
+
+def _file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as ifile:
+        for block in iter(lambda: ifile.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _key(*parts):
+    return hashlib.sha256("\0".join([str(part) for part in parts]).encode("utf-8")).hexdigest()
+
+def _tool_version(cmd):
+    # First line the tool prints about its version, or "" if it cannot be run
+    try:
+        out = subprocess.run(cmd, capture_output=True)
+    except OSError:
+        return ""
+    return (out.stdout or out.stderr).decode("utf-8").strip().split("\n")[0]
+
+def _rdp_version():
+    try:
+        return subprocess.run(['conda', 'list', 'rdptools'], capture_output=True).stdout.decode('utf-8').split("\n")[-2].split()[1]
+    except (OSError, IndexError):
+        return ""
+
+def _tool_versions():
+    return {"sintax" : _tool_version(['vsearch', '--version']),
+            "blast" : _tool_version(['makeblastdb', '-version']),
+            "rdp" : _rdp_version()}
+
+class _TrainingCache:
+    # Manifest of what has been built in a training directory. Each stage is stored
+    # under a key hashing everything its outputs depend on (reference digest, format,
+    # dup, tool version), so a stage only needs rebuilding when its key changes or
+    # one of its outputs has gone missing.
+    def __init__(self, tf):
+        self.path = os.path.join(tf, "training_cache.json")
+        try:
+            with open(self.path, "r") as ifile:
+                self.entries = json.load(ifile)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+        self.lock = threading.Lock()
+
+    def fresh(self, stage, key, outputs=()):
+        # outputs are glob patterns, each of which must match at least one file
+        return self.entries.get(stage) == key and all([glob.glob(pattern) for pattern in outputs])
+
+    def update(self, stage, key, **extra):
+        # Builds running side by side record themselves as they finish
+        with self.lock:
+            self.entries[stage] = key
+            self.entries.update(extra)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as ofile:
+                json.dump(self.entries, ofile, indent=1)
+            os.replace(tmp_path, self.path)
@@ -6,296 +6,251 @@
 # The full license in the file LICENSE, distributed with this software.
 # -------------------------------------------------------------------------
 
-import sys, os, itertools
+import sys, os, re, itertools
+import numpy as np
 import pandas as pd
+from ._lineage import _split_lineage
+from ._table import _TaxonomyTable, _TaxonVocabulary
 
-def _reformat_RDP(rdp_file, output_dir, confidence, ranks):
-	input = open(rdp_file)
-	all_lines = input.readlines()
-	input.close()
-
-	output_file = F"{output_dir}/otu_taxonomy_rdp_final.txt"
-	output = open(output_file,"w")
+_RDP_RE = re.compile(r"\t([^\t]*)\t[^\t]*\t([^\t]*)") # taxon, rank, confidence triples
+_SCORED_RE = re.compile(r"([^,]+)\(([^()]*)\)") # SINTAX/UTAX "p:Ascomycota(0.9700)" predictions
 
+def _final_header(ranks):
 	if ranks[0] == "Kingdom":
-		output.write("Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score")
-		output.write("\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n")
-	else:
-		output.write("Feature ID\tOTU_Score")
-		for r in ranks:
-			output.write(F"\t{r}\t{r.replace('ank_', '')}_score")
-		output.write("\n")
-
-	for i, line in enumerate(all_lines):
-		# capture confidence level at genus before altering line
-		temp = line.strip().split("\t")
-		confi = temp[7:-2][::3]
-		confi.append(temp[-1])
-		taxon = temp[5:][::3]
-
-		# remove any taxonomic levels after first "unidentified"
-		j=0
-		new_taxon = []
-		while j<len(taxon):
-			if	"ncertae_sedis" in taxon[j]:
-				taxon[j] = "Incertae_sedis"
-			if  "unidentified" in taxon[j] or float(confi[j])<confidence:
-				del confi[j:]
-				break
-			else: new_taxon.append(taxon[j].capitalize())
-			j+=1
-
-		# remove "_sp" species classifications
-		if ranks[0] == "Kingdom" and len(new_taxon)>0 and (" sp" in new_taxon[-1] or "_sp" in new_taxon[-1]):
-			del new_taxon[-1]
-			del confi[-1]
-		# remove terminal Incertae_sedis
-		while len(new_taxon)>0 and "ncertae_sedis" in new_taxon[-1]:
-			del new_taxon[-1]
-			del confi[-1]
-
-
-		if confi == []:
-			score = "NA"
-		else:
-			score = confi[-1]
-		tax_confi = ""
-		for k in range(len(new_taxon)):
-			tax_confi += F"\t{new_taxon[k]}\t{confi[k]}"
-
-		# iters = [iter(new_taxon), iter(confi)]
-		# tax_confi = list(str(it.next()) for it in itertools.cycle(iters))
-
-		# output.write(temp[0]+"\t"+score+"\t"+"\t".join(tax_confi)+"\n")
-		output.write(F"{temp[0]}\t{score}{tax_confi}\n")
-
-	output.close()
-	return output_file
+		return ("Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score"
+			"\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n")
+	return "Feature ID\tOTU_Score" + "".join([F"\t{r}\t{r.replace('ank_', '')}_score" for r in ranks]) + "\n"
+
+def _tax_confi(taxa, confid):
+	return "".join([F"\t{t}\t{c}" for t, c in zip(taxa, confid)])
+
+def _collect_rows(rows, output_file, ranks, write_final=True, vocab=None):
+	# Load reformatted rows into a _TaxonomyTable, optionally also writing them out as
+	# the otu_taxonomy_*_final.txt file
+	table = _TaxonomyTable(ranks, vocab)
+	if not write_final:
+		for row in rows:
+			table.add_row(row)
+		return None, table
+	with open(output_file, "w") as output:
+		output.write(_final_header(ranks))
+		for row in rows:
+			table.add_row(row)
+			output.write(row)
+	return output_file, table
+
+def _write_final(in_file, output_file, ranks, parse_line, write_final=True, vocab=None):
+	# Stream classifier output through a per-line parser, one output row per input line
+	with open(in_file, "r") as input:
+		return _collect_rows((parse_line(line) for line in input), output_file, ranks, write_final, vocab)
+
+def _rdp_line(line, confidence, ranks):
+	# OTU_1		Root	rootrank	1.0	Fungi	Kingdom	0.98	Zygomycota	Phylum	0.05 ...
+	fields = line.strip().split("\t", 5)
+	new_taxon = []
+	confi = []
+	# remove any taxonomic levels after first "unidentified"
+	for taxon, conf in _RDP_RE.findall("\t" + fields[-1] if len(fields) > 5 else ""):
+		if "ncertae_sedis" in taxon:
+			taxon = "Incertae_sedis"
+		if "unidentified" in taxon or float(conf) < confidence:
+			break
+		new_taxon.append(taxon.capitalize())
+		confi.append(conf)
+
+	# remove "_sp" species classifications
+	if ranks[0] == "Kingdom" and len(new_taxon)>0 and (" sp" in new_taxon[-1] or "_sp" in new_taxon[-1]):
+		del new_taxon[-1]
+		del confi[-1]
+	# remove terminal Incertae_sedis
+	while len(new_taxon)>0 and "ncertae_sedis" in new_taxon[-1]:
+		del new_taxon[-1]
+		del confi[-1]
+
+	score = confi[-1] if confi else "NA"
+	return F"{fields[0]}\t{score}{_tax_confi(new_taxon, confi)}\n"
+
+def _reformat_RDP(rdp_file, output_dir, confidence, ranks, write_final=True, vocab=None):
+	return _write_final(rdp_file, F"{output_dir}/otu_taxonomy_rdp_final.txt", ranks,
+		lambda line: _rdp_line(line, confidence, ranks), write_final, vocab)
 
 ################################################################################
-def _reformat_UTAX(utax_file, output_dir, confidence, ranks):
-	input = open(utax_file)
-	all_lines = input.readlines()
-	input.close()
+def _utax_line(line, confidence, ranks):
+	# OTU_1328	d:Fungi,p:Ascomycota(0.9700),c:Archaeorhizomycetes(0.8000),...
+	temp = line.split()
+	domain, _, scored = temp[1].partition(",")
+	pairs = _SCORED_RE.findall(scored)
+	temp4 = []
+	confid = []
+	for taxon, conf in pairs:
+		if "unidentified" in taxon or float(conf) < confidence:
+			break
+		temp4.append(taxon[2:].capitalize())
+		confid.append(conf)
+
+	# remove "_sp" species classificaitons
+	if ranks[0] == "Kingdom" and len(temp4)>0 and temp4[-1].endswith("_sp"):
+		del temp4[-1]
+		del confid[-1]
+	# remove terminal Incertae_sedis
+	while len(temp4)>0 and "ncertae_sedis" in temp4[-1]:
+		del temp4[-1]
+		del confid[-1]
+
+	score = confid[-1] if confid else 0
+	return F"{temp[0]}\t{score}\t{domain[2:].capitalize()}\tNA{_tax_confi(temp4, confid)}\n"
+
+def _reformat_UTAX(utax_file, output_dir, confidence, ranks, write_final=True, vocab=None):
+	return _write_final(utax_file, F"{output_dir}/otu_taxonomy_utax_final.txt", ranks,
+		lambda line: _utax_line(line, confidence, ranks), write_final, vocab)
 
-	output_file = F"{output_dir}/otu_taxonomy_utax_final.txt"
-	output = open(output_file,"w")
+################################################################################
+def _sintax_line(line, confidence, ranks):
+	# OTU_999	d:Fungi(1.0000),p:Ascomycota(1.0000),c:Leotiomycetes(1.0000),o:Helotiales(1.0000),s:Helotiales_sp(1.0000)	+	...
+	temp = line.split("\t")
+	ID = temp[0].split(" ")[0]
+	pairs = _SCORED_RE.findall(temp[1])
+	if len(pairs) == 0:
+		tax_confi = '\t'.join([""]*len(ranks)*2)
+		return F"{ID}\t{0.0000}\t{tax_confi}\n"
+	confid = [conf for taxon, conf in pairs]
+	# The lowest prediction is not reported, as in earlier releases
+	temp1 = ",".join([taxon for taxon, conf in pairs[:-1]]).split(",")
+
+	# fix missing taxonomic levels
 	if ranks[0] == "Kingdom":
-		output.write("Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score")
-		output.write("\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n")
-	else:
-		output.write("Feature ID\tOTU_Score")
-		for r in ranks:
-			output.write(F"\t{r}\t{r.replace('ank_', '')}_score")
-		output.write("\n")
-
-	for i, line in enumerate(all_lines):
-		#remove unwanted third column and convert "(" and ")" to "*"
-		temp = line.replace("(", "*").replace(")","*").split()
-		line = temp[0]+"\t"+temp[1]
-
-		temp0 = line.split("*")
-		confid = temp0[1:][::2]
-		line2 = "".join(temp0[0:-2][::2])
-
-		temp1 = line2.split(",")
-		j=1
-		new_line = [temp1[0]]
-		while j<len(temp1):
-			if  "unidentified" in temp1[j] or float(confid[j-1]) < confidence:
-				del confid[j-1:]
-				break
+		levels = ["d:", "k:", "p:", "c:", "o:", "f:", "g:", "s:"]
+		if len(temp1)<len(levels) and len(temp1) > 1:
+			if "g:" in temp1[-2]:
+				for k, level in enumerate(temp1):
+					if levels[k] not in temp1[k]:
+						temp1.insert(k, levels[k]+"Incertae_sedis")
+						confid.insert(k, 9)
 			else:
-				new_line.append(temp1[j])
-			j+=1
-
-		line2 = ",".join(new_line)
-
-		temp2 = line2.split(",")
-		# OTU_1328        d:Fungi, p:Ascomycota, c:Archaeorhizomycetes, o:Archaeorhizomycetales, f:Archaeorhizomycetaceae, g:Archaeorhizomyces, s:Archaeorhizomyces_sp
-		temp3 = temp2[0].split()
-		# OTU_1328, d:Fungi
-		temp4 = []
-		for item in temp2[1:]:
-			temp4.append(item[2:].capitalize())
-		# Ascomycota, Archaeorhizomycetes, Archaeorhizomycetales, Archaeorhizomycetaceae, Archaeorhizomyces, Archaeorhizomyces_sp
-
-		# remove "_sp" species classificaitons
-		if ranks[0] == "Kingdom" and len(temp4)>0 and temp4[-1].endswith("_sp"):
-			del temp4[-1]
-			del confid[-1]
-
-		# remove terminal Incertae_sedis
-		while len(temp4)>0 and "ncertae_sedis" in temp4[-1]:
-			del temp4[-1]
-			del confid[-1]
-
-		confid = [str(x) for x in confid]
-		if len(confid) > 0:
-			score = confid[-1]
+				for k, level in enumerate(temp1):
+					if levels[k] not in temp1[k]:
+						temp1.insert(k, levels[k]+"unidentified")
+						confid.insert(k, 0)
+
+	j=0
+	temp2 = []
+	while j<len(temp1):
+		if  "unidentified" in temp1[j]:
+			del confid[j:]
+			break
+		elif confid[j]==9 and float(confid[j+1])<confidence:
+			del confid[j:]
+			break
+		elif float(confid[j])<confidence:
+			del confid[j:]
+			break
 		else:
-			score = 0
-		if len(temp3) > 1:
-			final_line = F"{temp3[0]}\t{score}\t{temp3[1][2:].capitalize()}\tNA"
-			tax_confi = ""
-			for k in range(len(temp4)):
-				tax_confi += F"\t{temp4[k]}\t{confid[k]}"
-
-			output.write(F"{final_line+tax_confi}\n")
-		else:
-			tax_confi = '\t'.join([""]*len(ranks)*2)
-			output.write(F"{temp0[0]}\t{0.0000}\t{tax_confi}\n")
-
-	output.close()
-	return output_file
+			temp2.append(temp1[j].capitalize())
+		j+=1
+
+	# remove "_sp" species classificaitons
+	if len(temp2)>0 and temp2[-1].endswith("_sp"):
+		del temp2[-1]
+		del confid[-1]
+	# remove terminal Incertae_sedis
+	while len(temp2)>0 and "Incertae_sedis" in temp2[-1]:
+		del temp2[-1]
+		del confid[-1]
+
+	confid = [str(x) if x!=9 else "NA" for x in confid]
+	new_taxonomy = [item[2:].capitalize() for item in temp2]
+	score = confid[-1] if confid else "NA"
+	return F"{ID}\t{score}{_tax_confi(new_taxonomy, confid)}\n"
+
+def _reformat_SINTAX(sintax_file, output_dir, confidence, ranks, write_final=True, vocab=None):
+	return _write_final(sintax_file, F"{output_dir}/otu_taxonomy_sintax_final.txt", ranks,
+		lambda line: _sintax_line(line, confidence, ranks), write_final, vocab)
 
 ################################################################################
-def _reformat_SINTAX(sintax_file, output_dir, confidence, ranks):
-	input = open(sintax_file)
-	all_lines = input.readlines()
-	input.close()
-
-	output_file = F"{output_dir}/otu_taxonomy_sintax_final.txt"
-	output = open(output_file, "w")
-	if ranks[0] == "Kingdom":
-		output.write("Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score")
-		output.write("\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n")
+def _blast_consensus(blast_res, confidence, max_hits, ethresh, p_iden_thresh, ranks):
+	# Filter hits once, keep the first max_hits of each query, then take the majority
+	# taxon and its fraction for every query and rank from grouped counts. A query is
+	# classified down to the first rank failing the thresholds, as before.
+	queries = pd.unique(blast_res["query"])
+	hits = blast_res[(blast_res["e_value"] <= ethresh) & (blast_res["percent_identity"] >= p_iden_thresh)]
+	hits = hits.groupby("query", sort=False).head(max_hits)
+	passing = pd.Series(True, index=queries)
+	score = pd.Series("0.0", index=queries)
+	body = pd.Series("", index=queries)
+	for t in ranks:
+		if t not in hits.columns and t == "Kingdom":
+			t = "Domain"
+		counts = hits.groupby(["query", t], sort=False).size()
+		top = counts.sort_values(ascending=False, kind="stable").groupby(level=0, sort=False).head(1)
+		top_query = top.index.get_level_values(0)
+		taxon = pd.Series(top.index.get_level_values(1), index=top_query).reindex(queries)
+		frac = (pd.Series(top.to_numpy(), index=top_query) / counts.groupby(level=0, sort=False).sum()).reindex(queries)
+		failed = taxon.isna()
+		taxon = taxon.fillna("").astype(str)
+		failed |= taxon.str.contains("unidentified", regex=False) | (frac < confidence)
+		if t == ranks[-1]:
+			failed |= taxon.str.endswith("_sp")
+		passing &= ~failed
+		frac = frac.map(str)
+		taxon = taxon.mask(taxon.str.contains("ncertae_sedis", regex=False), "Incertae_sedis")
+		body = body + ("\t" + taxon + "\t" + frac).where(passing, "")
+		score = score.mask(passing, frac)
+	rows = pd.Series(queries, index=queries).str.split(" ").str[0] + "\t" + score + body
+	no_hits = ~pd.Series(queries, index=queries).isin(hits["query"])
+	rows[no_hits] = rows[no_hits].str.split("\t").str[0] + "\t0.0" + "\t"*len(ranks)*2
+	return rows.tolist()
+
+_BLAST_COLS = ["query", "subject", "e_value", "bitscore", "percent_identity", "query_coverage"]
+
+def _blast_frame(rows, ranks):
+	blast_res = pd.DataFrame(rows, columns=_BLAST_COLS + list(ranks))
+	blast_res = blast_res.astype({"e_value" : "float64", "percent_identity" : "float64", "query" : "str"})
+	blast_res["percent_identity"] /= 100 # pident is a percentage, p_iden is a proportion
+	return blast_res
+
+def _iter_blast_tab(blast_file, ranks, format, batch_size=10000):
+	# Parse `blastn -outfmt "7 qacc sacc evalue bitscore pident qcovs [stitle]"` output
+	# query block by query block, yielding tables of up to batch_size queries. The
+	# subject lineage is split into rank columns like the UTAX headers; a query
+	# without hits gets one empty row so it is still reported.
+	rows = []
+	query_count = 0
+	empty = [None]*(len(_BLAST_COLS) - 1 + len(ranks))
+	with open(blast_file, "r") as ifile:
+		for line in ifile:
+			if line.startswith("# Query: "):
+				if query_count == batch_size:
+					yield _blast_frame(rows, ranks)
+					rows = []
+					query_count = 0
+				query = line[9:].strip()
+				query_count += 1
+			elif line.startswith("# 0 hits found"):
+				rows.append([query] + empty)
+			elif line[0] != "#" and not line.isspace():
+				spl = line.rstrip("\n").split("\t")
+				lineage = [x for x in " ".join(spl[1:2] + spl[6:]).split() if ";" in x]
+				taxa = _split_lineage(lineage[-1], format)[:len(ranks)] if lineage else []
+				rows.append(spl[:6] + taxa + [None]*(len(ranks) - len(taxa)))
+	if rows:
+		yield _blast_frame(rows, ranks)
+
+def _blast_rows(blast_file, confidence, max_hits, ethresh, p_iden_thresh, ranks, format):
+	with open(blast_file, "r") as ifile:
+		tabular = ifile.read(1) == "#"
+	if tabular: # blastn -outfmt 7, consensus is built a batch of queries at a time
+		blast_batches = _iter_blast_tab(blast_file, ranks, format)
 	else:
-		output.write("Feature ID\tOTU_Score")
-		for r in ranks:
-			output.write(F"\t{r}\t{r.replace('ank_', '')}_score")
-		output.write("\n")
-	for i, line in enumerate(all_lines):
-		# remove unwanted third column and convert "(" and ")" to "*"
-		# temp = line.replace("(", "*").replace(")","*").split("\t")
-		temp = line.split("\t")
-		ID = temp[0].split(" ")[0]
-		del temp[2:]
-		# temp =>  'OTU_999'	'd:Fungi*1.0000*,p:Ascomycota*1.0000*,c:Leotiomycetes*1.0000*,o:Helotiales*1.0000*,s:Helotiales_sp*1.0000*'
-		### NEW STUFF
-		temp0 = temp[1].split(",")
-		res = []
-		for x in temp0:
-			t = list(x)
-			if len(t) == 0:
-				break
-			t[-1] = "*"
-			t[-8] = "*"
-			res.append("".join(t))
-		if len(t) != 0:
-			temp0 = ",".join(res).split("*")[:-1]
-			### END NEW STUFF
-			# temp0 = temp[1].split("*")
-			# temp0 =>  'd:Fungi,' '1.0000' ',p:Ascomycota' '1.0000' ',c:Leotiomycetes' '1.0000' ',o:Helotiales' '1.0000' ',s:Helotiales_sp' '1.0000'
-			confid = temp0[1:][::2]
-			# confid =>  '1.0000' '1.0000' '1.0000' '1.0000' '1.0000'
-			temp_line = "".join(temp0[0:-2][::2])
-			# temp_line =>  "d:Fungi,p:Ascomycota,c:Leotiomycetes,o:Helotiales,s:Helotiales_sp"
-
-			# fix missing taxonomic levels
-			temp1 = temp_line.split(",")
-			# temp1 =>  'd:Fungi' 'p:Ascomycota' 'c:Leotiomycetes' 'o:Helotiales' 's:Helotiales_sp'
-			if ranks[0] == "Kingdom":
-				levels = ["d:", "k:", "p:", "c:", "o:", "f:", "g:", "s:"]
-				if len(temp1)<len(levels) and len(temp1) > 1:
-					if "g:" in temp1[-2]:
-						for k, level in enumerate(temp1):
-							if levels[k] not in temp1[k]:
-								temp1.insert(k, levels[k]+"Incertae_sedis")
-								confid.insert(k, 9)
-					else:
-						for k, level in enumerate(temp1):
-							if levels[k] not in temp1[k]:
-								temp1.insert(k, levels[k]+"unidentified")
-								confid.insert(k, 0)
-
-			j=0
-			temp2 = []
-			while j<len(temp1):
-				if  "unidentified" in temp1[j]:
-					del confid[j:]
-					break
-				elif confid[j]==9 and float(confid[j+1])<confidence:
-					del confid[j:]
-					break
-				elif float(confid[j])<confidence:
-					del confid[j:]
-					break
-				else:
-					temp2.append(temp1[j].capitalize())
-				j+=1
-
-			# remove "_sp" species classificaitons
-			if len(temp2)>0 and temp2[-1].endswith("_sp"):
-				del temp2[-1]
-				del confid[-1]
-			# remove terminal Incertae_sedis
-			while len(temp2)>0 and "Incertae_sedis" in temp2[-1]:
-				del temp2[-1]
-				del confid[-1]
-
-			confid = [str(x) if x!=9 else "NA" for x in confid]
-
-			new_taxonomy = []
-			for item in temp2:
-				new_taxonomy.append(item[2:].capitalize())
-
-			if confid == []:
-				score = "NA"
-			else:
-				score = confid[-1]
-
-			tax_confi = ""
-			for k in range(len(new_taxonomy)):
-				tax_confi += F"\t{new_taxonomy[k]}\t{confid[k]}"
-
-			output.write(F"{ID}\t{score}{tax_confi}\n")
-		else:
-			tax_confi = '\t'.join([""]*len(ranks)*2)
-			output.write(F"{ID}\t{0.0000}\t{tax_confi}\n")
-
+		blast_res = pd.read_csv(blast_file) # Read the input csv
+		blast_batches = [blast_res.astype({"e_value" : "float64", "query" : "str"})]
+	for blast_res in blast_batches:
+		for row in _blast_consensus(blast_res, confidence, max_hits, ethresh, p_iden_thresh, ranks):
+			yield F"{row}\n"
 
-	output.close()
-	return output_file
-
-################################################################################
-def _reformat_BLAST(blast_file, output_dir, confidence, max_hits, ethresh, p_iden_thresh, ranks):
+def _reformat_BLAST(blast_file, output_dir, confidence, max_hits, ethresh, p_iden_thresh, ranks, format="UNITE", write_final=True, vocab=None):
 	output_file = F"{output_dir}/otu_taxonomy_blast_final.txt" # Filename for output
-	if ranks[0] == "Kingdom":
-		classification_buf = "Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score"
-		classification_buf += "\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n"
-	else:
-		classification_buf = "Feature ID\tOTU_Score"
-		for r in ranks:
-			classification_buf += F"\t{r}\t{r.replace('ank_', '')}_score"
-		classification_buf += "\n"
-
-	blast_res = pd.read_csv(blast_file) # Read the input csv
-	blast_res = blast_res.astype({"e_value" : "float64", "query" : "str"})
-	uniq = pd.unique(blast_res["query"]) # List of all otus
-	for q in uniq:
-		q_list = [q.split(" ")[0], "0.0"] # OTU and placeholder confidence
-		q_sub = blast_res[(blast_res["query"] == q) & (blast_res["e_value"] <= ethresh) & (blast_res["percent_identity"] >= p_iden_thresh)] # Subset by OTU and e_values
-		if len(q_sub) == 0:
-			q_list.extend([""]*len(ranks)*2)
-		else:
-			q_sub = q_sub[:min([len(q_sub), max_hits])] # Take all hits or up to max_hits
-			for t in ranks:
-				if t not in q_sub.columns and t == "Kingdom":
-					t = "Domain"
-				vcs = q_sub[t].value_counts(normalize = True)
-				if len(vcs) == 0 or "unidentified" in vcs.index[0] or vcs[0] < confidence or (t == ranks[-1] and vcs.index[0].endswith("_sp")): # If unidentified, under conf thresh, or a species with "_sp", break
-				    break
-				else:
-					if "ncertae_sedis" in vcs.index[0]:
-					    q_list.extend(["Incertae_sedis", str(vcs[0])])
-					else:
-						q_list.extend([vcs.index[0], str(vcs[0])])
-					q_list[1] = str(vcs[0])
-		classification_buf += "\t".join(q_list) + "\n"
-	with open(output_file, "w") as ofile:
-	    ofile.write(classification_buf)
-	return output_file
+	return _collect_rows(_blast_rows(blast_file, confidence, max_hits, ethresh, p_iden_thresh, ranks, format),
+		output_file, ranks, write_final, vocab)
 
 ################################################################################
 def _build_iso_hl_dict(blast_outfile, hl_qc=75, hl_id=0, iso_qc=75, iso_id=0, hl=False, hl_fmt="UNITE"):
@@ -338,25 +293,12 @@ def _build_iso_hl_dict(blast_outfile, hl_qc=75, hl_id=0, iso_qc=75, iso_id=0, hl
 
 ################################################################################
 def _build_dict(filename, ranks):
-	file = open(filename, "r")
-	all_lines = file.readlines()
-	file.close()
-
-	dict = {}
-	for i, line in enumerate(all_lines[1:]):
-		temp = line.replace(" ", "_").strip().split()
-		dict[temp[0]] = []
-		if len(temp)>2:
-			dict[temp[0]]=temp[2:]
-		if len(dict[temp[0]])<len(ranks)*2:
-			while len(dict[temp[0]])<len(ranks)*2:
-				dict[temp[0]].append("")
-		# strip numbers from species identifications
-		species = "".join(
-						list(
-							filter(lambda c: not c.isdigit(), dict[temp[0]][-2])))
-		dict[temp[0]][-2] = species.replace("_"," ")
-	return dict
+	table = _TaxonomyTable(ranks)
+	with open(filename, "r") as file:
+		file.readline()
+		for line in file:
+			table.add_row(line)
+	return table
 
 ################################################################################
 def _real_hier(filename):
@@ -415,17 +357,65 @@ def _vote(cla1, cla2, cla3, conservative):
 	return winner
 
 ################################################################################
-def _count_classifications(filenames, output_dir, format, rank_count, use_blast=False):
+def _vote_batch(tables, otus, conservative):
+	# _vote for every OTU in otus and every rank at once. tables are the three
+	# classifiers' _TaxonomyTables, sharing one vocabulary. Returns an (OTUs x ranks)
+	# array of winning taxon IDs, 0 where there is no winner.
+	vocab = tables[0].vocab
+	na_stripped = np.array([vocab.intern(x.replace("NA", "")) for x in list(vocab.names)], dtype=np.int32)
+	taxa = np.stack([na_stripped[t.taxa[[t.index[otu] for otu in otus]]] for t in tables], axis=-1)
+	scores = np.stack([t.scores[[t.index[otu] for otu in otus]] for t in tables], axis=-1)
+	t0, t1, t2 = taxa[..., 0], taxa[..., 1], taxa[..., 2]
+	empty = taxa == 0
+	empty_count = empty.sum(axis=-1)
+
+	# Two or three classifiers agree: the majority taxon (0 if they agree on nothing)
+	majority = np.where((t0 == t1) | (t0 == t2), t0, np.where(t1 == t2, t1, 0))
+	# Only one classifier assigned a taxon
+	single = np.zeros_like(t0) if conservative else taxa.max(axis=-1)
+	# Two classifiers disagree: the first classifier holding the best score of the
+	# two wins, unless the disagreement is with the third classifier being empty
+	best = np.where(empty, -np.inf, scores).max(axis=-1)
+	best_pick = np.take_along_axis(taxa, (scores == best[..., None]).argmax(axis=-1)[..., None], axis=-1)[..., 0]
+	split = np.where(empty[..., 2], 0, best_pick)
+
+	winners = np.where(empty_count == 0, majority, 0)
+	winners = np.where(empty_count == 2, single, winners)
+	winners = np.where((empty_count == 1) & (majority != 0), majority, winners)
+	winners = np.where((empty_count == 1) & (majority == 0), split, winners)
+	return winners
+
+################################################################################
+def _iter_taxonomies(source, start, freq, rank_count):
+	# Taxon names of each OTU, from a _TaxonomyTable or from the tab-separated columns
+	# of a final or consensus taxonomy file
+	if isinstance(source, _TaxonomyTable):
+		for width, row in zip(source.widths, zip(*[source.names(k) for k in range(rank_count)])):
+			taxonomy = list(row[:width])
+			if width==rank_count: # species numbers were stripped when the table was built
+				taxonomy[-1] = taxonomy[-1].strip()
+			yield taxonomy
+		return
+	with open(source, "r") as input:
+		input.readline()
+		for line in input:
+			temp = line.strip().split("\t")
+			taxonomy = temp[start::freq]
+			if len(taxonomy)==rank_count:
+				# strip numbers from species identifications
+				species = "".join(list(filter(lambda c: not c.isdigit(), taxonomy[-1])))
+				taxonomy[-1] = species.replace("_"," ").strip()
+			yield taxonomy
+
+def _count_classifications(sources, output_dir, format, rank_count, use_blast=False):
 	# rdp, utax, sintax, consensus OR
 	# rdp, sintax, blast, consensus
+	# each a _TaxonomyTable or a taxonomy file
 	file_num = 0
 	unique_dict = {}
 	for i in range(rank_count):
 		unique_dict[i] = {}
-	for i, file in enumerate(filenames):
-		input = open(file, "r")
-		all_lines = input.readlines()
-		input.close()
+	for i, source in enumerate(sources):
 		count_y = [0]*rank_count
 		count_n = [0]*rank_count
 		output1 = open(F"{output_dir}/otu_taxonomy_CountClassified.txt", "w")
@@ -435,14 +425,7 @@ def _count_classifications(filenames, output_dir, format, rank_count, use_blast=
 		else: 	#consensus file does not have scores
 			start= 1
 			freq = 1
-		for j, line in enumerate(all_lines[1:]):
-			temp = line.strip().split("\t")
-			taxonomy = temp[start::freq]
-			if len(taxonomy)==rank_count:
-				# strip numbers from species identifications
-				species = "".join(list(filter(lambda c: not c.isdigit(), taxonomy[-1])))
-				taxonomy[-1] = species.replace("_"," ").strip()
-
+		for taxonomy in _iter_taxonomies(source, start, freq, rank_count):
 			for k in range(0,rank_count):
 				if k<len(taxonomy):
 					count_y[k]+=1
@@ -507,347 +490,144 @@ def _to_TSVTaxonomyFormat(df):
 
 ################################################################################
 
+_CLASSIFIER_NAMES = {"rdp" : "RDP", "sintax" : "SINTAX", "blast" : "BLAST", "utax" : "UTAX"}
+
+_FORMAT_EXAMPLES = {
+	"UNITE" : {"rdp" : "Input file not in RDP format. Please Reformat As Below:\nOTU_###	_	Root	rootrank	1.0	Fungi	Kingdom	0.98	Zygomycota	Phylum	0.05	Zygomycota_Incertae_sedis	Class	0.05	Mucorales	Order	0.04	Syncephalastraceae	Family	0.01	Fennellomyces	Genus	0.01	Fennellomyces linderi	Species	0.01",
+		"utax" : "Input file not in UTAX format. Please Reformat As Below:\nOTU_###	d:Fungi,p:Ascomycota(0.9700),c:Pezizomycetes(0.8000),o:Pezizales(0.7900),f:Sarcosomataceae(0.7700),g:Pseudoplectania(0.3700),s:Pseudoplectania_nigrella(0.3700)	+	d:Fungi,p:Ascomycota,c:Pezizomycetes",
+		"blast" : "Input file not in BLAST format. Please Reformat As Below:\nquery,subject,bitscore,e_value,percent_identity,query_coverage,kingdom,phylum,class,order,family,genus,species",
+		"sintax" : "Input file not in SINTAX format. Please Reformat As Below:\nOTU_###	d:Fungi(1.0000),p:Ascomycota(0.9700),c:Pezizomycetes(0.8000),o:Pezizales(0.7900),f:Sarcosomataceae(0.7700),g:Pseudoplectania(0.3700),s:Pseudoplectania_nigrella(0.3700)	+	d:Fungi,p:Ascomycota,c:Pezizomycetes"},
+	"SILVA" : {"rdp" : "Input file not in RDP format. Please Reformat As Below:\nOTU_###	Root	rootrank	1.0	Bacteria_1	Rank_1	1.0	Firmicutes_1	Rank_2	1.0	Bacilli_1	Rank_3	1.0	Bacillales_1	Rank_4	0.8	Bacillaceae_1	Rank_5	0.8	Bacillus_1	Rank_6	0.8	Bacillus_pumilus_1	Rank_7	0.8",
+		"utax" : "Input file not in UTAX format. Please Reformat As Below:\nOTU_###	d:Bacteria_1(1.0000),k:Firmicutes_1(1.0000),p:Bacilli_1(0.9600),c:Bacillales_1(0.7200),o:Bacillaceae_1(0.7200),f:Bacillus_1(0.7200),g:Bacillus_pumilus_1(0.7200)	+	d:Bacteria_1,k:Firmicutes_1,p:Bacilli_1",
+		"blast" : "Input file not in BLAST format. Please Reformat As Below:\nquery,subject,bitscore,e_value,percent_identity,query_coverage,Rank_1,Rank_2,Rank_3,Rank_4,Rank_5,Rank_6,Rank_7",
+		"sintax" : "Input file not in SINTAX format. Please Reformat As Below:\nOTU_###	d:Bacteria_1(1.0000),k:Firmicutes_1(1.0000),p:Bacilli_1(0.9600),c:Bacillales_1(0.7200),o:Bacillaceae_1(0.7200),f:Bacillus_1(0.7200),g:Bacillus_pumilus_1(0.7200)	+	d:Bacteria_1,k:Firmicutes_1,p:Bacilli_1"}}
+
+def _check_classifier_file(file_name, classifier, format):
+	if not os.path.isfile(file_name):
+		raise FileNotFoundError(F"{classifier.upper()} file could not be opened.")
+	examples = _FORMAT_EXAMPLES["UNITE" if format == "UNITE" else "SILVA"]
+	with open(file_name, "r") as input_file:
+		line = input_file.readline()
+		temp0 = line.split("\t")
+		if classifier == "rdp":
+			if len(temp0)==0:
+				raise ValueError("RDP file is empty. Did you allot enough memory with --mem?")
+			elif len(temp0)<10 or temp0[3]!="rootrank":
+				raise ValueError(examples["rdp"])
+		elif classifier == "blast":
+			if not line.startswith("# BLASTN") and "query,subject,bitscore,e_value,percent_identity,query_coverage" not in temp0[0]:
+				raise ValueError(examples["blast"])
+		elif format == "UNITE":
+			while "+" not in line and "-" not in line and line != "":
+				line = input_file.readline()
+			if line == "":
+				raise ValueError(examples[classifier])
+		elif classifier == "utax":
+			while not temp0[1].startswith("R1:") and line != "":
+				line = input_file.readline()
+				temp0 = line.split("\t")
+			if line == "":
+				raise ValueError(examples["utax"])
+		elif temp0[1].startswith("R1:"):
+			raise ValueError(examples["sintax"])
+
+def _write_rows(ofile, rows, batch_size=10000):
+	buf = []
+	for row in rows:
+		buf.append(row)
+		if len(buf) == batch_size:
+			ofile.write("".join(buf))
+			buf = []
+	ofile.write("".join(buf))
+
 def _combine_taxonomy(output_dir, conf, tax, evalue, mhits, p_iden, format, db, tf, isolates, iso_qc, iso_id, hl, hl_qc, hl_id, conservative, consistent, blast=True):
-    three_classifiers = ["rdp", "sintax", "blast"]
-    if format == "UNITE":
-    	filename = db
-    	filename_base = tf + "/" + ".".join(os.path.basename(filename).split(".")[:-1])
-
-    	header_line = open(filename_base + "__RDP_taxonomy.txt", "r").readline()
-    	ranks = header_line.strip().split("\t")[1:]
-    	if consistent:
-    		taxa_set = _real_hier(filename_base + "__RDP_taxonomy.txt")
-    	for classifier in three_classifiers:
-    		file_name = F"{tax}otu_taxonomy."+classifier
-    		try:
-    			open(file_name,"r")
-    		except FileNotFoundError:
-    			raise FileNotFoundError(F"{classifier.upper()} file could not be opened.")
-    		input_file = open(file_name,"r")
-    		line = input_file.readline()
-    		temp0 = line.split("\t")
-    		if classifier == "rdp":
-    			if len(temp0)==0:
-    				raise ValueError("RDP file is empty. Did you allot enough memory with --mem?")
-    			elif len(temp0)<10 or temp0[3]!="rootrank":
-    				raise ValueError("Input file not in RDP format. Please Reformat As Below:\nOTU_###	_	Root	rootrank	1.0	Fungi	Kingdom	0.98	Zygomycota	Phylum	0.05	Zygomycota_Incertae_sedis	Class	0.05	Mucorales	Order	0.04	Syncephalastraceae	Family	0.01	Fennellomyces	Genus	0.01	Fennellomyces linderi	Species	0.01")
-    		elif classifier == "utax":
-    			while "+" not in line and "-" not in line and line != "":
-    				line = input_file.readline()
-    			if line == "":
-    				raise ValueError("Input file not in UTAX format. Please Reformat As Below:\nOTU_###	d:Fungi,p:Ascomycota(0.9700),c:Pezizomycetes(0.8000),o:Pezizales(0.7900),f:Sarcosomataceae(0.7700),g:Pseudoplectania(0.3700),s:Pseudoplectania_nigrella(0.3700)	+	d:Fungi,p:Ascomycota,c:Pezizomycetes")
-    		elif classifier == "blast":
-    			if "query,subject,bitscore,e_value,percent_identity,query_coverage" not in temp0[0]:
-    				raise ValueError("Input file not in BLAST format. Please Reformat As Below:\nquery,subject,bitscore,e_value,percent_identity,query_coverage,kingdom,phylum,class,order,family,genus,species")
-    		else:
-    			while "+" not in line and "-" not in line and line != "":
-    				line = input_file.readline()
-    			if line == "":
-    				raise ValueError("Input file not in SINTAX format. Please Reformat As Below:\nOTU_###	d:Fungi(1.0000),p:Ascomycota(0.9700),c:Pezizomycetes(0.8000),o:Pezizales(0.7900),f:Sarcosomataceae(0.7700),g:Pseudoplectania(0.3700),s:Pseudoplectania_nigrella(0.3700)	+	d:Fungi,p:Ascomycota,c:Pezizomycetes")
-
-    		input_file.close()
-
-    		if classifier == "rdp":
-    			print("\n____________________________________________________________________\nReformatting "+classifier.upper()+" file\n")
-    			rdp_file = _reformat_RDP(file_name, output_dir, conf, ranks)
-    			rdp_dict = _build_dict(rdp_file, ranks)
-    		elif classifier == "utax":
-    			print("\nReformatting "+classifier.upper()+" file\n")
-    			uta_file = _reformat_UTAX(file_name, output_dir, conf, ranks)
-    			uta_dict = _build_dict(uta_file, ranks)
-    		elif classifier == "blast":
-    			print("\nReformatting "+classifier.upper()+" file\n")
-    			blast_file = _reformat_BLAST(file_name, output_dir, conf, max_hits=mhits, ethresh=evalue, p_iden_thresh=p_iden, ranks=ranks)
-    			blast_dict = _build_dict(blast_file, ranks)
-    		else:
-    			print("\nReformatting "+classifier.upper()+" file\n")
-    			sin_file = _reformat_SINTAX(file_name, output_dir, conf, ranks)
-    			sin_dict = _build_dict(sin_file, ranks)
-    		print("\tDone\n")
-    	if isolates == "True":
-    		print("\nReformatting isolate result file\n")
-    		iso_dict = _build_iso_hl_dict(F"{tax}/isolates_blast.out", iso_qc=iso_qc, iso_id=iso_id)
-    		print("\tDone\n")
-    	if hl != "null":
-    		print("\nReformatting high level tax result file\n")
-    		print(F"User set query coverage minimum: {hl_qc} User set percent identity minimum: {hl_id}")
-    		hl_dict = _build_iso_hl_dict(F"{tax}/hl_blast.out", hl=True, hl_fmt=hl, hl_qc=hl_qc, hl_id=hl_id)
-    		print("\tDone\n")
-    	print("\nGenerating consensus taxonomy & combined taxonomy table\n")
-    	consensus_file = F"{output_dir}/constax_taxonomy.txt"
-    	consensus = open(consensus_file, "w")
-    	if isolates == "True":
-    		consensus.write("Feature ID\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\tSpecies\tIsolate\tIsolate_percent_id\tIsolate_query_cover")
-    	else:
-    		consensus.write("Feature ID\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\tSpecies")
-    	if hl != "null":
-    		consensus.write("\tHigh_level_taxonomy\tHL_hit_percent_id\tHL_hit_query_cover")
-    	if consistent:
-    		consensus.write("\tConsistent_hierarchy\n")
-    	else:
-    		consensus.write("\n")
-    	if blast:
-    		combined = open(F"{output_dir}/combined_taxonomy.txt", "w")
-    		combined.write("Feature ID\tKingdom_RDP\tKingdom_BLAST\tKingdom_SINTAX\tKingdom_Consensus\tPhylum_RDP\tPhylum_BLAST\tPhylum_SINTAX")
-    		combined.write("\tPhylum_Consensus\tClass_RDP\tClass_BLAST\tClass_SINTAX\tClass_Consensus\tOrder_RDP\tOrder_BLAST\tOrder_SINTAX")
-    		combined.write("\tOrder_Consensus\tFamily_RDP\tFamily_BLAST\tFamily_SINTAX\tFamily_Consensus\tGenus_RDP\tGenus_BLAST\tGenus_SINTAX")
-    		combined.write("\tGenus_Consensus\tSpecies_RDP\tSpecies_BLAST\tSpecies_SINTAX\tSpecies_Consensus\n")
-
-    		for otu in rdp_dict.keys():
-    			consensus.write(otu+"\t")
-    			combined.write(otu)
-    			levels = []
-    			for m in range(0,len(ranks)*2,2):
-    				level = _vote(rdp_dict[otu][m:m+2], blast_dict[otu][m:m+2], sin_dict[otu][m:m+2], conservative)
-    				combined.write("\t"+rdp_dict[otu][m]+"\t"+blast_dict[otu][m]+"\t"+sin_dict[otu][m]+"\t")
-    				if level != "":
-    					levels.append(level)
-    				combined.write(level)
-    			levels_clean = []
-    			for x in levels:
-    				if "ncertae_sedis" in x:
-    					levels_clean.append("")
-    				else:
-    					levels_clean.append(x)
-    			consensus.write('\t'.join(levels_clean+[""]*(len(ranks)-len(levels_clean))))
-    			if isolates == "True":
-    				consensus.write(F"\t{iso_dict[otu][0]}\t{iso_dict[otu][1]}\t{iso_dict[otu][2]}")
-    			if hl != "null":
-    				consensus.write(F"\t{hl_dict[otu][0]}\t{hl_dict[otu][1]}\t{hl_dict[otu][2]}")
-    			if consistent:
-    				tax_string = '\t'.join(levels_clean)
-    				consensus.write(F"\t{int(tax_string.replace(' ', '_').strip('_') in taxa_set)}\n")
-    			else:
-    				consensus.write("\n")
-    			combined.write("\n")
-    		print("\tDone\n")
-
-    		consensus.close()
-    		combined.close()
-
-
-    		print("\nGenerating classification counts & summary table\n")
-    		_count_classifications([rdp_file, sin_file, blast_file, consensus_file], output_dir, "UNITE", len(ranks), use_blast=True)
-    	else:
-    		combined = open(F"{output_dir}/combined_taxonomy.txt", "w")
-    		combined.write("Feature ID\tKingdom_RDP\tKingdom_SINTAX\tKingdom_UTAX\tKingdom_Consensus\tPhylum_RDP\tPhylum_SINTAX\tPhylum_UTAX")
-    		combined.write("\tPhylum_Consensus\tClass_RDP\tClass_SINTAX\tClass_UTAX\tClass_Consensus\tOrder_RDP\tOrder_SINTAX\tOrder_UTAX")
-    		combined.write("\tOrder_Consensus\tFamily_RDP\tFamily_SINTAX\tFamily_UTAX\tFamily_Consensus\tGenus_RDP\tGenus_SINTAX\tGenus_UTAX")
-    		combined.write("\tGenus_Consensus\tSpecies_RDP\tSpecies_SINTAX\tSpecies_UTAX\tSpecies_Consensus\n")
-
-    		for otu in rdp_dict.keys():
-    			consensus.write(otu+"\t")
-    			combined.write(otu)
-    			levels = []
-    			for m in range(0,len(ranks)*2,2):
-    				level = _vote(rdp_dict[otu][m:m+2], sin_dict[otu][m:m+2], uta_dict[otu][m:m+2], conservative)
-    				combined.write("\t"+rdp_dict[otu][m]+"\t"+sin_dict[otu][m]+"\t"+uta_dict[otu][m]+"\t")
-    				if level != "":
-    					levels.append(level)
-    				combined.write(level)
-    			levels_clean = []
-    			for x in levels:
-    				if "ncertae_sedis" in x:
-    					levels_clean.append("")
-    				else:
-    					levels_clean.append(x)
-    			consensus.write('\t'.join(levels_clean+[""]*(len(ranks)-len(levels_clean))))
-    			if isolates == "True":
-    				consensus.write(F"\t{iso_dict[otu][0]}\t{iso_dict[otu][1]}\t{iso_dict[otu][2]}")
-    			if hl != "null":
-    				consensus.write(F"\t{hl_dict[otu][0]}\t{hl_dict[otu][1]}\t{hl_dict[otu][2]}")
-    			if consistent:
-    				tax_string = '\t'.join(levels_clean)
-    				consensus.write(F"\t{int(tax_string.replace(' ', '_').strip('_') in taxa_set)}\n")
-    			else:
-    				consensus.write("\n")
-    			combined.write("\n")
-    		print("\tDone\n")
-
-    		consensus.close()
-    		combined.close()
-
-
-    		print("\nGenerating classification counts & summary table\n")
-    		_count_classifications([rdp_file, uta_file, sin_file, consensus_file], output_dir, "UNITE", len(ranks))
-    	print("\tDone\n\n")
-    	print("____________________________________________________________________\n")
-    else:
-    	filename = db
-    	filename_base = tf + "/" + ".".join(os.path.basename(filename).split(".")[:-1])
-
-    	header_line = open(filename_base + "__RDP_taxonomy.txt", "r").readline() # Extract first line of taxonomy file to get ranks
-    	ranks = header_line.strip().split("\t")[1:]
-    	if consistent:
-    		taxa_set = _real_hier(filename_base + "__RDP_taxonomy.txt")
-    	for classifier in three_classifiers:
-    		file_name = F"{tax}otu_taxonomy."+classifier
-    		try:
-    			open(file_name,"r")
-    		except FileNotFoundError:
-    			raise FileNotFoundError(F"{classifier.upper()} file could not be opened.")
-    		input_file = open(file_name,"r")
-    		line = input_file.readline()
-    		temp0 = line.split("\t")
-    		if classifier == "rdp":
-    			if len(temp0)==0:
-    				raise ValueError("RDP file is empty. Did you allot enough memory with --mem?")
-    			elif len(temp0)<10 or temp0[3]!="rootrank":
-    				raise ValueError("Input file not in RDP format. Please Reformat As Below:\nOTU_###	Root	rootrank	1.0	Bacteria_1	Rank_1	1.0	Firmicutes_1	Rank_2	1.0	Bacilli_1	Rank_3	1.0	Bacillales_1	Rank_4	0.8	Bacillaceae_1	Rank_5	0.8	Bacillus_1	Rank_6	0.8	Bacillus_pumilus_1	Rank_7	0.8")
-    		elif classifier == "utax":
-    			while not temp0[1].startswith("R1:") and line != "":
-    				line = input_file.readline()
-    				temp0 = line.split("\t")
-    			if line == "":
-    				raise ValueError("Input file not in UTAX format. Please Reformat As Below:\nOTU_###	d:Bacteria_1(1.0000),k:Firmicutes_1(1.0000),p:Bacilli_1(0.9600),c:Bacillales_1(0.7200),o:Bacillaceae_1(0.7200),f:Bacillus_1(0.7200),g:Bacillus_pumilus_1(0.7200)	+	d:Bacteria_1,k:Firmicutes_1,p:Bacilli_1")
-    		elif classifier == "blast":
-    			if "query,subject,bitscore,e_value,percent_identity,query_coverage" not in temp0[0]:
-    				raise ValueError("Input file not in BLAST format. Please Reformat As Below:\nquery,subject,bitscore,e_value,percent_identity,query_coverage,Rank_1,Rank_2,Rank_3,Rank_4,Rank_5,Rank_6,Rank_7")
-    		else:
-    			if temp0[1].startswith("R1:"):
-    				raise ValueError("Input file not in SINTAX format. Please Reformat As Below:\nOTU_###	d:Bacteria_1(1.0000),k:Firmicutes_1(1.0000),p:Bacilli_1(0.9600),c:Bacillales_1(0.7200),o:Bacillaceae_1(0.7200),f:Bacillus_1(0.7200),g:Bacillus_pumilus_1(0.7200)	+	d:Bacteria_1,k:Firmicutes_1,p:Bacilli_1")
-    		input_file.close()
-
-    		if classifier == "rdp":
-    			print("\n____________________________________________________________________\nReformatting "+classifier.upper()+" file\n")
-    			rdp_file = _reformat_RDP(file_name, output_dir, conf, ranks)
-    			rdp_dict = _build_dict(rdp_file, ranks)
-    		elif classifier == "utax":
-    			print("\nReformatting "+classifier.upper()+" file\n")
-    			uta_file = _reformat_UTAX(file_name, output_dir, conf, ranks)
-    			uta_dict = _build_dict(uta_file, ranks)
-    		elif classifier == "blast":
-    			print("\nReformatting "+classifier.upper()+" file\n")
-    			blast_file = _reformat_BLAST(file_name, output_dir, conf, max_hits=mhits, ethresh=evalue, p_iden_thresh=p_iden, ranks=ranks)
-    			blast_dict = _build_dict(blast_file, ranks)
-    		else:
-    			print("\nReformatting "+classifier.upper()+" file\n")
-    			sin_file = _reformat_SINTAX(file_name, output_dir, conf, ranks)
-    			sin_dict = _build_dict(sin_file, ranks)
-    		print("\tDone\n")
-    	if isolates == "True":
-    		print("\nReformatting isolate result file\n")
-    		iso_dict = _build_iso_hl_dict(F"{tax}/isolates_blast.out", iso_qc=iso_qc, iso_id=iso_id)
-    		print("\tDone\n")
-    	if hl != "null":
-    		print("\nReformatting high level tax result file\n")
-    		print(F"User set query coverage minimum: {hl_qc} User set percent identity minimum: {hl_id}")
-    		hl_dict = _build_iso_hl_dict(F"{tax}/hl_blast.out", hl=True, hl_fmt=hl, hl_qc=hl_qc, hl_id=hl_id)
-    		print("\tDone\n")
-    	print("\nGenerating consensus taxonomy & combined taxonomy table\n")
-    	consensus_file = F"{output_dir}/constax_taxonomy.txt"
-    	consensus = open(consensus_file, "w")
-
-    	combined = open(F"{output_dir}/combined_taxonomy.txt", "w")
-    	combined.write("Feature ID")
-    	consensus.write("Feature ID")
-
-    	if blast:
-    		for r in ranks:
-    			combined.write(F"\t{r}_RDP\t{r}_BLAST\t{r}_SINTAX\t{r}_Consensus")
-    			consensus.write(F"\t{r}")
-    		if isolates == "True":
-    			consensus.write("\tIsolate\tIsolate_percent_id\tIsolate_query_cover")
-    		if hl != "null":
-    			consensus.write("\tHigh_level_taxonomy\tHL_hit_percent_id\tHL_hit_query_cover")
-    		if consistent:
-    			consensus.write("\tConsistent_hierarchy")
-    		consensus.write("\n")
-    		combined.write("\n")
-
-    		for otu in rdp_dict.keys():
-    			consensus.write(otu+"\t")
-    			combined.write(otu)
-    			levels = []
-    			for m in range(0,len(ranks)*2,2):
-    				level = _vote(rdp_dict[otu][m:m+2], blast_dict[otu][m:m+2], sin_dict[otu][m:m+2], conservative)
-    				combined.write("\t"+rdp_dict[otu][m]+"\t"+blast_dict[otu][m]+"\t"+sin_dict[otu][m]+"\t")
-    				if level != "":
-    					levels.append(level)
-    				combined.write(level)
-    			levels_clean = []
-    			for x in levels:
-    				if "ncertae_sedis" in x:
-    					levels_clean.append("")
-    				else:
-    					levels_clean.append(x)
-    			consensus.write('\t'.join(levels_clean+[""]*(len(ranks)-len(levels_clean))))
-    			if isolates == "True":
-    				consensus.write(F"\t{iso_dict[otu][0]}\t{iso_dict[otu][1]}\t{iso_dict[otu][2]}")
-    			if hl != "null":
-    				consensus.write(F"\t{hl_dict[otu][0]}\t{hl_dict[otu][1]}\t{hl_dict[otu][2]}")
-    			if consistent:
-    				tax_string = '\t'.join(levels_clean)
-    				consensus.write(F"\t{int(tax_string in taxa_set)}\n")
-    			else:
-    				consensus.write("\n")
-    			combined.write("\n")
-    		print("\tDone\n")
-
-    		consensus.close()
-    		combined.close()
-
-
-    		print("\nGenerating classification counts & summary table\n")
-    		_count_classifications([rdp_file, sin_file, blast_file, consensus_file], output_dir, "SILVA", len(ranks), use_blast=True)
-    	else:
-    		combined = open(F"{output_dir}/combined_taxonomy.txt", "w")
-    		filename = db
-    		filename_base = tf + "/" + ".".join(os.path.basename(filename).split(".")[:-1])
-
-    		header_line = open(filename_base + "__RDP_taxonomy.txt", "r").readline()
-    		ranks = header_line.strip().split("\t")[1:]
-    		combined.write("Feature ID")
-    		consensus.write("Feature ID")
-
-    		for r in ranks:
-    			combined.write(F"\t{r}_RDP\t{r}_SINTAX\t{r}_UTAX\t{r}_Consensus")
-    			consensus.write(F"\t{r}")
-    		if isolates == "True":
-    			consensus.write("\tIsolate\tIsolate_percent_id\tIsolate_query_cover")
-    		if hl != "null":
-    			consensus.write("\tHigh_level_taxonomy\tHL_hit_percent_id\tHL_hit_query_cover")
-    		if consistent:
-    			consensus.write("\tConsistent_hierarchy")
-    		combined.write("\n")
-    		consensus.write("\n")
-
-    		for otu in rdp_dict.keys():
-    			consensus.write(otu+"\t")
-    			combined.write(otu)
-    			levels = []
-    			for m in range(0,len(ranks)*2,2):
-    				level = _vote(rdp_dict[otu][m:m+2], sin_dict[otu][m:m+2], uta_dict[otu][m:m+2], conservative)
-    				combined.write("\t"+rdp_dict[otu][m]+"\t"+sin_dict[otu][m]+"\t"+uta_dict[otu][m]+"\t")
-    				if level != "":
-    					levels.append(level)
-    				combined.write(level)
-    			levels_clean = []
-    			for x in levels:
-    				if "ncertae_sedis" in x:
-    					levels_clean.append("")
-    				else:
-    					levels_clean.append(x)
-    			consensus.write('\t'.join(levels_clean+[""]*(len(ranks)-len(levels_clean))))
-    			if isolates == "True":
-    				consensus.write(F"\t{iso_dict[otu][0]}\t{iso_dict[otu][1]}\t{iso_dict[otu][2]}")
-    			if hl != "null":
-    				consensus.write(F"\t{hl_dict[otu][0]}\t{hl_dict[otu][1]}\t{hl_dict[otu][2]}")
-    			if consistent:
-    				tax_string = '\t'.join(levels_clean)
-    				consensus.write(F"\t{int(tax_string in taxa_set)}\n")
-    			else:
-    				consensus.write("\n")
-    			combined.write("\n")
-    		print("\tDone\n")
-
-    		consensus.close()
-    		combined.close()
-
-
-    		print("\nGenerating classification counts & summary table\n")
-    		_count_classifications([rdp_file, uta_file, sin_file, consensus_file], output_dir, "SILVA", len(ranks))
-    	print("\tDone\n\n")
-    	print("____________________________________________________________________\n")
-		constax_table = pd.read_table(consensus_file)
-		return _to_TSVTaxonomyFormat(constax_table)
+	# Classifiers in voting and combined-table column order, and in summary column order
+	classifiers = ["rdp", "blast", "sintax"] if blast else ["rdp", "sintax", "utax"]
+	count_order = ["rdp", "sintax", "blast"] if blast else ["rdp", "utax", "sintax"]
+	filename = db
+	filename_base = tf + "/" + ".".join(os.path.basename(filename).split(".")[:-1])
+
+	with open(filename_base + "__RDP_taxonomy.txt", "r") as ifile: # Extract first line of taxonomy file to get ranks
+		ranks = ifile.readline().strip().split("\t")[1:]
+	vocab = _TaxonVocabulary()
+	if consistent:
+		taxa_set = _real_hier(filename_base + "__RDP_taxonomy.txt")
+	tables = {}
+	for classifier in ["rdp", "sintax", "blast" if blast else "utax"]:
+		file_name = F"{tax}/otu_taxonomy.{classifier}"
+		_check_classifier_file(file_name, classifier, format)
+		if classifier == "rdp":
+			print("\n____________________________________________________________________\nReformatting RDP file\n")
+			tables["rdp"] = _reformat_RDP(file_name, output_dir, conf, ranks, vocab=vocab)[1]
+		elif classifier == "utax":
+			print("\nReformatting UTAX file\n")
+			tables["utax"] = _reformat_UTAX(file_name, output_dir, conf, ranks, vocab=vocab)[1]
+		elif classifier == "blast":
+			print("\nReformatting BLAST file\n")
+			tables["blast"] = _reformat_BLAST(file_name, output_dir, conf, max_hits=mhits, ethresh=evalue, p_iden_thresh=p_iden, ranks=ranks, format=format, vocab=vocab)[1]
+		else:
+			print("\nReformatting SINTAX file\n")
+			tables["sintax"] = _reformat_SINTAX(file_name, output_dir, conf, ranks, vocab=vocab)[1]
+		print("\tDone\n")
+	if isolates == "True":
+		print("\nReformatting isolate result file\n")
+		iso_dict = _build_iso_hl_dict(F"{tax}/isolates_blast.out", iso_qc=iso_qc, iso_id=iso_id)
+		print("\tDone\n")
+	if hl != "null":
+		print("\nReformatting high level tax result file\n")
+		print(F"User set query coverage minimum: {hl_qc} User set percent identity minimum: {hl_id}")
+		hl_dict = _build_iso_hl_dict(F"{tax}/hl_blast.out", hl=True, hl_fmt=hl, hl_qc=hl_qc, hl_id=hl_id)
+		print("\tDone\n")
+
+	print("\nGenerating consensus taxonomy & combined taxonomy table\n")
+	otus = tables["rdp"].keys()
+	vote_tables = [tables[c] for c in classifiers]
+	winners = _vote_batch(vote_tables, otus, conservative)
+	names = vocab.names
+	taxa = [t.taxa[[t.index[otu] for otu in otus]] for t in vote_tables]
+
+	consensus_header = "Feature ID" + "".join([F"\t{r}" for r in ranks])
+	if isolates == "True":
+		consensus_header += "\tIsolate\tIsolate_percent_id\tIsolate_query_cover"
+	if hl != "null":
+		consensus_header += "\tHigh_level_taxonomy\tHL_hit_percent_id\tHL_hit_query_cover"
+	if consistent:
+		consensus_header += "\tConsistent_hierarchy"
+	labels = [_CLASSIFIER_NAMES[c] for c in classifiers]
+	combined_header = "Feature ID" + "".join([F"\t{r}_{labels[0]}\t{r}_{labels[1]}\t{r}_{labels[2]}\t{r}_Consensus" for r in ranks])
+
+	def consensus_rows():
+		for i, otu in enumerate(otus):
+			levels_clean = ["" if "ncertae_sedis" in names[x] else names[x] for x in winners[i] if x != 0]
+			row = [otu] + levels_clean + [""]*(len(ranks)-len(levels_clean))
+			if isolates == "True":
+				row.extend([str(x) for x in iso_dict[otu][:3]])
+			if hl != "null":
+				row.extend([str(x) for x in hl_dict[otu][:3]])
+			if consistent:
+				tax_string = '\t'.join(levels_clean)
+				if format == "UNITE":
+					tax_string = tax_string.replace(' ', '_').strip('_')
+				row.append(str(int(tax_string in taxa_set)))
+			yield "\t".join(row) + "\n"
+
+	def combined_rows():
+		for i, otu in enumerate(otus):
+			cells = [F"\t{names[a]}\t{names[b]}\t{names[c]}\t{names[w]}" for a, b, c, w in zip(taxa[0][i], taxa[1][i], taxa[2][i], winners[i])]
+			yield otu + "".join(cells) + "\n"
+
+	consensus_file = F"{output_dir}/constax_taxonomy.txt"
+	with open(consensus_file, "w") as consensus:
+		consensus.write(consensus_header + "\n")
+		_write_rows(consensus, consensus_rows())
+	with open(F"{output_dir}/combined_taxonomy.txt", "w") as combined:
+		combined.write(combined_header + "\n")
+		_write_rows(combined, combined_rows())
+	print("\tDone\n")
+
+	print("\nGenerating classification counts & summary table\n")
+	_count_classifications([tables[c] for c in count_order] + [consensus_file], output_dir, "UNITE" if format == "UNITE" else "SILVA", len(ranks), use_blast=blast)
+	print("\tDone\n\n")
+	print("____________________________________________________________________\n")
+	constax_table = pd.read_table(consensus_file)
+	return _to_TSVTaxonomyFormat(constax_table)
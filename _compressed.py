@@ -0,0 +1,115 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import io, gzip, shutil, subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# gzip and zstd files are told apart by their magic bytes, so a compressed file can keep
+# any name. Where pigz or zstd are installed they run as a separate process, decompressing
+# while the file is parsed; otherwise the gzip module or the zstandard package is used.
+
+_MAGIC = {b"\x1f\x8b" : "gzip", b"\x28\xb5\x2f\xfd" : "zstd"}
+_EXTENSIONS = (".gz", ".zst")
+
+def _compression(path):
+    try:
+        with open(path, "rb") as ifile:
+            head = ifile.read(4)
+    except FileNotFoundError:
+        return None
+    for magic, kind in _MAGIC.items():
+        if head.startswith(magic):
+            return kind
+    return None
+
+def _strip_compression(name):
+    for ext in _EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+class _PipeReader(io.RawIOBase):
+    # stdout of a decompressor. Closing before the end stops it; otherwise its exit status
+    # is checked, so a truncated or corrupt file is an error rather than a short read.
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.proc.stdout.readinto(b)
+        if n == 0:
+            self.eof = True
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.proc.stdout.close()
+        if not self.eof:
+            self.proc.terminate()
+        code = self.proc.wait()
+        if self.eof and code != 0:
+            raise subprocess.CalledProcessError(code, self.cmd)
+
+class _PipeWriter(io.RawIOBase):
+    # stdin of a compressor writing (or appending, as a new gzip member) to path, waited
+    # for on close
+    def __init__(self, cmd, path, mode="w"):
+        self.cmd = cmd
+        self.ofile = open(path, mode + "b")
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.ofile)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.proc.stdin.write(b)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.proc.stdin.close()
+        code = self.proc.wait()
+        self.ofile.close()
+        if code != 0:
+            raise subprocess.CalledProcessError(code, self.cmd)
+
+def _open_text(path, mode="r", compress=False, encoding=None, buffering=1 << 20):
+    # Text stream reading a plain, gzip or zstd file, or writing a plain or, with compress,
+    # gzip file (fast level, as the files written are intermediates read back soon after)
+    if mode == "r":
+        kind = _compression(path)
+        if kind is None:
+            return open(path, "r", encoding=encoding, buffering=buffering)
+        if kind == "gzip":
+            if shutil.which("pigz") is None:
+                return gzip.open(path, "rt", encoding=encoding)
+            raw = _PipeReader(["pigz", "-dc", path])
+        elif shutil.which("zstd") is not None:
+            raw = _PipeReader(["zstd", "-dcq", path])
+        elif zstandard is not None:
+            return zstandard.open(path, "rt", encoding=encoding)
+        else:
+            raise RuntimeError(F"{path} is zstd compressed; install zstd or the zstandard Python package to read it")
+        return io.TextIOWrapper(io.BufferedReader(raw, buffering), encoding=encoding)
+    if not compress:
+        return open(path, mode, encoding=encoding, buffering=buffering)
+    if shutil.which("pigz") is None:
+        return gzip.open(path, mode + "t", compresslevel=1, encoding=encoding)
+    return io.TextIOWrapper(io.BufferedWriter(_PipeWriter(["pigz", "-1", "-c"], path, mode), buffering), encoding=encoding)
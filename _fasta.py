@@ -0,0 +1,140 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, mmap
+import numpy as np
+from ._compressed import _compression, _open_text
+
+def _one_line(seq):
+    return "".join([line.strip() for line in seq.splitlines()])
+
+class _Fasta:
+    # FASTA file mapped into memory with an offset index of its records, built once when
+    # the file is opened. Record i spans bytes starts[i]:starts[i + 1] (the last one runs
+    # to the end of the file) and starts with its header line. Anything before the first
+    # ">" is read as a record of its own, as the readline loops this replaces did.
+    #   len(fasta), fasta.ids      record count and IDs (first word of each header)
+    #   fasta.raw(i)               memoryview of the record bytes, without copying them
+    #   fasta.header(i)            header line as text, newline kept
+    #   fasta.record(i)            (header line, sequence lines) as text, newlines kept
+    #   fasta.sequence(i)          sequence on one line, without newlines
+    #   fasta.get(ID)              record of an ID, or None
+    #   iter(fasta)                records in file order, as record()
+    #   fasta.chunks(n)            n (first, last + 1) record ranges of about equal bytes
+    #   fasta.text(first, last)    the records first:last as text, no parsing
+    def __init__(self, path, encoding="utf-8"):
+        self.path = path
+        self.encoding = encoding
+        self.size = os.path.getsize(path)
+        self._ids = None
+        self._by_id = None
+        if self.size == 0:
+            self._mm = b""
+            self._view = memoryview(b"")
+            self.starts = np.zeros(0, dtype=np.int64)
+            return
+        with open(path, "rb") as ifile:
+            self._mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mm)
+        starts = [0]
+        find = self._mm.find
+        pos = find(b"\n>")
+        while pos >= 0:
+            starts.append(pos + 1)
+            pos = find(b"\n>", pos + 1)
+        self.starts = np.array(starts, dtype=np.int64)
+
+    def close(self):
+        self._view.release()
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _end(self, i):
+        return int(self.starts[i + 1]) if i + 1 < len(self.starts) else self.size
+
+    def raw(self, i):
+        return self._view[int(self.starts[i]):self._end(i)]
+
+    def record(self, i):
+        text = str(self.raw(i), self.encoding)
+        if "\r" in text: # as read in text mode
+            text = text.replace("\r\n", "\n")
+        split = text.find("\n") + 1
+        if split == 0:
+            return text, ""
+        return text[:split], text[split:]
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield self.record(i)
+
+    def sequence(self, i):
+        return _one_line(self.record(i)[1])
+
+    def header(self, i):
+        start, end = int(self.starts[i]), self._end(i)
+        newline = self._mm.find(b"\n", start, end)
+        header = str(self._view[start:end if newline < 0 else newline + 1], self.encoding)
+        return header.replace("\r\n", "\n")
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = []
+            for i in range(len(self.starts)):
+                header = self.header(i)[1:].split()
+                self._ids.append(header[0] if header else "")
+        return self._ids
+
+    def get(self, ID):
+        if self._by_id is None:
+            self._by_id = {}
+            for i, rec_id in enumerate(self.ids):
+                self._by_id.setdefault(rec_id, i)
+        i = self._by_id.get(ID)
+        return None if i is None else self.record(i)
+
+    def chunks(self, n):
+        if len(self.starts) == 0:
+            return []
+        n = max(1, min(n, len(self.starts)))
+        bounds = np.searchsorted(self.starts, np.arange(1, n) * (self.size / n))
+        bounds = np.unique(np.concatenate([[0], bounds, [len(self.starts)]]))
+        return [(int(first), int(last)) for first, last in zip(bounds[:-1], bounds[1:])]
+
+    def text(self, first, last):
+        end = int(self.starts[last]) if last < len(self.starts) else self.size
+        return str(self._view[int(self.starts[first]):end], self.encoding)
+
+def _records(path, encoding="utf-8"):
+    # (header line, sequence lines) of every record, as iter(_Fasta), for plain files and
+    # for gzip or zstd files, which are read as the decompressor streams them
+    if _compression(path) is None:
+        with _Fasta(path, encoding) as fasta:
+            yield from fasta
+        return
+    with _open_text(path, encoding=encoding) as ifile:
+        header = ifile.readline()
+        seq = []
+        for line in ifile:
+            if line[0] == ">":
+                yield header, "".join(seq)
+                header, seq = line, []
+            else:
+                seq.append(line)
+        if header != "":
+            yield header, "".join(seq)
@@ -8,12 +8,13 @@
 # The full license in the file LICENSE, distributed with this software.
 # -------------------------------------------------------------------------
 
-import sys, os, unicodedata, argparse, glob, time
-import numpy as np
-from ._lineage import _lin_to_tax, _add_full_lineage, _convert_lines
+import sys, os, unicodedata, argparse, glob, time, functools, random, warnings
+from ._lineage import _lin_to_tax, _add_full_lineage
+from ._fasta import _Fasta, _records, _one_line
+from ._compressed import _compression, _open_text, _strip_compression
 
 def _detect_format(db):
-    with open(db, "r") as ifile:
+    with _open_text(db) as ifile:
     	line = ifile.readline()
     	line_bar_split = line.split("|")
     	if line[0]!=">": # or len(temp0)!= 5:
@@ -38,12 +39,46 @@ def _convert_utax_line(utax_taxa):
 		new_taxa.append(F"{r_lets[min(len(utax_taxa), len(r_lets)) - 1]}:{utax_taxa[-1]}")
 	return ",".join(new_taxa)
 
-def _format_ref_db(db, tf, format, dup=False):
+_SILVA_TRANSLATION = str.maketrans("*,<>", "_   ")
+
+def _ascii_text(text):
+	line = text.replace(" Bacteria;", "?Bacteria;").replace(" Eukaryota;", "?Eukaryota;").replace(" Archaea;", "?Archaea;").replace(" ", "_")
+	#correct umlauts or special letters
+	return unicodedata.normalize('NFKD', line).encode('ASCII', 'ignore').decode().translate(_SILVA_TRANSLATION)
+
+def _ascii_silva_header(line, lineages):
+	# Lineages repeat across most of a SILVA release, so everything from the first space
+	# on is normalised once per distinct lineage, kept in lineages for the formatting run,
+	# and only the accession every time
+	split = line.find(" ")
+	if split < 0:
+		ascii_line = _ascii_text(line)
+	else:
+		lineage = line[split:]
+		ascii_lineage = lineages.get(lineage)
+		if ascii_lineage is None:
+			ascii_lineage = lineages[lineage] = _ascii_text(lineage)
+		ascii_line = _ascii_text(line[:split]) + ascii_lineage
+	return ascii_line.replace("Oral_Taxon", "oral_taxon").replace("'","")
+
+def _silva_ranks(lineage):
+	t_list = lineage.strip().split(";")
+	if "unidentified" in t_list:
+		non_unid = [i for i,x in enumerate(t_list) if x != "unidentified"]
+		t_list = ["-" if x == "unidentified" else x for x in t_list]
+		if t_list[-1] == "-": # if lowest rank in unidentified, add the lowest identified rank to the lowest taxa
+			t_list[-1] = t_list[non_unid[-1]] + "_unidentified"
+	return tuple(t_list)
+
+def _ref_base(db, tf):
+    return tf + "/" + ".".join(_strip_compression(os.path.basename(db)).split(".")[:-1])
+
+def _format_ref_db(db, tf, format, dup=False, lineage=True, compress=False):
     filename = db
-    filename_base = tf + "/" + ".".join(os.path.basename(filename).split(".")[:-1])
+    filename_base = _ref_base(filename, tf)
     print("\n____________________________________________________________________\nReformatting database\n")
     start = time.process_time()
-    fasta = open(filename_base+"__RDP.fasta","w")
+    fasta = _open_text(filename_base+"__RDP.fasta", "w", compress=compress)
     taxon_fn = filename_base+"__RDP_taxonomy.txt"
     taxon = open(taxon_fn,"w")
     print(F"{format} format detected\n")
@@ -51,175 +86,224 @@ def _format_ref_db(db, tf, format, dup=False):
     	taxon.write("Seq_ID\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\tSpecies\n")
 
     	num = 0
-    	with open(filename) as database:
-    		for line in database:
-    			if line[0] == ">":
-    				#correct umlauts or special letters
-    				ascii_line = unicodedata.normalize('NFKD', line).encode('ASCII', 'ignore')
-    				temp = ascii_line.decode()[1:].split("|")
-
-    				#RDP files
-    				name = str(temp[1])
-    				temp2 = temp[4].strip().split("__")
-    				to_genus = [ item[:-2] for item in temp2[1:-1] ]
-
-    				if "Incertae_sedis" in to_genus:
-    					indices = [i for i,x in enumerate(to_genus) if x == "Incertae_sedis"]
-    					for j in indices:
-    						if "Incertae_sedis" not in to_genus[j-1]:
-    							to_genus[j] = str(to_genus[j-1])+"_Incertae_sedis"
-    						else:
-    							to_genus[j] = str(to_genus[j-1])
-    				if "unidentified" in to_genus:
-    					indices = [i for i,x in enumerate(to_genus) if x == "unidentified"]
-    					for j in indices:
-    						to_genus[j] = "-"
-
-    				if to_genus[0] != "-":
-    					species = str(temp2[-1])
-    					if "Incertae" in species:
-    						species = "unidentified_sp"
-    					elif to_genus[-1] not in species:
-    						temp=species.split("_")
-    						species = temp[0]+"_unidentified_"+temp[1]
-    					if species.endswith("sp"):
-    						species+= "_"+str(num)
-    						num += 1
-
-    					taxonomy = name+"\t"+"\t".join(to_genus)+"\t"+species+"\n"
-    					fasta.write(">"+name+"\n")
-    					taxon.write(taxonomy)
-    					seq = next(database)
-    					fasta.write(seq)
+    	for line, seq in _records(filename):
+    		if line[0] == ">":
+    			#correct umlauts or special letters
+    			ascii_line = unicodedata.normalize('NFKD', line).encode('ASCII', 'ignore')
+    			temp = ascii_line.decode()[1:].split("|")
+
+    			#RDP files
+    			name = str(temp[1])
+    			temp2 = temp[4].strip().split("__")
+    			to_genus = [ item[:-2] for item in temp2[1:-1] ]
+
+    			if "Incertae_sedis" in to_genus:
+    				indices = [i for i,x in enumerate(to_genus) if x == "Incertae_sedis"]
+    				for j in indices:
+    					if "Incertae_sedis" not in to_genus[j-1]:
+    						to_genus[j] = str(to_genus[j-1])+"_Incertae_sedis"
+    					else:
+    						to_genus[j] = str(to_genus[j-1])
+    			if "unidentified" in to_genus:
+    				indices = [i for i,x in enumerate(to_genus) if x == "unidentified"]
+    				for j in indices:
+    					to_genus[j] = "-"
+
+    			if to_genus[0] != "-":
+    				species = str(temp2[-1])
+    				if "Incertae" in species:
+    					species = "unidentified_sp"
+    				elif to_genus[-1] not in species:
+    					temp=species.split("_")
+    					species = temp[0]+"_unidentified_"+temp[1]
+    				if species.endswith("sp"):
+    					species+= "_"+str(num)
+    					num += 1
+
+    				taxonomy = name+"\t"+"\t".join(to_genus)+"\t"+species+"\n"
+    				fasta.write(">"+name+"\n")
+    				taxon.write(taxonomy)
+    				fasta.writelines(seq.splitlines(True)[:1])
     	fasta.close()
     	taxon.close()
 
     else:
+    	# One pass over the database: sequences stream straight to the FASTA while the
+    	# taxonomy rows are held until the deepest lineage is known for rank padding
     	max_rank = 1
-    	with open(filename, "r") as database:
-    		line = database.readline()
-    		while line != "":
-    			t_list = line.strip().split(";")
-    			if len(t_list) > max_rank:
-    				max_rank = len(t_list)
-    			line = database.readline()
+    	rows = []
+    	lineages = {}
+    	ranks = {}
+    	for line, seq in _records(filename):
+    		max_rank = max(max_rank, line.strip().count(";") + 1)
+    		temp = _ascii_silva_header(line, lineages)[1:].split("?")
+
+    		name = str(temp[0]).split(".")[0]
+    		t_list = ranks.get(temp[1])
+    		if t_list is None:
+    			t_list = ranks[temp[1]] = _silva_ranks(temp[1])
+    		rows.append((name, t_list))
+    		fasta.write(">"+name+"\n")
+    		fasta.write(_one_line(seq).replace("U", "T") + "\n")
     	taxon.write("Seq_ID\t" + "\t".join([F"Rank_{x}" for x in range(1, max_rank+1)]) + "\n")
-    	with open(filename, "r") as database:
-    		line = database.readline()
-    		while line != "":
-    			line = line.replace(" Bacteria;", "?Bacteria;").replace(" Eukaryota;", "?Eukaryota;").replace(" Archaea;", "?Archaea;").replace(" ", "_")
-    			ascii_line = unicodedata.normalize('NFKD', line).encode('ASCII', 'ignore')
-    			# temp = ascii_line.decode().replace("*", "_").replace("'", "").replace(",", "").replace("Oral_Taxon", "oral_taxon")[1:].split("?")
-    			temp = ascii_line.decode().translate(str.maketrans("*,<>", "_   ")).replace("Oral_Taxon", "oral_taxon").replace("'","")[1:].split("?")
+    	for name, t_list in rows:
+    		if len(t_list) < max_rank:
+    			t_list = t_list[:-1] + ("-",)*(max_rank - len(t_list)) + t_list[-1:] # fill in missing ranks
+    		taxon.write(name+"\t"+"\t".join(t_list)+"\n")
 
-    			name = str(temp[0]).split(".")[0]
-    			t_list = temp[1].strip().split(";")
+    	fasta.close()
+    	taxon.close()
 
-    			if "unidentified" in t_list:
-    				indices = [i for i,x in enumerate(t_list) if x == "unidentified"]
-    				non_unid = [i for i,x in enumerate(t_list) if x != "unidentified"]
-    				for j in indices:
-    					t_list[j] = "-"
-    				if t_list[-1] == "-": # if lowest rank in unidentified, add the lowest identified rank to the lowest taxa
-    				    t_list[-1] = t_list[non_unid[-1]] + "_unidentified"
+    print(F"Reference database FASTAs formatted in {time.process_time() - start} seconds...\n")
 
-    			if len(t_list) < max_rank:
-    				t_list = t_list[:-1] + ["-"]*(max_rank - len(t_list)) + [t_list[-1]] # fill in missing ranks
+    if lineage:
+    	_lin_to_tax(filename_base, format, dup)
+    	_add_full_lineage(filename_base, format, compress)
 
+    print("Database formatting complete\n____________________________________________________________________\n\n")
 
-    			taxonomy = name+"\t"+"\t".join(t_list)+"\n"
-    			fasta.write(">"+name+"\n")
-    			taxon.write(taxonomy)
-    			line = database.readline()
-    			seq = ""
-    			while line != "" and line[0] != ">":
-    				seq += line.strip()
-    				line = database.readline()
-    			seq = seq.replace("U", "T")
-    			fasta.write(seq + "\n")
+def _diff_ref_db(old_base, new_base):
+    # IDs of the records only in the newly formatted reference, or None if the update
+    # cannot be applied on top of the old one (ranks differ, records removed or changed)
+    with open(old_base+"__RDP_taxonomy.txt", "r") as old_taxon:
+    	old_header = old_taxon.readline()
+    	old_lines = old_taxon.readlines()
+    old_rows = {line.split("\t", 1)[0] : line for line in old_lines}
+    if len(old_rows) != len(old_lines): # repeated IDs cannot be told apart
+    	return None
+    new_ids = set()
+    with open(new_base+"__RDP_taxonomy.txt", "r") as new_taxon:
+    	if new_taxon.readline() != old_header:
+    		return None
+    	for line in new_taxon:
+    		ID = line.split("\t", 1)[0]
+    		old_line = old_rows.pop(ID, None)
+    		if old_line is None:
+    			if ID in new_ids:
+    				return None
+    			new_ids.add(ID)
+    		elif old_line != line:
+    			return None
+    if len(old_rows) > 0:
+    	return None
+    return new_ids
 
-    	fasta.close()
-    	taxon.close()
+def _subset_ref_db(base, ids):
+    # Keep only the given records in a formatted reference, in place
+    with open(base+"__RDP_taxonomy.txt", "r") as taxon, open(base+"__RDP_taxonomy.tmp", "w") as subset:
+    	subset.write(taxon.readline())
+    	subset.writelines([line for line in taxon if line.split("\t", 1)[0] in ids])
+    os.replace(base+"__RDP_taxonomy.tmp", base+"__RDP_taxonomy.txt")
+    with _open_text(base+"__RDP.tmp", "w", compress=_compression(base+"__RDP.fasta") is not None) as subset:
+    	for header, seq in _records(base+"__RDP.fasta"):
+    		if header[1:].strip() in ids:
+    			subset.write(header + seq)
+    os.replace(base+"__RDP.tmp", base+"__RDP.fasta")
 
-    print(F"Reference database FASTAs formatted in {time.process_time() - start} seconds...\n")
+_NUCLEOTIDES = str.maketrans("", "", "ATCGURYSWKMBDHVN\n") #IUPAC nucleotides, deleted to leave any invalid characters
+_NUCLEOTIDE_BYTES = b"ATCGURYSWKMBDHVN\n"
 
-    os.remove(F"{filename_base}__RDP_taxonomy_trained.txt")
-    os.remove(F"{filename_base}__RDP_taxonomy_headers.txt")
+def _invalid_records(names, seqs):
+    # (name, invalid characters) of every sequence with characters outside IUPAC. The whole
+    # batch is checked at once as uppercased bytes, and only a batch with something left
+    # after deleting the IUPAC bytes is checked record by record.
+    if len("".join(seqs).encode('utf-8').upper().translate(None, _NUCLEOTIDE_BYTES)) == 0:
+        return []
+    invalid = []
+    for name, seq in zip(names, seqs):
+        chars = seq.upper().translate(_NUCLEOTIDES)
+        if len(chars) > 0:
+            invalid.append((name, set(chars)))
+    return invalid
 
-    _lin_to_tax(filename_base, format, dup)
-    _add_full_lineage(filename_base, format)
+def _invalid_report(invalid, input_file, shown=20):
+    report = [F"Invalid character(s) are present in {len(invalid)} sequence(s) in input file {input_file}:"]
+    report.extend([F"{name.strip().strip('>')}: {' '.join(sorted(chars))}" for name, chars in invalid[:shown]])
+    if len(invalid) > shown:
+        report.append(F"... and {len(invalid) - shown} more")
+    return "\n".join(report)
 
-    print("Database formatting complete\n____________________________________________________________________\n\n")
+def _check_length(out_seq, otu_name):
+    if len(out_seq) < 16:
+        otu_name = otu_name.strip().strip(">")
+        warnings.warn(F"Sequence length of {otu_name} is less than 15 nucleotides and may cause this SINTAX error: 'assert failed: m_U.Size == SeqCount'", RuntimeWarning)
 
 def _check_seq(seq, input_file, otu_name):
-    lets = set("ATCGURYSWKMBDHVN\n") #IUPAC nucleotides
     out_seq = seq.upper()
-    seq_set = set(out_seq)
-    if len(seq_set-lets) > 0:
-        raise ValueError(F"Invalid character(s) {seq_set-lets} are present in sequences in input file {input_file}")
-    elif len(out_seq) < 16:
-        otu_name = otu_name.strip().strip(">")
-        warnings.warn(F"Sequence length of {otu_name} is less than 15 nucleotides and may cause this SINTAX error: 'assert failed: m_U.Size == SeqCount'", RuntimeWarning)
+    invalid = _invalid_records([otu_name], [out_seq])
+    if len(invalid) > 0:
+        raise ValueError(_invalid_report(invalid, input_file))
+    _check_length(out_seq, otu_name)
+    return out_seq
+
+@functools.lru_cache(maxsize=4096)
+def _ascii_header(header):
+    return unicodedata.normalize('NFKD', header).encode('ASCII', 'ignore').decode().replace(' ', '_')
+
+def _convert_lines(line_arr, filter=False, input_name="", validate=True):
+    header, seq = line_arr
+    if filter and "k__unidentified" in header:
+        return ""
+    # Plain ASCII headers only need their spaces replaced
+    header = header.replace(' ', '_') if header.isascii() else _ascii_header(header)
+    if validate:
+        seq = _check_seq(seq, input_name, line_arr[0])
     else:
-        return out_seq
-
-def _check_input_names(input, name="", filter=False):
-    convert_lines_vec = np.vectorize(_convert_lines)
-    rec_dict={}
-    with open(input, "r", encoding='utf-8') as ifile:
-        line = ifile.readline()
-        while line != "":
-            header = line
-            line = ifile.readline()
-            seq = ""
-            while line != "" and line[0] != ">":
-                seq = F"{seq}{line}"
-                line = ifile.readline()
-            rec_dict[header] = seq
+        seq = seq.upper()
+        _check_length(seq, line_arr[0])
+    return F"{header}{seq}"
 
+def _write_records(ofile, records, filter, input_name):
+    # Validate a batch of records together, then write them. Returns the invalid ones.
+    invalid = _invalid_records([header for header, seq in records], [seq for header, seq in records])
+    if len(invalid) == 0:
+        ofile.writelines([_convert_lines(record, filter=filter, input_name=input_name, validate=False) for record in records])
+    return invalid
+
+def _check_input_names(input, name="", filter=False, batch_size=10000):
+    # Validate and normalise the records a batch at a time, writing each batch as it is
+    # read. Invalid sequences are all reported together once the whole input is read.
     if name == "":
         fname = F"formatted_inputs_{'%06x' % random.randrange(16**6)}.fasta"
         print(fname)
     else:
         fname = name
-    rec_array = np.array(list(rec_dict.items()))
-    rec_hash = {}
-    for i in range(rec_array.shape[0]):
-        rec_hash[i] = _convert_lines(rec_array[i], filter=filter, input_name=input)
-
-    buffer = "".join(rec_hash.values())
+    headers = set()
+    invalid = []
+    batch = []
     with open(fname, "w") as ofile:
-        ofile.write(buffer)
-
-def _split_inputs(input):
-    buffer = ""
-    total_rec_count = 0
-    file_rec_count = 0
-    file_count = 0
-    query_files = []
-    prefix = input.split(".fasta")[0]
-    print("Input FASTA: ", input)
+        for header, seq in _records(input):
+            if header in headers:
+                warnings.warn(F"Repeated record {header.strip()} in {input}, only the first is kept", RuntimeWarning)
+                continue
+            headers.add(header)
+            batch.append((header, seq))
+            if len(batch) == batch_size:
+                invalid.extend(_write_records(ofile, batch, filter, input))
+                batch = []
+        invalid.extend(_write_records(ofile, batch, filter, input))
+    if len(invalid) > 0:
+        os.remove(fname)
+        raise ValueError(_invalid_report(invalid, input))
+    return fname
+
+def _chunk_size(input, workers=1, sample_bytes=1 << 20, min_recs=100, max_bases=5000000):
+    # Estimate records and mean sequence length from the head of the file, then aim
+    # for a few chunks per worker so each blastn startup is amortised over many
+    # queries without leaving workers idle at the tail
+    total_bytes = os.path.getsize(input)
     with open(input, "r") as ifile:
-        line = ifile.readline()
-        while line != "":
-            header = line
-            line = ifile.readline()
-            seq = ""
-            while line != "" and line[0] != ">":
-                seq += line.strip()
-                line = ifile.readline()
-            buffer += F"{header}{seq}\n"
-            total_rec_count += 1
-            file_rec_count += 1
-            if file_rec_count > 99:
-                file_rec_count = 0
-                with open(F"{prefix}_{file_count:04d}.fasta", "w") as ofile:
-                    ofile.write(buffer)
-                    query_files.append(F"{prefix}_{file_count:04d}.fasta")
-                file_count += 1
-                buffer = ""
-        if buffer != "":
-            with open(F"{prefix}_{file_count:04d}.fasta", "w") as ofile:
-                ofile.write(buffer)
-                query_files.append(F"{prefix}_{file_count:04d}.fasta")
-    return query_files
+        sample = ifile.read(sample_bytes)
+    rec_count = max(1, sample.count(">"))
+    seq_len = max(1, (len(sample) - sum(len(l) for l in sample.splitlines() if l.startswith(">"))) // rec_count)
+    est_recs = max(1, total_bytes * rec_count // max(1, len(sample)))
+    size = -(-est_recs // (workers * 4))
+    return max(min_recs, min(size, max_bases // seq_len))
+
+def _iter_chunks(input, chunk_size):
+    # Yield FASTA text of about chunk_size records each, with sequences on one line. The
+    # chunks are cut to hold equal bytes, so long sequences do not pile up in one chunk.
+    with _Fasta(input) as fasta:
+        for first, last in fasta.chunks(-(-len(fasta) // max(1, chunk_size))):
+            records = [fasta.record(i) for i in range(first, last)]
+            yield "".join([F"{header}{_one_line(seq)}\n" for header, seq in records])
@@ -8,175 +8,138 @@
 # The full license in the file LICENSE, distributed with this software.
 # -------------------------------------------------------------------------
 
-import sys, os
+import sys, os, itertools, sqlite3
+from ._compressed import _open_text
 
-def _RDP_head_to_UTAX(lineage, format):
+def _split_lineage(lineage, format):
 	taxa = lineage.split(";")[1:]
-	out = ""
 	if format != "UNITE" and len(taxa) > 8: # Account for SILVA taxa which have too many ranks to be classified with SINTAX
 		taxa = taxa[:8]
-	for r in range(len(taxa)):
-		if format == "UNITE":
-			out = F"{out}{'dkpcofg'[r]}:{taxa[r]},"
-		else:
-			out = F"{out}{'dkpcofgs'[r]}:{taxa[r]},"
-
-	return out[:-1]
-    
-def _add_full_lineage(filebase, format):
-	print("\n\tAdding Full Lineage\n\n")
+	return taxa
 
-	with open(filebase+"__RDP_taxonomy_headers.txt", 'r') as f:
-		f1 = f.readlines()
-	hash = {} #lineage map
+def _RDP_head_to_UTAX(lineage, format):
+	taxa = _split_lineage(lineage, format)
+	if format == "UNITE":
+		r_lets = 'dkpcofg'
+	else:
+		r_lets = 'dkpcofgs'
+	return ",".join([F"{r_lets[r]}:{taxa[r]}" for r in range(len(taxa))])
 
-	output_RDP = open(filebase+"__RDP_trained.fasta", 'w')
-	output_UTAX = open(filebase+"__UTAX.fasta", 'w')
+def _split_header(line):
+	ID, lineage = line.strip().split("\t")
+	return ID.strip(">"), lineage
 
-	for line in f1:
-		ID, lineage = line.strip().split("\t")
-		ID = ID.strip(">")
-		hash[ID] = lineage
+def _lineage_index(header_file, index_file):
+	# On-disk ID -> lineage map, for when the headers and the FASTA are not in the same order
+	if os.path.exists(index_file):
+		os.remove(index_file)
+	index = sqlite3.connect(index_file)
+	index.execute("CREATE TABLE lineage (id TEXT PRIMARY KEY, lineage TEXT)")
+	with open(header_file, 'r') as f:
+		index.executemany("INSERT OR REPLACE INTO lineage VALUES (?, ?)", (_split_header(line) for line in f))
+	index.commit()
+	return index
 
-	with open(filebase+"__RDP.fasta", 'r') as f:
-		f2 = f.readlines()
-	for line in f2:
-		if line[0] == '>':
-			ID = line.strip().replace('>', '')
-			try:
-				lineage = hash[ID]
-			except KeyError:
-				print(ID, 'not in taxonomy file')
-				sys.exit()
-			output_RDP.write(F"{line.strip()}\t{lineage}\n")
-			output_UTAX.write(F"{line.strip()};tax={_RDP_head_to_UTAX(lineage, format)};\n")
-		else:
-			output_RDP.write(line.strip()+"\n")
-			output_UTAX.write(line.strip()+"\n")
-	output_RDP.close()
-	output_UTAX.close()
+def _add_full_lineage(filebase, format, compress=False):
+	print("\n\tAdding Full Lineage\n\n")
+	# The headers are written in the order of the formatted FASTA, so the two are joined
+	# line by line, only falling back to an index of the headers if an ID is out of step.
+	# UTAX taxa strings are built once per distinct lineage of this reference.
+	index_file = filebase+"__RDP_taxonomy_headers.sqlite"
+	index = None
+	utax = {}
+	try:
+		with open(filebase+"__RDP_taxonomy_headers.txt", 'r') as headers, \
+			_open_text(filebase+"__RDP.fasta") as fasta, \
+			open(filebase+"__RDP_trained.fasta", 'w', buffering=1 << 20) as output_RDP, \
+			_open_text(filebase+"__UTAX.fasta", 'w', compress=compress) as output_UTAX:
+			for line in fasta:
+				if line[0] == '>':
+					line = line.strip()
+					ID = line.replace('>', '')
+					if index is None:
+						header = headers.readline()
+						header_ID, lineage = _split_header(header) if header != "" else (None, None)
+						if header_ID != ID:
+							index = _lineage_index(filebase+"__RDP_taxonomy_headers.txt", index_file)
+					if index is not None:
+						hit = index.execute("SELECT lineage FROM lineage WHERE id = ?", (ID,)).fetchone()
+						lineage = None if hit is None else hit[0]
+					if lineage is None:
+						print(ID, 'not in taxonomy file')
+						sys.exit()
+					taxa = utax.get(lineage)
+					if taxa is None:
+						taxa = utax[lineage] = _RDP_head_to_UTAX(lineage, format)
+					output_RDP.write(F"{line}\t{lineage}\n")
+					output_UTAX.write(F"{line};tax={taxa};\n")
+				else:
+					output_RDP.write(line.strip()+"\n")
+					output_UTAX.write(line.strip()+"\n")
+	finally:
+		if index is not None:
+			index.close()
+		if os.path.exists(index_file):
+			os.remove(index_file)
 
-def _lin_to_tax(file_base, format, dup=False):
+def _lin_to_tax(file_base, format, dup=False, previous=None):
 	print("\n\tTraining Taxonomy")
 	if dup:
 		print("\n\tDuplicate taxa being handled with numerical suffices")
-	with open(file_base+"__RDP_taxonomy.txt", 'r') as f:
+	# Allow for taxa which have more than 1 parent lineage, always outside of UNITE
+	number_names = dup or format != "UNITE"
+	# previous is the taxonomy of an earlier run, replayed without output so that its taxa
+	# keep their ids and only the taxa new in file_base are written, extending that tree
+	with open(file_base+"__RDP_taxonomy.txt", 'r') as f, \
+		open(previous if previous is not None else os.devnull, 'r') as previous_file, \
+		open(file_base+"__RDP_taxonomy_headers.txt", "w", buffering=1 << 20) as taxon_headers, \
+		open(file_base+"__RDP_taxonomy_trained.txt", "w", buffering=1 << 20) as output_file:
 		line = f.readline()
-		cols = line.strip().split('\t')[1:] # Split the first line into columns
-		hash = {}#taxon name-id map
-		ranks = {}#column number-rank map
-		hash = {"Root":0}#initiate root rank taxon id map
-		for i in range(len(cols)): # Assign ranks based on column headers
-			ranks[i] = cols[i]
+		ranks = line.strip().split('\t')[1:] # Split the first line into columns, one rank each
 		root = ['0', 'Root', '-1', '0', 'rootrank']#root rank info
-		with open(file_base+"__RDP_taxonomy_trained.txt", 'w') as output_file:
+		if previous is None:
 			output_file.write("*".join(root)+"\n")
+		previous_file.readline()
+		# Lineage trie, each node is [taxon id, trained name, children by taxon name]. The top
+		# node is the empty lineage, which only gets an id if a record starts with "-"
+		top = [None, None, {}]
+		end_name_dict = {}
 		ID = 0 #taxon id
-		line = f.readline()
-		if format == "UNITE":
-			name_to_end = {}
-			if dup:
-				end_name_dict = {}
-			while line != "":
-				rec_count = 0
-				th_buf = "" # taxon header buffer
-				output_buf = "" # trained taxonomy buffer
-				while line != "" and rec_count < 10000: # Rec count to export when buffer is at 10000 records
-					rec_count += 1
-					acc = line.split('\t')[0]
-					cols = line.strip().split('\t')[1:]
-					header = F">{acc}\tRoot"
-					for i in range(len(cols)):#iterate each column
-						name = []
-						for node in cols[:i + 1]:
-							if not node == '-':
-								name.append(node)
-						pName = ";".join(name[:-1])
-						depth = len(name)
-						name = ";".join(name)
-						if name in hash: # Avoid repeated taxonomies
-							if name != prev_name:
-								prev_name = name
-								header += F";{name_to_end[name]}"
-							continue
-						prev_name = name
-						rank = ranks[i]
-						if i == 0:
-							pName = 'Root'
-						pID = hash[pName]#parent taxid
-						ID += 1
-						hash[name] = ID #add name-id to the map
-						end_name = name.split(';')[-1]
-						if dup:
-							if end_name not in end_name_dict:
-								end_name_dict[end_name] = 1
-								end_name = F"{end_name}_1"
-							else:
-								end_name_dict[end_name] += 1
-								end_name = F"{end_name}_{end_name_dict[end_name]}"
-						header = F"{header};{end_name}"
-						name_to_end[name] = end_name
-						output_buf = F"{output_buf}{ID}*{end_name}*{pID}*{depth}*{rank}\n"
-					th_buf = F"{th_buf}{header}\n"
-					line = f.readline()
-				with open(file_base+"__RDP_taxonomy_headers.txt", "a+") as taxon_headers:
-					taxon_headers.write(th_buf)
-				with open(file_base+"__RDP_taxonomy_trained.txt", "a+") as output_file:
-					output_file.write(output_buf)
-		else:
-			name_to_end = {}
-			end_name_dict = {}
-			while line != "":
-				rec_count = 0
-				th_buf = ""
-				output_buf = ""
-				while line != "" and rec_count < 10000:
-					rec_count += 1
-					acc = line.split('\t')[0]
-					cols = line.strip().split('\t')[1:]
-					header = F">{acc}\tRoot"
-					for i in range(len(cols)):#iterate each column
-						name = []
-						for node in cols[:i + 1]:
-							if not node == '-':
-								name.append(node)
-						pName = ";".join(name[:-1])
-						depth = len(name)
-						name = ";".join(name)
-						if name in hash:
-							if name != prev_name:
-								prev_name = name
-								header += F";{name_to_end[name]}"
-							continue
-						prev_name = name
-						rank = ranks[i]
-						if i == 0:
-							pName = 'Root'
-						pID = hash[pName]#parent taxid
-						ID += 1
-						hash[name] = ID #add name-id to the map
-						end_name = name.split(';')[-1]
-						# Allow for taxa which have more than 1 parent lineage
-						if end_name not in end_name_dict:
-							end_name_dict[end_name] = 1
-							end_name = F"{end_name}_1"
-						else:
-							end_name_dict[end_name] += 1
-							end_name = F"{end_name}_{end_name_dict[end_name]}"
-						header = F"{header};{end_name}"
-						name_to_end[name] = end_name
-						output_buf = F"{output_buf}{ID}*{end_name}*{pID}*{depth}*{rank}\n"
-					th_buf = F"{th_buf}{header}\n"
-					line = f.readline()
-				with open(file_base+"__RDP_taxonomy_headers.txt", "a+") as taxon_headers:
-					taxon_headers.write(th_buf)
-					print("Headers exported")
-				with open(file_base+"__RDP_taxonomy_trained.txt", "a+") as output_file:
-					output_file.write(output_buf)
-					print("Trained taxonomy exported")
-
-def _convert_lines(line_arr, filter=False, input_name=""):
-    if filter and "k__unidentified" in line_arr[0]:
-        return ""
-    else:
-        return F"{unicodedata.normalize('NFKD', line_arr[0]).encode('ASCII', 'ignore').decode().replace(' ', '_')}{check_seq(line_arr[1], input_name, line_arr[0])}"
+		records = itertools.chain(((line, False) for line in previous_file), ((line, True) for line in f))
+		for line, export in records:
+			acc = line.split('\t')[0]
+			cols = line.strip().split('\t')[1:]
+			header = [F">{acc}\tRoot"]
+			node = top
+			prev = None
+			depth = 0
+			for i in range(len(cols)):#iterate each column, walking down the trie
+				if cols[i] == '-':
+					if i > 0:
+						continue # same taxon as the previous column
+					child = top
+				else:
+					child = node[2].get(cols[i])
+					if child is None:
+						child = [None, None, {}]
+						node[2][cols[i]] = child
+					depth += 1
+				if child[0] is None: # new taxon
+					pID = 0 if i == 0 else node[0] #parent taxid
+					ID += 1
+					end_name = cols[i] if child is not top else ""
+					if number_names:
+						end_name_dict[end_name] = end_name_dict.get(end_name, 0) + 1
+						end_name = F"{end_name}_{end_name_dict[end_name]}"
+					child[0] = ID
+					child[1] = end_name
+					if export:
+						output_file.write(F"{ID}*{end_name}*{pID}*{depth}*{ranks[i]}\n")
+				if child is not prev:
+					header.append(child[1])
+				prev = node = child
+			if export:
+				taxon_headers.write(";".join(header) + "\n")
+	if format != "UNITE":
+		print("Headers exported")
+		print("Trained taxonomy exported")
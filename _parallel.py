@@ -0,0 +1,72 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import subprocess, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+def _run_capture(cmd, stdin=None):
+    return subprocess.run(cmd, input=stdin, capture_output=True, check=True).stdout.decode('utf-8')
+
+def _run_logged(cmd, log_file, check=True):
+    # Run cmd with its stdout written to log_file and its stderr appended after it.
+    # Returns the stderr text, for tools that report failures there.
+    with open(log_file, "wb") as log:
+        proc = subprocess.run(cmd, stdout=log, stderr=subprocess.PIPE)
+    with open(log_file, "ab") as log:
+        log.write(proc.stderr)
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=proc.stderr)
+    return proc.stderr.decode('utf-8')
+
+def _run_pool(jobs, workers=1):
+    # Run (cmd, stdin) jobs with at most `workers` in flight at once. Outputs are
+    # yielded in the order of `jobs`, regardless of which job finishes first, and
+    # jobs are only pulled from the iterable as slots free up.
+    if workers <= 1:
+        for cmd, stdin in jobs:
+            yield _run_capture(cmd, stdin)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for cmd, stdin in jobs:
+            pending.append(pool.submit(_run_capture, cmd, stdin))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _run_stages(stages, nthreads=1, mem=0):
+    # Start (name, func, threads, mem) stages concurrently, each as soon as the shared
+    # thread and memory budgets allow. A stage asking for more than the whole budget
+    # runs once nothing else is. Returns the wall-clock seconds taken by each stage.
+    free = {"threads" : nthreads, "mem" : mem}
+    cond = threading.Condition()
+    timings = {}
+    def run(name, func, threads, stage_mem):
+        with cond:
+            cond.wait_for(lambda: (free["threads"] >= threads and free["mem"] >= stage_mem)
+                or (free["threads"] == nthreads and free["mem"] == mem))
+            free["threads"] -= threads
+            free["mem"] -= stage_mem
+        start = time.time()
+        try:
+            func()
+        finally:
+            timings[name] = time.time() - start
+            with cond:
+                free["threads"] += threads
+                free["mem"] += stage_mem
+                cond.notify_all()
+    with ThreadPoolExecutor(max_workers=len(stages)) as pool:
+        futures = [pool.submit(run, *stage) for stage in stages]
+        for future in futures:
+            future.result()
+    for name in timings:
+        print(F"{name} finished in {timings[name]:.1f} seconds")
+    return timings
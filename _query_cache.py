@@ -0,0 +1,194 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, json, time, hashlib, sqlite3, warnings
+from ._fasta import _Fasta
+
+# Raw classifier output of every query, in the tax directory, by classifier
+_OUTPUTS = {"rdp" : "otu_taxonomy.rdp", "sintax" : "otu_taxonomy.sintax", "blast" : "otu_taxonomy.blast",
+            "isolates" : "isolates_blast.out", "hl" : "hl_blast.out"}
+
+def _file_fingerprint(path):
+    if path == "null" or not os.path.exists(path):
+        return path
+    stat = os.stat(path)
+    return F"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def _fingerprint(train_dict, isolates, hl, *params):
+    # Everything the classifier output of a query depends on besides its sequence: the
+    # trained model (the training cache keys when train recorded them), the isolate and
+    # high level references and the classification parameters
+    manifest = os.path.join(train_dict["rdp_path"], "training_cache.json")
+    try:
+        with open(manifest, "r") as ifile:
+            trained = ifile.read()
+    except FileNotFoundError:
+        trained = "\n".join([_file_fingerprint(train_dict["sintax_database"]), _file_fingerprint(F'{train_dict["rdp_path"]}rRNAClassifier.properties')])
+    parts = [json.dumps(train_dict, sort_keys=True), trained, _file_fingerprint(isolates), _file_fingerprint(hl)] + [str(p) for p in params]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+class _QueryCache:
+    # sqlite store of per-query classifier output, keyed by the hash of the sequence and
+    # the fingerprint of the run, and trimmed to max_bytes least recently used first
+    def __init__(self, path, max_bytes):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.max_bytes = max_bytes
+
+    def get_many(self, keys, batch_size=500):
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            rows = self.db.execute(F"SELECT key, value FROM results WHERE key IN ({','.join(['?'] * len(batch))})", batch)
+            found.update([(key, json.loads(value)) for key, value in rows])
+        now = time.time()
+        self.db.executemany("UPDATE results SET used = ? WHERE key = ?", [(now, key) for key in found])
+        self.db.commit()
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+        self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+        self.db.commit()
+        self._evict()
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in self.db.execute("SELECT key, size FROM results ORDER BY used"):
+            stale.append((key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        self.db.executemany("DELETE FROM results WHERE key = ?", stale)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+def _query_id(header):
+    return header[1:].split()[0]
+
+def _dereplicate(formatted_inputs, unique_file):
+    # Write the first record of every distinct sequence to unique_file. Returns the
+    # (ID, representative ID) of every query in input order.
+    reps = {}
+    members = []
+    with _Fasta(formatted_inputs) as fasta, open(unique_file, "w") as ofile:
+        for header, seq in fasta:
+            key = seq.replace("\n", "").upper()
+            ID = _query_id(header)
+            if key not in reps:
+                reps[key] = ID
+                ofile.write(header)
+                ofile.write(seq)
+            members.append((ID, reps[key]))
+    print(F"{len(reps)} unique sequences among {len(members)} queries, {len(members) / max(1, len(reps)):.2f} queries per unique sequence")
+    return members
+
+def _split_queries(formatted_inputs, cache, fingerprint, miss_file):
+    # Look every query up in the cache and write the ones not found to miss_file. Returns
+    # the (ID, key) of every query in input order, the cached results by ID and the
+    # number of queries left to classify.
+    with _Fasta(formatted_inputs) as fasta:
+        records = [(header, seq, hashlib.sha256((fingerprint + seq.replace("\n", "").upper()).encode("utf-8")).hexdigest())
+            for header, seq in fasta]
+    found = cache.get_many(set([key for header, seq, key in records]))
+    order = []
+    hits = {}
+    misses = 0
+    with open(miss_file, "w") as ofile:
+        for header, seq, key in records:
+            ID = _query_id(header)
+            order.append((ID, key))
+            if key in found:
+                hits[ID] = found[key]
+            else:
+                misses += 1
+                ofile.write(header)
+                ofile.write(seq)
+    return order, hits, misses
+
+def _per_query(path, kind):
+    # Output text of each query: one line for RDP and SINTAX, the whole "# BLASTN" block
+    # of comment and hit lines for BLAST (-outfmt 7)
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, "r") as ifile:
+        if kind in ("rdp", "sintax"):
+            for line in ifile:
+                results[line.split("\t", 1)[0].strip()] = line
+        else:
+            block = []
+            for line in ifile:
+                if line.startswith("# BLAST") and len(block) > 0:
+                    _add_block(results, block)
+                    block = []
+                block.append(line)
+            _add_block(results, block)
+    return results
+
+def _add_block(results, block):
+    for line in block:
+        if line.startswith("# Query: "):
+            results[line[9:].split()[0]] = "".join(block)
+            return
+
+def _rename(text, old, new):
+    if old == new:
+        return text
+    lines = []
+    for line in text.splitlines(True):
+        if line.startswith(old + "\t"):
+            line = new + line[len(old):]
+        elif line.startswith("# Query: " + old):
+            line = "# Query: " + new + line[len("# Query: " + old):]
+        lines.append(line)
+    return "".join(lines)
+
+def _merge_outputs(tax, kinds, order, hits, cache):
+    # Store the fresh output of the classified queries, then rewrite each output file with
+    # every query in input order, cached queries renamed to their ID in this input. A query
+    # missing from the output of any classifier is not stored, so it is classified again
+    # next time rather than served an empty result.
+    fresh = {kind : _per_query(os.path.join(tax, _OUTPUTS[kind]), kind) for kind in kinds}
+    new_items = {}
+    incomplete = []
+    for ID, key in order:
+        if ID not in hits:
+            if all([ID in fresh[kind] for kind in kinds]):
+                new_items[key] = dict([("id", ID)] + [(kind, fresh[kind][ID]) for kind in kinds])
+            else:
+                incomplete.append(ID)
+    if len(incomplete) > 0:
+        warnings.warn(F"{len(incomplete)} queries missing from the output of a classifier were not cached, e.g. {incomplete[0]}", RuntimeWarning)
+    cache.put_many(new_items)
+    for kind in kinds:
+        with open(os.path.join(tax, _OUTPUTS[kind]), "w") as ofile:
+            for ID, key in order:
+                if ID in hits:
+                    ofile.write(_rename(hits[ID].get(kind, ""), hits[ID]["id"], ID))
+                else:
+                    ofile.write(fresh[kind].get(ID, ""))
+
+def _expand_outputs(tax, kinds, members):
+    # Rewrite each output file with a copy of its representative's output for every query
+    for kind in kinds:
+        results = _per_query(os.path.join(tax, _OUTPUTS[kind]), kind)
+        with open(os.path.join(tax, _OUTPUTS[kind]), "w") as ofile:
+            for ID, rep in members:
+                ofile.write(_rename(results.get(rep, ""), rep, ID))
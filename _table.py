@@ -0,0 +1,121 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+from array import array
+import numpy as np
+
+class _TaxonVocabulary:
+	# Interns taxon names to integer IDs, shared by the tables of one run so that IDs
+	# compare across classifiers. ID 0 is always the empty name (unclassified).
+	def __init__(self):
+		self.names = [""]
+		self.ids = {"" : 0}
+
+	def intern(self, name):
+		ID = self.ids.get(name)
+		if ID is None:
+			ID = len(self.names)
+			self.ids[name] = ID
+			self.names.append(name)
+		return ID
+
+	def __len__(self):
+		return len(self.names)
+
+def _score(value):
+	# "NA", empty and unparseable scores count as 0, as in _vote
+	try:
+		return float(value)
+	except ValueError:
+		return 0.
+
+class _TaxonomyTable:
+	# Reformatted results of one classifier, one row per OTU in the order added.
+	#   ranks         rank names, one column each
+	#   otus, index   OTU IDs in row order and the OTU -> row map
+	#   vocab         _TaxonVocabulary the taxon IDs refer to
+	#   taxa          int32 array (OTUs x ranks) of taxon IDs, 0 where unclassified
+	#   scores        float32 array (OTUs x ranks), 0 where missing or "NA"
+	#   names(k)      taxon names of rank k for every OTU
+	#   widths        number of rank cells present in each row, empty cells included
+	#   table[otu]    [taxon, score, taxon, score, ...] row, as _build_dict built it
+	def __init__(self, ranks, vocab=None):
+		self.ranks = list(ranks)
+		self.vocab = _TaxonVocabulary() if vocab is None else vocab
+		self.otus = []
+		self.index = {}
+		self._taxa = array("i")
+		self._scores = array("f")
+		self._widths = array("h")
+		self._arrays = None
+
+	def add_row(self, line):
+		# Normalise an otu_taxonomy_*_final.txt line the way _build_dict does, but keep
+		# empty taxon cells in place so that later ranks stay in their columns
+		rank_count = len(self.ranks)
+		temp = line.strip().split("\t")
+		width = len(temp[2::2])
+		temp = [x.replace(" ", "_") for x in temp]
+		values = temp[2:rank_count*2 + 2]
+		values.extend([""]*(rank_count*2 - len(values)))
+		# strip numbers from species identifications
+		values[-2] = "".join([c for c in values[-2] if not c.isdigit()]).replace("_", " ")
+		taxa = [self.vocab.intern(x) for x in values[0::2]]
+		scores = [_score(x) for x in values[1::2]]
+		self._arrays = None
+		if temp[0] in self.index:
+			start = self.index[temp[0]]*rank_count
+			self._taxa[start:start + rank_count] = array("i", taxa)
+			self._scores[start:start + rank_count] = array("f", scores)
+			self._widths[self.index[temp[0]]] = width
+		else:
+			self.index[temp[0]] = len(self.otus)
+			self.otus.append(temp[0])
+			self._taxa.extend(taxa)
+			self._scores.extend(scores)
+			self._widths.append(width)
+
+	def _as_arrays(self):
+		if self._arrays is None:
+			shape = (len(self.otus), len(self.ranks))
+			self._arrays = (np.array(self._taxa, dtype=np.int32).reshape(shape),
+				np.array(self._scores, dtype=np.float32).reshape(shape))
+		return self._arrays
+
+	@property
+	def taxa(self):
+		return self._as_arrays()[0]
+
+	@property
+	def scores(self):
+		return self._as_arrays()[1]
+
+	def names(self, k):
+		vocab_names = self.vocab.names
+		return [vocab_names[x] for x in self._taxa[k::len(self.ranks)]]
+
+	@property
+	def widths(self):
+		return self._widths
+
+	def keys(self):
+		return self.otus
+
+	def __contains__(self, otu):
+		return otu in self.index
+
+	def __len__(self):
+		return len(self.otus)
+
+	def __getitem__(self, otu):
+		rank_count = len(self.ranks)
+		start = self.index[otu]*rank_count
+		row = []
+		for taxon, score in zip(self._taxa[start:start + rank_count], self._scores[start:start + rank_count]):
+			row.extend([self.vocab.names[taxon], score])
+		return row
@@ -6,76 +6,131 @@
 # The full license in the file LICENSE, distributed with this software.
 # -------------------------------------------------------------------------
 
-import os
+import os, subprocess, json, functools
+from collections import deque
 import pandas as pd
 from q2_types.feature_data import (FeatureData, Taxonomy, Sequence, DNAIterator, DNAFASTAFormat, TSVTaxonomyFormat)
 from qiime2.plugin import Int, Str, Float, Bool, Choices, Range
 from .plugin_setup import plugin, citations
 from .train import CONSTAXTaxonomicClassifier
-from ._format_data import _check_input_names, _split_inputs, _detect_format
+from ._format_data import _check_input_names, _chunk_size, _iter_chunks, _detect_format
+from ._parallel import _run_pool, _run_stages
+from ._blast_pin import _residency_report
+from ._combine import _combine_taxonomy
+from ._query_cache import _QueryCache, _fingerprint, _dereplicate, _split_queries, _merge_outputs, _expand_outputs
+
+def _run_sintax(formatted_inputs, train_dict, tax, conf, nthreads):
+    cmd = ['vsearch', '-sintax', formatted_inputs, '-db', train_dict['sintax_database'], '-tabbedout',
+        F'{tax}/otu_taxonomy.sintax', '-strand', 'both', '-sintax_cutoff', str(conf), '-threads', str(nthreads)]
+    subprocess.run(cmd, check=True)
+
+    # An attached backup suffix is the only in-place form GNU and BSD sed both accept
+    cmd = ['sed', '-i.bak', '-e', r's|([0-1][.][0-9]\{2\}|&00|g', F'{tax}/otu_taxonomy.sintax']
+    subprocess.run(cmd, check=True)
+    os.remove(F'{tax}/otu_taxonomy.sintax.bak')
+
+def _run_blast(formatted_inputs, train_dict, tax, mhits, isolates, hl, nthreads, workers, chunk_size):
+    if isolates != "null":
+        formatted_isolates = _check_input_names(isolates, name=F"{tax}/isolates_formatted.fasta")
+        iso_blast_db = F'{tax}/{os.path.basename(isolates).split(".")[0]}__BLAST'
+        cmd = ['makeblastdb', '-in', F'{tax}/isolates_formatted.fasta', '-dbtype', 'nucl', '-out', iso_blast_db]
+        subprocess.run(cmd, check=True)
+    if hl != "null":
+        formatted_hl = _check_input_names(hl, name=F"{tax}/hl_formatted.fasta")
+        hl_blast_db = F'{tax}/{os.path.basename(hl).split(".")[0]}__BLAST'
+        cmd = ['makeblastdb', '-in', F'{tax}/hl_formatted.fasta', '-dbtype', 'nucl', '-out', hl_blast_db]
+        subprocess.run(cmd, check=True)
+
+    # Query chunks are piped to blastn on stdin; chunk jobs against the reference,
+    # isolate and HL databases share one pool, and nthreads is split between the
+    # concurrently running blastn processes
+    if chunk_size < 1:
+        chunk_size = _chunk_size(formatted_inputs, workers)
+    # A database left cold by other runs is re-read from disk by every chunk; see _blast_pin
+    print(_residency_report(train_dict['blast_database']))
+    blast_threads = str(max(1, nthreads // workers))
+    blast_fmt = '7 qacc sacc evalue bitscore pident qcovs stitle'
+    blast_dbs = [('blast', train_dict['blast_database'], ['-max_target_seqs', str(mhits)])]
+    if isolates != "null":
+        blast_dbs.append(('isolates', iso_blast_db, ['-max_target_seqs', '1', '-evalue', '0.00001']))
+    if hl != "null":
+        blast_dbs.append(('hl', hl_blast_db, ['-max_target_seqs', '1', '-evalue', '0.001']))
+    job_dests = deque()
+    def blast_jobs():
+        for chunk in _iter_chunks(formatted_inputs, chunk_size):
+            chunk = chunk.encode('utf-8')
+            for dest, blast_db, blast_args in blast_dbs:
+                job_dests.append(dest)
+                yield (['blastn', '-query', '-', '-db', blast_db, '-num_threads', blast_threads, '-outfmt', blast_fmt] + blast_args, chunk)
+    blast_outputs = {'blast' : open(F'{tax}/otu_taxonomy.blast', 'w')}
+    if isolates != "null":
+        blast_outputs['isolates'] = open(F'{tax}/isolates_blast.out', 'w')
+    if hl != "null":
+        blast_outputs['hl'] = open(F'{tax}/hl_blast.out', 'w')
+    try:
+        for blast_out in _run_pool(blast_jobs(), workers):
+            blast_outputs[job_dests.popleft()].write(blast_out)
+    finally:
+        for ofile in blast_outputs.values():
+            ofile.close()
+
+def _run_rdp(formatted_inputs, train_dict, tax, conf, mem):
+    cmd = ['classifier', 'classify', '--conf', str(conf), '--format', 'allrank', '--train_propfile', F'{train_dict["rdp_path"]}rRNAClassifier.properties',
+        '-o', F'{tax}/otu_taxonomy.rdp', formatted_inputs, F'-Xmx{mem}m']
+    subprocess.run(cmd, check=True)
 
 def classify(db: DNAFASTAFormat, input: DNAFASTAFormat, training_result: str, output_dir: str = 'output', mem: int = 4000, conf: float = 0.8, tax: str = "taxonomy_assignments",
                      nthreads: int = 1, evalue: float = 1., mhits: int = 10, p_iden: float = 0., tf: str = "training_files",
                      isolates: str = "null", iso_qc: int = 75, iso_id: float = 1., hl: str = "null", hl_qc: int = 75, hl_id: float = 1.,
-                     conservative: bool = False , consistent: bool = False) -> TSVTaxonomyFormat:
+                     conservative: bool = False , consistent: bool = False, workers: int = 1, chunk_size: int = 0,
+                     query_cache: str = "null", query_cache_size: int = 1000, derep: bool = True) -> TSVTaxonomyFormat:
     with open(training_result, "r") as ifile:
         train_dict = json.load(ifile)
     format = train_dict["format"]
-    db = train_dict['blast_database'].strip("__BLAST")
-    if not combine_only:
-        formatted_inputs = _check_input_names(input)
+    # _combine_taxonomy finds the training files by the name of the reference they were formatted from
+    db = train_dict['blast_database'][:-len("__BLAST")] + ".fasta"
+    os.makedirs(tax, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    formatted_inputs = _check_input_names(input)
+    queries = formatted_inputs
+    if derep:
+        # Identical sequences under different feature IDs are classified once and
+        # their results copied to every ID before the consensus is built
+        queries = F'{tax}/unique_inputs.fasta'
+        members = _dereplicate(formatted_inputs, queries)
+    if query_cache != "null":
+        # Queries classified by an earlier run with the same model and parameters are
+        # taken from the cache, only the rest go through the classifiers
+        results_cache = _QueryCache(query_cache, query_cache_size * 2**20)
+        fingerprint = _fingerprint(train_dict, isolates, hl, conf, evalue, mhits, p_iden)
+        order, hits, misses = _split_queries(queries, results_cache, fingerprint, F'{tax}/uncached_inputs.fasta')
+        queries = F'{tax}/uncached_inputs.fasta'
+        print(F"{len(order) - misses} of {len(order)} queries found in the result cache")
 
-        print("__________________________________________________________________________")
-        print("Assigning taxonomy to OTU's representative sequences")
+    print("__________________________________________________________________________")
+    print("Assigning taxonomy to OTU's representative sequences")
 
-        # SINTAX
-        sintax_db = F"{tax}/sintax.db"
-        cmd = ['vsearch', '-sintax', formatted_inputs, '-db', train_dict['sintax_database'], '-tabbedout',
-            F'{tax}/otu_taxonomy.sintax', '-strand', 'both', '-sintax_cutoff', str(conf), '-threads', str(nthreads)]
-        subprocess.run(cmd, check=True)
-
-        cmd = ['sed', '-i', '',  '-e', 's|([0-1][.][0-9]\{2\}|&00|g', F'{tax}/otu_taxonomy.sintax']
-        subprocess.run(cmd, check=True)
-
-        # BLAST
-        split_queries = _split_inputs(formatted_inputs)
-        if isolates != "null":
-            formatted_isolates = _check_input_names(isolates, name=F"{tax}/isolates_formatted.fasta")
-            iso_blast_db = F'{tax}/{os.path.basename(isolates).split(".")[0]}__BLAST'
-            cmd = ['makeblastdb', '-in', F'{tax}/isolates_formatted.fasta', '-dbtype', 'nucl', '-out', iso_blast_db]
-            subprocess.run(cmd, check=True)
-            iso_buf = ""
-        if high_level_db != "null":
-            formatted_hl = _check_input_names(high_level_db, name=F"{tax}/hl_formatted.fasta")
-            hl_blast_db = F'{tax}/{os.path.basename(high_level_db).split(".")[0]}__BLAST'
-            cmd = ['makeblastdb', '-in', F'{tax}/hl_formatted.fasta', '-dbtype', 'nucl', '-out', hl_blast_db]
-            subprocess.run(cmd, check=True)
-            hl_buf = ""
-        with open(F'{tax}/blast.out', 'w') as ofile:
-                for i in split_queries:
-                    cmd = ['blastn', '-query', i, '-db', train_dict['blast_database'], '-num_threads', 'nthreads', '-outfmt', '7', 'qacc', 'sacc', 'evalue', 'bitscore', 'pident', 'qcovs"', '-max_target_seqs', str(mhits)]
-                    blast_out = subprocess.run(cmd, capture_output = True).stdout.decode('utf-8')
-                    ofile.write(blast_out)
-                    if isolates != "null":
-                        cmd = ['blastn', '-query', i, '-db', iso_blast_db, '-num_threads', 'nthreads', '-outfmt', '7', 'qacc', 'sacc', 'evalue', 'bitscore', 'pident', 'qcovs"', '-max_target_seqs', '1', '-evalue', '0.00001']
-                        iso_buf += subprocess.run(cmd, capture_output = True).stdout.decode('utf-8')
-                    if high_level_db != "null":
-                        cmd = ['blastn', '-query', i, '-db', hl_blast_db, '-num_threads', 'nthreads', '-outfmt', '7', 'qacc', 'sacc', 'evalue', 'bitscore', 'pident', 'qcovs"', '-max_target_seqs', '1', '-evalue', '0.001']
-                        hl_buf += subprocess.run(cmd, capture_output = True).stdout.decode('utf-8')
-        if isolates != "null":
-            with open(F'{tax}/isolates_blast.out', 'w') as ofile:
-                ofile.write(iso_buf)
-        if high_level_db != "null":
-            with open(F'{tax}/hl_blast.out', 'w') as ofile:
-                ofile.write(hl_buf)
-
-        # RDP
-        cmd = ['classifier', 'classify', '--conf', str(conf), '--format', 'allrank', '--train_propfile', F'{train_dict["rdp_path"]}rRNAClassifier.properties',
-            '-o', F'{tax}/otu_taxonomy.rdp', formatted_inputs, F'-Xmx{mem}m']
-        subprocess.run(cmd, check=True)
+    # The three classifiers are independent, so they run side by side. RDP is a
+    # single JVM holding the mem budget; SINTAX and BLAST split the other threads.
+    # With too few threads the scheduler runs them one after another.
+    rdp_threads = 1
+    sintax_threads = max(1, (nthreads - rdp_threads) // 2)
+    blast_threads = max(1, nthreads - rdp_threads - sintax_threads)
+    if query_cache == "null" or misses > 0:
+        _run_stages([
+            ('SINTAX', functools.partial(_run_sintax, queries, train_dict, tax, conf, sintax_threads), sintax_threads, 0),
+            ('BLAST', functools.partial(_run_blast, queries, train_dict, tax, mhits, isolates, hl, blast_threads, workers, chunk_size), blast_threads, 0),
+            ('RDP', functools.partial(_run_rdp, queries, train_dict, tax, conf, mem), rdp_threads, mem)],
+            nthreads=nthreads, mem=mem)
+    kinds = ['rdp', 'sintax', 'blast'] + (['isolates'] if isolates != "null" else []) + (['hl'] if hl != "null" else [])
+    if query_cache != "null":
+        _merge_outputs(tax, kinds, order, hits, results_cache)
+        results_cache.close()
+    if derep:
+        _expand_outputs(tax, kinds, members)
 
     # Combine classification results
-    consensus_Taxonomy = _combine_taxonomy(output_dir, conf, tax, evalue, mhits, p_iden, format, db, tf,
+    consensus_taxonomy = _combine_taxonomy(output_dir, conf, tax, evalue, mhits, p_iden, format, db, tf,
         isolates, iso_qc, iso_id, hl, hl_qc, hl_id, conservative, consistent)
     return consensus_taxonomy
 
@@ -99,6 +154,11 @@ plugin.methods.register_function(
                 'hl_id': Float % Range(0., 1., inclusive_end=True),
                 'conservative': Bool,
                 'consistent': Bool,
+                'workers': Int % Range(1, None),
+                'chunk_size': Int % Range(0, None),
+                'query_cache': Str,
+                'query_cache_size': Int % Range(1, None),
+                'derep': Bool,
                 'output_dir': Str,
                 'tax': Str},
     outputs=[('consensus_taxonomy', FeatureData[Taxonomy])],
@@ -120,6 +180,11 @@ plugin.methods.register_function(
                             'hl_id': 'Minimum aligned sequence proportion identity to report high-level taxonomy matches. Must be in range [0, 1]',
                             'conservative': 'Use conservative consensus rule (2 False = False winner).',
                             'consistent': 'Show if the consensus taxonomy is consistent with the real hierarchical taxonomy.',
+                            'workers': 'Maximum number of BLAST chunk jobs to run at once, sharing nthreads between them. Must be in range [1, infinity].',
+                            'chunk_size': 'Number of query records per BLAST job. 0 chooses a size from the input size, sequence length and workers.',
+                            'query_cache': 'sqlite file caching the classifier results of each query sequence across runs. Sequences already classified with the same training result and parameters skip SINTAX, BLAST and RDP.',
+                            'query_cache_size': 'Maximum size of the query cache in MB, least recently used results are evicted first. Must be in range [1, infinity].',
+                            'derep': 'Classify identical query sequences once and assign the result to each of their feature IDs.',
                             'output_dir': 'Output directory for classifications.',
                             'tax': 'Directory for intermediate taxonomy assignments.'},
     output_descriptions={'consensus_taxonomy': 'Taxonomy classifications of query sequences with accompanying statistics and matches to high-level database andor isolates.'},
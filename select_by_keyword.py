@@ -6,19 +6,54 @@
 # The full license in the file LICENSE, distributed with this software.
 # -------------------------------------------------------------------------
 
-def fasta_select_by_keyword(input, output, keyword):
-    rec_dict = {}
-    with open(input, "r") as ifile:
-        line = ifile.readline()
-        while line != "":
-            header = line
-            line = ifile.readline()
-            seq = ""
-            while line != "" and line[0] != ">":
-                seq += line.strip()
-                line = ifile.readline()
-            rec_dict[header] = seq
-    with open(output, "w") as ofile:
-        for rec in rec_dict.keys():
-            if keyword in rec:
-                ofile.write(F"{rec}{rec_dict[rec]}\n")
+import re
+from q2_types.feature_data import (FeatureData, Sequence, DNAFASTAFormat)
+from qiime2.plugin import Str, Bool, List
+from .plugin_setup import plugin, citations
+from ._fasta import _Fasta
+
+def _keyword_matcher(keywords, regex=False, ignore_case=False):
+    # One compiled alternation over every keyword, so each header is scanned once however
+    # many keywords there are
+    if isinstance(keywords, str):
+        keywords = [keywords]
+    if len(keywords) == 0:
+        raise ValueError("No keywords given to select records by")
+    patterns = keywords if regex else [re.escape(keyword) for keyword in keywords]
+    return re.compile("|".join([F"(?:{pattern})" for pattern in patterns]), re.IGNORECASE if ignore_case else 0).search
+
+def fasta_select_by_keyword(input, output, keywords, regex=False, ignore_case=False):
+    # Records are written as they are matched, in input order and with repeated headers
+    # kept. Only the headers are read to select records. Returns the number selected.
+    match = _keyword_matcher(keywords, regex, ignore_case)
+    selected = 0
+    with _Fasta(input) as fasta, open(output, "w") as ofile:
+        for i in range(len(fasta)):
+            header = fasta.header(i)
+            if match(header):
+                ofile.write(F"{header}{fasta.sequence(i)}\n")
+                selected += 1
+    return selected
+
+def select_by_keyword(sequences: DNAFASTAFormat, keywords: list, regex: bool = False, ignore_case: bool = False) -> DNAFASTAFormat:
+    selected = DNAFASTAFormat()
+    count = fasta_select_by_keyword(str(sequences), str(selected), keywords, regex, ignore_case)
+    print(F"{count} records selected")
+    return selected
+
+plugin.methods.register_function(
+    function=select_by_keyword,
+    inputs={'sequences' : FeatureData[Sequence]},
+    parameters={'keywords' : List[Str],
+                'regex' : Bool,
+                'ignore_case' : Bool},
+    outputs=[('selected_sequences', FeatureData[Sequence])],
+    input_descriptions={'sequences' : 'Sequences to filter, such as a reference database, in FASTA format.'},
+    parameter_descriptions={'keywords' : 'Keywords to search for in the sequence headers. Records whose header contains any of them are kept.',
+                            'regex' : 'Treat the keywords as regular expressions.',
+                            'ignore_case' : 'Match the keywords regardless of case.'},
+    output_descriptions={'selected_sequences' : 'Records whose header matched a keyword, in input order.'},
+    name='Select sequences by keyword',
+    description='Function to select the records of a FASTA file whose header contains any of the keywords',
+    citations=[citations['liber2021constax2']]
+    )
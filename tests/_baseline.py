@@ -0,0 +1,651 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+# Verbatim copies of functions as they were before they were rewritten, kept so
+# that tests can check the new implementations produce the same output. Positional
+# vcs[0] lookups are written vcs.iloc[0], which pandas 3 requires.
+
+import os, sys, time, unicodedata
+import pandas as pd
+
+def _count_classifications(filenames, output_dir, format, rank_count, use_blast=False):
+	# rdp, utax, sintax, consensus OR
+	# rdp, sintax, blast, consensus
+	file_num = 0
+	unique_dict = {}
+	for i in range(rank_count):
+		unique_dict[i] = {}
+	for i, file in enumerate(filenames):
+		input = open(file, "r")
+		all_lines = input.readlines()
+		input.close()
+		count_y = [0]*rank_count
+		count_n = [0]*rank_count
+		output1 = open(F"{output_dir}/otu_taxonomy_CountClassified.txt", "w")
+		if i<3:	#first 3 files have scores
+			start= 2
+			freq = 2
+		else: 	#consensus file does not have scores
+			start= 1
+			freq = 1
+		for j, line in enumerate(all_lines[1:]):
+			temp = line.strip().split("\t")
+			taxonomy = temp[start::freq]
+			if len(taxonomy)==rank_count:
+				# strip numbers from species identifications
+				species = "".join(list(filter(lambda c: not c.isdigit(), taxonomy[-1])))
+				taxonomy[-1] = species.replace("_"," ").strip()
+
+			for k in range(0,rank_count):
+				if k<len(taxonomy):
+					count_y[k]+=1
+					if taxonomy[k] not in unique_dict[k]:
+						unique_dict[k][taxonomy[k]] = [0,0,0,0]
+						unique_dict[k][taxonomy[k]][file_num]+= 1
+					else:
+						unique_dict[k][taxonomy[k]][file_num]+= 1
+				else:
+					taxonomy.append("Unidentified")
+					count_n[k]+=1
+					if taxonomy[k] not in unique_dict[k]:
+						unique_dict[k][taxonomy[k]] = [0,0,0,0]
+						unique_dict[k][taxonomy[k]][file_num]+= 1
+					else:
+						unique_dict[k][taxonomy[k]][file_num]+= 1
+
+
+		for l, level in enumerate(count_y):
+			count_y[l] = str(level)
+		for m, level in enumerate(count_n):
+			count_n[m] = str(level)
+		if format == "UNITE":
+			output1.write("\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\tSpecies\n")
+		else:
+			output1.write("\t" + "\t".join([F'Rank_{x}' for x in range(1,rank_count+1)])+ "\n")
+		output1.write("Classified\t"+"\t".join(count_y)+"\n")
+		output1.write("Unclassified\t"+"\t".join(count_n) + "\n")
+		output1.close()
+		file_num+=1
+	output2 = open(F"{output_dir}/Classification_Summary.txt", "w")
+	if use_blast:
+		output2.write("Classification\tRDP\tBLAST\tSINTAX\tCONSTAX\n")
+	else:
+		output2.write("Classification\tRDP\tSINTAX\tUTAX\tCONSTAX\n")
+	for l in range(0, rank_count):
+		key_list = list(unique_dict[l].keys())
+		key_list.sort()
+		if key_list[0].isspace():
+			for c in range(len(unique_dict[l]["Unidentified"])):
+				unique_dict[l]["Unidentified"][c] += unique_dict[l][key_list[0]][c]
+			key_list = key_list[1:]
+		for key in key_list:
+			output2.write(key+"\t"+"\t".join(str(x) for x in unique_dict[l][key])+"\n")
+	output2.close()
+
+def _reformat_RDP(rdp_file, output_dir, confidence, ranks):
+	input = open(rdp_file)
+	all_lines = input.readlines()
+	input.close()
+
+	output_file = F"{output_dir}/otu_taxonomy_rdp_final.txt"
+	output = open(output_file,"w")
+
+	if ranks[0] == "Kingdom":
+		output.write("Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score")
+		output.write("\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n")
+	else:
+		output.write("Feature ID\tOTU_Score")
+		for r in ranks:
+			output.write(F"\t{r}\t{r.replace('ank_', '')}_score")
+		output.write("\n")
+
+	for i, line in enumerate(all_lines):
+		# capture confidence level at genus before altering line
+		temp = line.strip().split("\t")
+		confi = temp[7:-2][::3]
+		confi.append(temp[-1])
+		taxon = temp[5:][::3]
+
+		# remove any taxonomic levels after first "unidentified"
+		j=0
+		new_taxon = []
+		while j<len(taxon):
+			if	"ncertae_sedis" in taxon[j]:
+				taxon[j] = "Incertae_sedis"
+			if  "unidentified" in taxon[j] or float(confi[j])<confidence:
+				del confi[j:]
+				break
+			else: new_taxon.append(taxon[j].capitalize())
+			j+=1
+
+		# remove "_sp" species classifications
+		if ranks[0] == "Kingdom" and len(new_taxon)>0 and (" sp" in new_taxon[-1] or "_sp" in new_taxon[-1]):
+			del new_taxon[-1]
+			del confi[-1]
+		# remove terminal Incertae_sedis
+		while len(new_taxon)>0 and "ncertae_sedis" in new_taxon[-1]:
+			del new_taxon[-1]
+			del confi[-1]
+
+
+		if confi == []:
+			score = "NA"
+		else:
+			score = confi[-1]
+		tax_confi = ""
+		for k in range(len(new_taxon)):
+			tax_confi += F"\t{new_taxon[k]}\t{confi[k]}"
+
+		# iters = [iter(new_taxon), iter(confi)]
+		# tax_confi = list(str(it.next()) for it in itertools.cycle(iters))
+
+		# output.write(temp[0]+"\t"+score+"\t"+"\t".join(tax_confi)+"\n")
+		output.write(F"{temp[0]}\t{score}{tax_confi}\n")
+
+	output.close()
+	return output_file
+
+def _reformat_UTAX(utax_file, output_dir, confidence, ranks):
+	input = open(utax_file)
+	all_lines = input.readlines()
+	input.close()
+
+	output_file = F"{output_dir}/otu_taxonomy_utax_final.txt"
+	output = open(output_file,"w")
+	if ranks[0] == "Kingdom":
+		output.write("Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score")
+		output.write("\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n")
+	else:
+		output.write("Feature ID\tOTU_Score")
+		for r in ranks:
+			output.write(F"\t{r}\t{r.replace('ank_', '')}_score")
+		output.write("\n")
+
+	for i, line in enumerate(all_lines):
+		#remove unwanted third column and convert "(" and ")" to "*"
+		temp = line.replace("(", "*").replace(")","*").split()
+		line = temp[0]+"\t"+temp[1]
+
+		temp0 = line.split("*")
+		confid = temp0[1:][::2]
+		line2 = "".join(temp0[0:-2][::2])
+
+		temp1 = line2.split(",")
+		j=1
+		new_line = [temp1[0]]
+		while j<len(temp1):
+			if  "unidentified" in temp1[j] or float(confid[j-1]) < confidence:
+				del confid[j-1:]
+				break
+			else:
+				new_line.append(temp1[j])
+			j+=1
+
+		line2 = ",".join(new_line)
+
+		temp2 = line2.split(",")
+		# OTU_1328        d:Fungi, p:Ascomycota, c:Archaeorhizomycetes, o:Archaeorhizomycetales, f:Archaeorhizomycetaceae, g:Archaeorhizomyces, s:Archaeorhizomyces_sp
+		temp3 = temp2[0].split()
+		# OTU_1328, d:Fungi
+		temp4 = []
+		for item in temp2[1:]:
+			temp4.append(item[2:].capitalize())
+		# Ascomycota, Archaeorhizomycetes, Archaeorhizomycetales, Archaeorhizomycetaceae, Archaeorhizomyces, Archaeorhizomyces_sp
+
+		# remove "_sp" species classificaitons
+		if ranks[0] == "Kingdom" and len(temp4)>0 and temp4[-1].endswith("_sp"):
+			del temp4[-1]
+			del confid[-1]
+
+		# remove terminal Incertae_sedis
+		while len(temp4)>0 and "ncertae_sedis" in temp4[-1]:
+			del temp4[-1]
+			del confid[-1]
+
+		confid = [str(x) for x in confid]
+		if len(confid) > 0:
+			score = confid[-1]
+		else:
+			score = 0
+		if len(temp3) > 1:
+			final_line = F"{temp3[0]}\t{score}\t{temp3[1][2:].capitalize()}\tNA"
+			tax_confi = ""
+			for k in range(len(temp4)):
+				tax_confi += F"\t{temp4[k]}\t{confid[k]}"
+
+			output.write(F"{final_line+tax_confi}\n")
+		else:
+			tax_confi = '\t'.join([""]*len(ranks)*2)
+			output.write(F"{temp0[0]}\t{0.0000}\t{tax_confi}\n")
+
+	output.close()
+	return output_file
+
+def _reformat_SINTAX(sintax_file, output_dir, confidence, ranks):
+	input = open(sintax_file)
+	all_lines = input.readlines()
+	input.close()
+
+	output_file = F"{output_dir}/otu_taxonomy_sintax_final.txt"
+	output = open(output_file, "w")
+	if ranks[0] == "Kingdom":
+		output.write("Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score")
+		output.write("\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n")
+	else:
+		output.write("Feature ID\tOTU_Score")
+		for r in ranks:
+			output.write(F"\t{r}\t{r.replace('ank_', '')}_score")
+		output.write("\n")
+	for i, line in enumerate(all_lines):
+		# remove unwanted third column and convert "(" and ")" to "*"
+		# temp = line.replace("(", "*").replace(")","*").split("\t")
+		temp = line.split("\t")
+		ID = temp[0].split(" ")[0]
+		del temp[2:]
+		# temp =>  'OTU_999'	'd:Fungi*1.0000*,p:Ascomycota*1.0000*,c:Leotiomycetes*1.0000*,o:Helotiales*1.0000*,s:Helotiales_sp*1.0000*'
+		### NEW STUFF
+		temp0 = temp[1].split(",")
+		res = []
+		for x in temp0:
+			t = list(x)
+			if len(t) == 0:
+				break
+			t[-1] = "*"
+			t[-8] = "*"
+			res.append("".join(t))
+		if len(t) != 0:
+			temp0 = ",".join(res).split("*")[:-1]
+			### END NEW STUFF
+			# temp0 = temp[1].split("*")
+			# temp0 =>  'd:Fungi,' '1.0000' ',p:Ascomycota' '1.0000' ',c:Leotiomycetes' '1.0000' ',o:Helotiales' '1.0000' ',s:Helotiales_sp' '1.0000'
+			confid = temp0[1:][::2]
+			# confid =>  '1.0000' '1.0000' '1.0000' '1.0000' '1.0000'
+			temp_line = "".join(temp0[0:-2][::2])
+			# temp_line =>  "d:Fungi,p:Ascomycota,c:Leotiomycetes,o:Helotiales,s:Helotiales_sp"
+
+			# fix missing taxonomic levels
+			temp1 = temp_line.split(",")
+			# temp1 =>  'd:Fungi' 'p:Ascomycota' 'c:Leotiomycetes' 'o:Helotiales' 's:Helotiales_sp'
+			if ranks[0] == "Kingdom":
+				levels = ["d:", "k:", "p:", "c:", "o:", "f:", "g:", "s:"]
+				if len(temp1)<len(levels) and len(temp1) > 1:
+					if "g:" in temp1[-2]:
+						for k, level in enumerate(temp1):
+							if levels[k] not in temp1[k]:
+								temp1.insert(k, levels[k]+"Incertae_sedis")
+								confid.insert(k, 9)
+					else:
+						for k, level in enumerate(temp1):
+							if levels[k] not in temp1[k]:
+								temp1.insert(k, levels[k]+"unidentified")
+								confid.insert(k, 0)
+
+			j=0
+			temp2 = []
+			while j<len(temp1):
+				if  "unidentified" in temp1[j]:
+					del confid[j:]
+					break
+				elif confid[j]==9 and float(confid[j+1])<confidence:
+					del confid[j:]
+					break
+				elif float(confid[j])<confidence:
+					del confid[j:]
+					break
+				else:
+					temp2.append(temp1[j].capitalize())
+				j+=1
+
+			# remove "_sp" species classificaitons
+			if len(temp2)>0 and temp2[-1].endswith("_sp"):
+				del temp2[-1]
+				del confid[-1]
+			# remove terminal Incertae_sedis
+			while len(temp2)>0 and "Incertae_sedis" in temp2[-1]:
+				del temp2[-1]
+				del confid[-1]
+
+			confid = [str(x) if x!=9 else "NA" for x in confid]
+
+			new_taxonomy = []
+			for item in temp2:
+				new_taxonomy.append(item[2:].capitalize())
+
+			if confid == []:
+				score = "NA"
+			else:
+				score = confid[-1]
+
+			tax_confi = ""
+			for k in range(len(new_taxonomy)):
+				tax_confi += F"\t{new_taxonomy[k]}\t{confid[k]}"
+
+			output.write(F"{ID}\t{score}{tax_confi}\n")
+		else:
+			tax_confi = '\t'.join([""]*len(ranks)*2)
+			output.write(F"{ID}\t{0.0000}\t{tax_confi}\n")
+
+
+	output.close()
+	return output_file
+
+def _reformat_BLAST(blast_file, output_dir, confidence, max_hits, ethresh, p_iden_thresh, ranks):
+	output_file = F"{output_dir}/otu_taxonomy_blast_final.txt" # Filename for output
+	if ranks[0] == "Kingdom":
+		classification_buf = "Feature ID\tOTU_Score\tKingdom\tK_score\tPhylum\tP_score\tClass\tC_score"
+		classification_buf += "\tOrder\tO_score\tFamily\tF_score\tGenus\tG_score\tSpecies\tS_score\n"
+	else:
+		classification_buf = "Feature ID\tOTU_Score"
+		for r in ranks:
+			classification_buf += F"\t{r}\t{r.replace('ank_', '')}_score"
+		classification_buf += "\n"
+
+	blast_res = pd.read_csv(blast_file) # Read the input csv
+	blast_res = blast_res.astype({"e_value" : "float64", "query" : "str"})
+	uniq = pd.unique(blast_res["query"]) # List of all otus
+	for q in uniq:
+		q_list = [q.split(" ")[0], "0.0"] # OTU and placeholder confidence
+		q_sub = blast_res[(blast_res["query"] == q) & (blast_res["e_value"] <= ethresh) & (blast_res["percent_identity"] >= p_iden_thresh)] # Subset by OTU and e_values
+		if len(q_sub) == 0:
+			q_list.extend([""]*len(ranks)*2)
+		else:
+			q_sub = q_sub[:min([len(q_sub), max_hits])] # Take all hits or up to max_hits
+			for t in ranks:
+				if t not in q_sub.columns and t == "Kingdom":
+					t = "Domain"
+				vcs = q_sub[t].value_counts(normalize = True)
+				if len(vcs) == 0 or "unidentified" in vcs.index[0] or vcs.iloc[0] < confidence or (t == ranks[-1] and vcs.index[0].endswith("_sp")): # If unidentified, under conf thresh, or a species with "_sp", break
+				    break
+				else:
+					if "ncertae_sedis" in vcs.index[0]:
+					    q_list.extend(["Incertae_sedis", str(vcs.iloc[0])])
+					else:
+						q_list.extend([vcs.index[0], str(vcs.iloc[0])])
+					q_list[1] = str(vcs.iloc[0])
+		classification_buf += "\t".join(q_list) + "\n"
+	with open(output_file, "w") as ofile:
+	    ofile.write(classification_buf)
+	return output_file
+
+def _RDP_head_to_UTAX(lineage, format):
+	taxa = lineage.split(";")[1:]
+	out = ""
+	if format != "UNITE" and len(taxa) > 8: # Account for SILVA taxa which have too many ranks to be classified with SINTAX
+		taxa = taxa[:8]
+	for r in range(len(taxa)):
+		if format == "UNITE":
+			out = F"{out}{'dkpcofg'[r]}:{taxa[r]},"
+		else:
+			out = F"{out}{'dkpcofgs'[r]}:{taxa[r]},"
+
+	return out[:-1]
+
+def _add_full_lineage(filebase, format):
+	print("\n\tAdding Full Lineage\n\n")
+
+	with open(filebase+"__RDP_taxonomy_headers.txt", 'r') as f:
+		f1 = f.readlines()
+	hash = {} #lineage map
+
+	output_RDP = open(filebase+"__RDP_trained.fasta", 'w')
+	output_UTAX = open(filebase+"__UTAX.fasta", 'w')
+
+	for line in f1:
+		ID, lineage = line.strip().split("\t")
+		ID = ID.strip(">")
+		hash[ID] = lineage
+
+	with open(filebase+"__RDP.fasta", 'r') as f:
+		f2 = f.readlines()
+	for line in f2:
+		if line[0] == '>':
+			ID = line.strip().replace('>', '')
+			try:
+				lineage = hash[ID]
+			except KeyError:
+				print(ID, 'not in taxonomy file')
+				sys.exit()
+			output_RDP.write(F"{line.strip()}\t{lineage}\n")
+			output_UTAX.write(F"{line.strip()};tax={_RDP_head_to_UTAX(lineage, format)};\n")
+		else:
+			output_RDP.write(line.strip()+"\n")
+			output_UTAX.write(line.strip()+"\n")
+	output_RDP.close()
+	output_UTAX.close()
+
+def _lin_to_tax(file_base, format, dup=False):
+	print("\n\tTraining Taxonomy")
+	if dup:
+		print("\n\tDuplicate taxa being handled with numerical suffices")
+	with open(file_base+"__RDP_taxonomy.txt", 'r') as f:
+		line = f.readline()
+		cols = line.strip().split('\t')[1:] # Split the first line into columns
+		hash = {}#taxon name-id map
+		ranks = {}#column number-rank map
+		hash = {"Root":0}#initiate root rank taxon id map
+		for i in range(len(cols)): # Assign ranks based on column headers
+			ranks[i] = cols[i]
+		root = ['0', 'Root', '-1', '0', 'rootrank']#root rank info
+		with open(file_base+"__RDP_taxonomy_trained.txt", 'w') as output_file:
+			output_file.write("*".join(root)+"\n")
+		ID = 0 #taxon id
+		line = f.readline()
+		if format == "UNITE":
+			name_to_end = {}
+			if dup:
+				end_name_dict = {}
+			while line != "":
+				rec_count = 0
+				th_buf = "" # taxon header buffer
+				output_buf = "" # trained taxonomy buffer
+				while line != "" and rec_count < 10000: # Rec count to export when buffer is at 10000 records
+					rec_count += 1
+					acc = line.split('\t')[0]
+					cols = line.strip().split('\t')[1:]
+					header = F">{acc}\tRoot"
+					for i in range(len(cols)):#iterate each column
+						name = []
+						for node in cols[:i + 1]:
+							if not node == '-':
+								name.append(node)
+						pName = ";".join(name[:-1])
+						depth = len(name)
+						name = ";".join(name)
+						if name in hash: # Avoid repeated taxonomies
+							if name != prev_name:
+								prev_name = name
+								header += F";{name_to_end[name]}"
+							continue
+						prev_name = name
+						rank = ranks[i]
+						if i == 0:
+							pName = 'Root'
+						pID = hash[pName]#parent taxid
+						ID += 1
+						hash[name] = ID #add name-id to the map
+						end_name = name.split(';')[-1]
+						if dup:
+							if end_name not in end_name_dict:
+								end_name_dict[end_name] = 1
+								end_name = F"{end_name}_1"
+							else:
+								end_name_dict[end_name] += 1
+								end_name = F"{end_name}_{end_name_dict[end_name]}"
+						header = F"{header};{end_name}"
+						name_to_end[name] = end_name
+						output_buf = F"{output_buf}{ID}*{end_name}*{pID}*{depth}*{rank}\n"
+					th_buf = F"{th_buf}{header}\n"
+					line = f.readline()
+				with open(file_base+"__RDP_taxonomy_headers.txt", "a+") as taxon_headers:
+					taxon_headers.write(th_buf)
+				with open(file_base+"__RDP_taxonomy_trained.txt", "a+") as output_file:
+					output_file.write(output_buf)
+		else:
+			name_to_end = {}
+			end_name_dict = {}
+			while line != "":
+				rec_count = 0
+				th_buf = ""
+				output_buf = ""
+				while line != "" and rec_count < 10000:
+					rec_count += 1
+					acc = line.split('\t')[0]
+					cols = line.strip().split('\t')[1:]
+					header = F">{acc}\tRoot"
+					for i in range(len(cols)):#iterate each column
+						name = []
+						for node in cols[:i + 1]:
+							if not node == '-':
+								name.append(node)
+						pName = ";".join(name[:-1])
+						depth = len(name)
+						name = ";".join(name)
+						if name in hash:
+							if name != prev_name:
+								prev_name = name
+								header += F";{name_to_end[name]}"
+							continue
+						prev_name = name
+						rank = ranks[i]
+						if i == 0:
+							pName = 'Root'
+						pID = hash[pName]#parent taxid
+						ID += 1
+						hash[name] = ID #add name-id to the map
+						end_name = name.split(';')[-1]
+						# Allow for taxa which have more than 1 parent lineage
+						if end_name not in end_name_dict:
+							end_name_dict[end_name] = 1
+							end_name = F"{end_name}_1"
+						else:
+							end_name_dict[end_name] += 1
+							end_name = F"{end_name}_{end_name_dict[end_name]}"
+						header = F"{header};{end_name}"
+						name_to_end[name] = end_name
+						output_buf = F"{output_buf}{ID}*{end_name}*{pID}*{depth}*{rank}\n"
+					th_buf = F"{th_buf}{header}\n"
+					line = f.readline()
+				with open(file_base+"__RDP_taxonomy_headers.txt", "a+") as taxon_headers:
+					taxon_headers.write(th_buf)
+					print("Headers exported")
+				with open(file_base+"__RDP_taxonomy_trained.txt", "a+") as output_file:
+					output_file.write(output_buf)
+					print("Trained taxonomy exported")
+
+def _format_ref_db(db, tf, format, dup=False):
+    filename = db
+    filename_base = tf + "/" + ".".join(os.path.basename(filename).split(".")[:-1])
+    print("\n____________________________________________________________________\nReformatting database\n")
+    start = time.process_time()
+    fasta = open(filename_base+"__RDP.fasta","w")
+    taxon_fn = filename_base+"__RDP_taxonomy.txt"
+    taxon = open(taxon_fn,"w")
+    print(F"{format} format detected\n")
+    if format == "UNITE":
+    	taxon.write("Seq_ID\tKingdom\tPhylum\tClass\tOrder\tFamily\tGenus\tSpecies\n")
+
+    	num = 0
+    	with open(filename) as database:
+    		for line in database:
+    			if line[0] == ">":
+    				#correct umlauts or special letters
+    				ascii_line = unicodedata.normalize('NFKD', line).encode('ASCII', 'ignore')
+    				temp = ascii_line.decode()[1:].split("|")
+
+    				#RDP files
+    				name = str(temp[1])
+    				temp2 = temp[4].strip().split("__")
+    				to_genus = [ item[:-2] for item in temp2[1:-1] ]
+
+    				if "Incertae_sedis" in to_genus:
+    					indices = [i for i,x in enumerate(to_genus) if x == "Incertae_sedis"]
+    					for j in indices:
+    						if "Incertae_sedis" not in to_genus[j-1]:
+    							to_genus[j] = str(to_genus[j-1])+"_Incertae_sedis"
+    						else:
+    							to_genus[j] = str(to_genus[j-1])
+    				if "unidentified" in to_genus:
+    					indices = [i for i,x in enumerate(to_genus) if x == "unidentified"]
+    					for j in indices:
+    						to_genus[j] = "-"
+
+    				if to_genus[0] != "-":
+    					species = str(temp2[-1])
+    					if "Incertae" in species:
+    						species = "unidentified_sp"
+    					elif to_genus[-1] not in species:
+    						temp=species.split("_")
+    						species = temp[0]+"_unidentified_"+temp[1]
+    					if species.endswith("sp"):
+    						species+= "_"+str(num)
+    						num += 1
+
+    					taxonomy = name+"\t"+"\t".join(to_genus)+"\t"+species+"\n"
+    					fasta.write(">"+name+"\n")
+    					taxon.write(taxonomy)
+    					seq = next(database)
+    					fasta.write(seq)
+    	fasta.close()
+    	taxon.close()
+
+    else:
+    	max_rank = 1
+    	with open(filename, "r") as database:
+    		line = database.readline()
+    		while line != "":
+    			t_list = line.strip().split(";")
+    			if len(t_list) > max_rank:
+    				max_rank = len(t_list)
+    			line = database.readline()
+    	taxon.write("Seq_ID\t" + "\t".join([F"Rank_{x}" for x in range(1, max_rank+1)]) + "\n")
+    	with open(filename, "r") as database:
+    		line = database.readline()
+    		while line != "":
+    			line = line.replace(" Bacteria;", "?Bacteria;").replace(" Eukaryota;", "?Eukaryota;").replace(" Archaea;", "?Archaea;").replace(" ", "_")
+    			ascii_line = unicodedata.normalize('NFKD', line).encode('ASCII', 'ignore')
+    			# temp = ascii_line.decode().replace("*", "_").replace("'", "").replace(",", "").replace("Oral_Taxon", "oral_taxon")[1:].split("?")
+    			temp = ascii_line.decode().translate(str.maketrans("*,<>", "_   ")).replace("Oral_Taxon", "oral_taxon").replace("'","")[1:].split("?")
+
+    			name = str(temp[0]).split(".")[0]
+    			t_list = temp[1].strip().split(";")
+
+    			if "unidentified" in t_list:
+    				indices = [i for i,x in enumerate(t_list) if x == "unidentified"]
+    				non_unid = [i for i,x in enumerate(t_list) if x != "unidentified"]
+    				for j in indices:
+    					t_list[j] = "-"
+    				if t_list[-1] == "-": # if lowest rank in unidentified, add the lowest identified rank to the lowest taxa
+    				    t_list[-1] = t_list[non_unid[-1]] + "_unidentified"
+
+    			if len(t_list) < max_rank:
+    				t_list = t_list[:-1] + ["-"]*(max_rank - len(t_list)) + [t_list[-1]] # fill in missing ranks
+
+
+    			taxonomy = name+"\t"+"\t".join(t_list)+"\n"
+    			fasta.write(">"+name+"\n")
+    			taxon.write(taxonomy)
+    			line = database.readline()
+    			seq = ""
+    			while line != "" and line[0] != ">":
+    				seq += line.strip()
+    				line = database.readline()
+    			seq = seq.replace("U", "T")
+    			fasta.write(seq + "\n")
+
+    	fasta.close()
+    	taxon.close()
+
+    print(F"Reference database FASTAs formatted in {time.process_time() - start} seconds...\n")
+
+    os.remove(F"{filename_base}__RDP_taxonomy_trained.txt")
+    os.remove(F"{filename_base}__RDP_taxonomy_headers.txt")
+
+    _lin_to_tax(filename_base, format, dup)
+    _add_full_lineage(filename_base, format)
+
+    print("Database formatting complete\n____________________________________________________________________\n\n")
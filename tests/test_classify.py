@@ -0,0 +1,82 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, sys, json, stat, tempfile, unittest, importlib.util
+
+RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+LINEAGE = ["Fungi", "Basidiomycota", "Agaricomycetes", "Russulales", "Russulaceae", "Russula", "Russula_rosea"]
+
+# Stand-ins for the classifiers: every query gets LINEAGE, in each tool's output layout
+TOOLS = {
+    "vsearch" : '''
+args = sys.argv[1:]
+with open(args[args.index("-sintax") + 1]) as ifile, open(args[args.index("-tabbedout") + 1], "w") as ofile:
+    for line in ifile:
+        if line[0] == ">":
+            preds = ",".join([F"{l}:{t}(1.00)" for l, t in zip("dkpcofg", LINEAGE)])
+            ofile.write(F"{line[1:].strip()}\\t{preds}\\t+\\t{preds}\\n")
+''',
+    "blastn" : '''
+lineage = ";".join(["Root"] + LINEAGE)
+for line in sys.stdin:
+    if line[0] == ">":
+        ID = line[1:].strip()
+        sys.stdout.write(F"# BLASTN 2.12.0+\\n# Query: {ID}\\n# Database: ref\\n# 1 hits found\\n")
+        sys.stdout.write(F"{ID}\\tref_1\\t1e-50\\t200\\t100.000\\t100\\t{lineage}\\n")
+''',
+    "classifier" : '''
+args = sys.argv[1:]
+with open(args[args.index("-o") + 2]) as ifile, open(args[args.index("-o") + 1], "w") as ofile:
+    for line in ifile:
+        if line[0] == ">":
+            preds = "".join([F"\\t{t}\\t{r.lower()}\\t1.0" for t, r in zip(LINEAGE, RANKS)])
+            ofile.write(F"{line[1:].strip()}\\t\\tRoot\\trootrank\\t1.0{preds}\\n")
+''',
+}
+
+@unittest.skipUnless(importlib.util.find_spec("qiime2") and importlib.util.find_spec("q2_types"), "QIIME 2 is not installed")
+class ClassifySmokeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.environ["PATH"]
+        self.cwd = os.getcwd()
+        bin_dir = os.path.join(self.tmp.name, "bin")
+        os.mkdir(bin_dir)
+        for name, body in TOOLS.items():
+            with open(os.path.join(bin_dir, name), "w") as ofile:
+                ofile.write(F"#!{sys.executable}\nimport sys\nRANKS = {RANKS!r}\nLINEAGE = {LINEAGE!r}\n{body}")
+            os.chmod(os.path.join(bin_dir, name), stat.S_IRWXU)
+        os.environ["PATH"] = bin_dir + os.pathsep + self.path
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ["PATH"] = self.path
+        self.tmp.cleanup()
+
+    def test_classify_end_to_end(self):
+        from ..classify import classify
+        tf = os.path.join(self.tmp.name, "training_files")
+        os.mkdir(tf)
+        with open(os.path.join(tf, "ref__RDP_taxonomy.txt"), "w") as ofile:
+            ofile.write("Seq_ID\t" + "\t".join(RANKS) + "\nref_1\t" + "\t".join(LINEAGE) + "\n")
+        training_result = os.path.join(tf, "training_result.json")
+        with open(training_result, "w") as ofile:
+            json.dump({"sintax_database" : F"{tf}/sintax.db", "blast_database" : F"{tf}/ref__BLAST",
+                       "rdp_path" : F"{tf}/", "format" : "UNITE", "blast_version" : "2.12.0+"}, ofile)
+        with open("otus.fasta", "w") as ofile:
+            ofile.write(">OTU_1\nACGTACGTACGTACGTACGT\n>OTU_2\nGGGTACGTACGTACGTACGT\n>OTU_3\nACGTACGTACGTACGTACGT\n")
+
+        result = classify(None, "otus.fasta", training_result, output_dir="output", tax="taxonomy_assignments", tf=tf)
+        self.assertEqual(list(result["Feature ID"]), ["OTU_1", "OTU_2", "OTU_3"])
+        self.assertEqual(list(result["Genus"]), ["Russula"]*3)
+        for name in ["constax_taxonomy.txt", "combined_taxonomy.txt", "Classification_Summary.txt"]:
+            self.assertTrue(os.path.isfile(os.path.join("output", name)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, random, tempfile, unittest
+from .._combine import (_count_classifications, _final_header, _vote, _vote_batch, _reformat_RDP, _reformat_SINTAX,
+    _reformat_UTAX, _reformat_BLAST, _rdp_line, _sintax_line, _utax_line)
+from .._table import _TaxonomyTable, _TaxonVocabulary
+from . import _baseline
+
+UNITE_RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+TAXA = ["Fungi", "Ascomycota", "Basidiomycota", "Agaricales", "Russula", "Russula_rosea", "Russula_sp2", "Incertae_sedis", ""]
+
+def _final_rows(rng, otus, ranks):
+    # otu_taxonomy_*_final.txt rows, some with empty taxon cells between classified ranks
+    rows = []
+    for otu in otus:
+        width = rng.randint(0, len(ranks))
+        cells = [F"\t{rng.choice(TAXA)}\t{rng.choice(['1.0000', '0.85', 'NA'])}" for k in range(width)]
+        rows.append(F"{otu}\t{rng.choice(['NA', '0.85', '0.0'])}{''.join(cells)}\n")
+    return rows
+
+SILVA_RANKS = [F"Rank_{i}" for i in range(1, 9)]
+NAMES = ["Fungi", "Ascomycota", "Sordariomycetes", "unidentified", "Incertae_sedis", "Agaricales_fam_Incertae_sedis", "Russula", "Russula_sp", "Mortierella_alpina"]
+CONFIDENCES = ["1.0000", "0.9700", "0.8000", "0.7999", "0.5000"]
+
+def _scored(rng, letters):
+    return ",".join([F"{l}:{rng.choice(NAMES)}({rng.choice(CONFIDENCES)})" for l in letters])
+
+def _rdp_output(rng, otu):
+    # allrank output with at least one rank below Root
+    triples = [F"\t{rng.choice(NAMES + ['Russula sp'])}\trank\t{rng.choice(['1.0', '0.97', '0.8', '0.5'])}" for r in range(rng.randint(1, 7))]
+    return F"{otu}\t\tRoot\trootrank\t1.0{''.join(triples)}\n"
+
+def _sintax_output(rng, otu):
+    letters = rng.choice(["dkpcofgs", "dpcofgs", "dkpcfgs"])
+    return F"{otu}\t{_scored(rng, letters[:rng.randint(0, len(letters))])}\t+\t\n"
+
+def _utax_output(rng, otu):
+    # an unscored domain followed by at least one scored rank
+    return F"{otu}\td:{rng.choice(NAMES)},{_scored(rng, 'pcofgs'[:rng.randint(1, 6)])}\t+\n"
+
+def _blast_csv(rng, ranks, queries):
+    # Hit tables in the csv layout, with ties, failing hits and missing ranks. A
+    # Kingdom column is named Domain, as in the SILVA-style headers.
+    columns = ["Domain" if r == "Kingdom" else r for r in ranks]
+    rows = ["query,subject,e_value,bitscore,percent_identity,query_coverage," + ",".join(columns) + "\n"]
+    for i in range(queries):
+        for j in range(rng.randint(1, 12)):
+            taxa = [rng.choice([F"{r}_{rng.randint(1, 2)}", "unidentified", "Agaricales_fam_Incertae_sedis", F"{r}_sp", ""]) for r in ranks]
+            rows.append(F"OTU_{i} extra,ref_{j},{rng.choice(['1e-50', '1e-05', '0.5', '2.0'])},200,{rng.choice(['0.9', '0.97', '1.0'])},100," + ",".join(taxa) + "\n")
+    return rows
+
+class CountClassificationsTest(unittest.TestCase):
+    def test_tables_match_final_files(self):
+        rng = random.Random(8)
+        otus = [F"OTU_{i}" for i in range(300)]
+        for ranks, format in [(UNITE_RANKS, "UNITE"), ([F"Rank_{i}" for i in range(1, 9)], "SILVA")]:
+            with tempfile.TemporaryDirectory() as tmp:
+                vocab = _TaxonVocabulary()
+                files, tables = [], []
+                for name in ["rdp", "sintax", "blast"]:
+                    rows = _final_rows(rng, otus, ranks)
+                    files.append(os.path.join(tmp, F"otu_taxonomy_{name}_final.txt"))
+                    with open(files[-1], "w") as ofile:
+                        ofile.write(_final_header(ranks))
+                        ofile.writelines(rows)
+                    tables.append(_TaxonomyTable(ranks, vocab))
+                    for row in rows:
+                        tables[-1].add_row(row)
+                consensus = os.path.join(tmp, "constax_taxonomy.txt")
+                with open(consensus, "w") as ofile:
+                    ofile.write("Feature ID" + "".join([F"\t{r}" for r in ranks]) + "\n")
+                    for otu in otus:
+                        ofile.write(otu + "".join([F"\t{rng.choice(TAXA)}" for r in ranks]) + "\n")
+                outputs = {}
+                for label, count, sources in [("old", _baseline._count_classifications, files), ("new", _count_classifications, tables)]:
+                    os.mkdir(os.path.join(tmp, label))
+                    count(sources + [consensus], os.path.join(tmp, label), format, len(ranks), use_blast=True)
+                    outputs[label] = [open(os.path.join(tmp, label, x)).read() for x in ["Classification_Summary.txt", "otu_taxonomy_CountClassified.txt"]]
+                self.assertEqual(outputs["old"], outputs["new"])
+
+class VoteBatchTest(unittest.TestCase):
+    def _tables(self, rows, ranks):
+        vocab = _TaxonVocabulary()
+        tables = [_TaxonomyTable(ranks, vocab) for i in range(3)]
+        for table, table_rows in zip(tables, rows):
+            for row in table_rows:
+                table.add_row(row)
+        return tables
+
+    def _check(self, tables, ranks):
+        otus = tables[0].keys()
+        for conservative in [False, True]:
+            winners = _vote_batch(tables, otus, conservative)
+            for i, otu in enumerate(otus):
+                rows = [t[otu] for t in tables]
+                expected = [_vote(*[row[k*2:k*2 + 2] for row in rows], conservative) for k in range(len(ranks))]
+                self.assertEqual([tables[0].vocab.names[x] for x in winners[i]], expected, F"{otu} conservative={conservative}")
+
+    def test_matches_vote_on_generated_tables(self):
+        rng = random.Random(9)
+        ranks = UNITE_RANKS[:5]
+        taxa = ["Fungi", "Ascomycota", "Basidiomycota", "NA", ""]
+        scores = ["1.0", "0.9", "0.85", "NA", ""]
+        otus = [F"OTU_{i}" for i in range(500)]
+        rows = [[otu + "\t0.9" + "".join([F"\t{rng.choice(taxa)}\t{rng.choice(scores)}" for r in ranks]) + "\n" for otu in otus] for i in range(3)]
+        self._check(self._tables(rows, ranks), ranks)
+
+    def test_no_call_and_ties(self):
+        ranks = UNITE_RANKS[:2]
+        rows = [["OTU_1\t1.0\tFungi\t1.0\tAscomycota\t0.9\n", # one classifier without a call
+                 "OTU_2\t0.9\tFungi\t0.9\tAscomycota\t0.9\n",  # tied scores, third classifier empty
+                 "OTU_3\t0.9\tFungi\t0.9\tAscomycota\t0.9\n",  # tied scores, second classifier empty
+                 "OTU_4\t0.9\tFungi\t0.9\tAscomycota\t0.9\n",  # three different taxa
+                 "OTU_5\t0.5\n"],                              # tied scores, first classifier empty
+                ["OTU_1\tNA\n",
+                 "OTU_2\t0.9\tFungi\t0.9\tBasidiomycota\t0.9\n",
+                 "OTU_3\t0.9\n",
+                 "OTU_4\t0.9\tFungi\t0.9\tBasidiomycota\t0.9\n",
+                 "OTU_5\t0.5\tFungi\t0.5\tAscomycota\t0.5\n"],
+                ["OTU_1\t1.0\tFungi\t0.8\n",
+                 "OTU_2\t0.9\n",
+                 "OTU_3\t0.9\tFungi\t0.9\tBasidiomycota\t0.9\n",
+                 "OTU_4\t0.9\tFungi\t0.9\tGlomeromycota\t0.9\n",
+                 "OTU_5\t0.5\tFungi\t0.5\tBasidiomycota\t0.5\n"]]
+        self._check(self._tables(rows, ranks), ranks)
+
+class ReformatTest(unittest.TestCase):
+    def test_matches_previous_reformatters(self):
+        rng = random.Random(6)
+        cases = [("rdp", _rdp_output, _baseline._reformat_RDP, _reformat_RDP),
+                 ("sintax", _sintax_output, _baseline._reformat_SINTAX, _reformat_SINTAX),
+                 ("utax", _utax_output, _baseline._reformat_UTAX, _reformat_UTAX)]
+        for name, output, old, new in cases:
+            for ranks in [UNITE_RANKS, SILVA_RANKS]:
+                with tempfile.TemporaryDirectory() as tmp:
+                    classifier_file = os.path.join(tmp, F"otu_taxonomy.{name}")
+                    with open(classifier_file, "w") as ofile:
+                        ofile.writelines([output(rng, F"OTU_{i}") for i in range(300)])
+                    os.mkdir(os.path.join(tmp, "old"))
+                    os.mkdir(os.path.join(tmp, "new"))
+                    with open(old(classifier_file, os.path.join(tmp, "old"), 0.8, ranks)) as ifile:
+                        expected = ifile.read()
+                    with open(new(classifier_file, os.path.join(tmp, "new"), 0.8, ranks)[0]) as ifile:
+                        self.assertEqual(ifile.read(), expected, F"{name} {ranks[0]}")
+
+    def test_blast_matches_previous_reformatter(self):
+        rng = random.Random(4)
+        for ranks, format in [(UNITE_RANKS, "UNITE"), (SILVA_RANKS, "SILVA")]:
+            for max_hits, ethresh, p_iden in [(10, 1., 0.), (3, 1e-5, 0.95)]:
+                with tempfile.TemporaryDirectory() as tmp:
+                    blast_file = os.path.join(tmp, "otu_taxonomy.blast")
+                    with open(blast_file, "w") as ofile:
+                        ofile.writelines(_blast_csv(rng, ranks, 200))
+                    os.mkdir(os.path.join(tmp, "old"))
+                    os.mkdir(os.path.join(tmp, "new"))
+                    with open(_baseline._reformat_BLAST(blast_file, os.path.join(tmp, "old"), 0.8, max_hits, ethresh, p_iden, ranks)) as ifile:
+                        expected = ifile.read()
+                    new = _reformat_BLAST(blast_file, os.path.join(tmp, "new"), 0.8, max_hits, ethresh, p_iden, ranks, format=format)[0]
+                    with open(new) as ifile:
+                        self.assertEqual(ifile.read(), expected, F"{ranks[0]} max_hits={max_hits}")
+
+    def test_lines(self):
+        self.assertEqual(_rdp_line("OTU_1\t\tRoot\trootrank\t1.0\tFungi\tkingdom\t1.0\tAscomycota\tphylum\t0.5\n", 0.8, UNITE_RANKS),
+                         "OTU_1\t1.0\tFungi\t1.0\n")
+        # SINTAX does not report its lowest prediction, but its score is the OTU score
+        self.assertEqual(_sintax_line("OTU_2\td:Fungi(1.0000),k:Fungi(1.0000),p:Ascomycota(0.9700),c:Leotiomycetes(0.5000)\t+\t\n", 0.8, UNITE_RANKS),
+                         "OTU_2\t0.5000\tFungi\t1.0000\tFungi\t1.0000\tAscomycota\t0.9700\n")
+        self.assertEqual(_utax_line("OTU_3\td:Fungi,p:Ascomycota(0.9700),c:Leotiomycetes(0.5000)\t+\n", 0.8, UNITE_RANKS),
+                         "OTU_3\t0.9700\tFungi\tNA\tAscomycota\t0.9700\n")
+
+    def test_rows_fixed_since_previous_reformatters(self):
+        # The previous UTAX reformatter wrote "OTU_4\td:Fungi" into the ID column of
+        # domain-only lines, and the RDP one reported Root's confidence when nothing
+        # below Root was classified
+        self.assertEqual(_utax_line("OTU_4\td:Fungi\t+\td:Fungi\n", 0.8, UNITE_RANKS), "OTU_4\t0\tFungi\tNA\n")
+        self.assertEqual(_rdp_line("OTU_5\t\tRoot\trootrank\t1.0\n", 0.8, UNITE_RANKS), "OTU_5\tNA\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, random, tempfile, unittest
+from .._format_data import _format_ref_db
+from . import _baseline
+
+TAXA = ["Proteobacteria", "Gammaproteobacteria", "Enterobacterales", "Enterobacteriaceae", "unidentified",
+        "Candidatus Müller", "Clade*1", "Family<2>", "Order,3", "Saccharomyces'", "Oral Taxon 123", "uncultured"]
+
+def _silva_fasta(rng, records):
+    # SILVA-style headers of varying depth, with multi-line RNA sequences
+    lines = []
+    for i in range(records):
+        domain = rng.choice(["Bacteria", "Eukaryota", "Archaea"])
+        taxa = [rng.choice(TAXA) for r in range(rng.randint(1, 7))]
+        species = rng.choice(["Escherichia coli", "unidentified", "Müller's bacterium"])
+        lines.append(F">AB{i:05d}.1.{rng.randint(900, 1500)} {';'.join([domain] + taxa + [species])}\n")
+        lines.extend(["".join(rng.choice("ACGU") for n in range(rng.randint(10, 60))) + "\n" for k in range(rng.randint(1, 3))])
+    return lines
+
+class FormatRefDBTest(unittest.TestCase):
+    def test_silva_matches_two_pass_formatter(self):
+        rng = random.Random(11)
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, "silva.fasta")
+            with open(db, "w", encoding="utf-8") as ofile:
+                ofile.writelines(_silva_fasta(rng, 500))
+            outputs = {}
+            for label in ["old", "new"]:
+                tf = os.path.join(tmp, label)
+                os.mkdir(tf)
+                if label == "old":
+                    # the previous formatter removed these before training the taxonomy
+                    for suffix in ["__RDP_taxonomy_trained.txt", "__RDP_taxonomy_headers.txt"]:
+                        open(os.path.join(tf, "silva" + suffix), "w").close()
+                    _baseline._format_ref_db(db, tf, "SILVA")
+                else:
+                    _format_ref_db(db, tf, "SILVA", lineage=False)
+                outputs[label] = [open(os.path.join(tf, "silva" + suffix)).read() for suffix in ["__RDP.fasta", "__RDP_taxonomy.txt"]]
+            self.assertEqual(outputs["old"], outputs["new"])
+
+if __name__ == "__main__":
+    unittest.main()
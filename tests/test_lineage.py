@@ -0,0 +1,56 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, random, tempfile, unittest
+from .._lineage import _lin_to_tax
+from . import _baseline
+
+UNITE_RANKS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+# Few names per rank, so lineages share prefixes and names recur under other parents
+NAMES = [["Fungi", "Metazoa"], ["Ascomycota", "Basidiomycota"], ["Leotiomycetes", "Agaricomycetes"],
+         ["Helotiales", "Agaricales", "Incertae_sedis"], ["Fam_1", "Fam_2", "Incertae_sedis"], ["Gen_1", "Gen_2", "Helotiales"], ["Sp_1", "Sp_2", "Gen_1"]]
+
+def _taxonomy_rows(rng, ranks, records):
+    # Every record has at least two named ranks; see test_repeated_first_taxon
+    rows = []
+    for i in range(records):
+        cols = ["-"]*len(ranks)
+        while len([x for x in cols if x != "-"]) < 2:
+            cols = [rng.choice(NAMES[k % len(NAMES)]) if rng.random() > 0.15 else "-" for k in range(len(ranks))]
+        rows.append(F"SH{i:05d}\t" + "\t".join(cols) + "\n")
+    return rows
+
+def _train(tmp, label, train, rows, ranks, format, dup):
+    base = os.path.join(tmp, label, "ref")
+    os.mkdir(os.path.join(tmp, label))
+    with open(base + "__RDP_taxonomy.txt", "w") as ofile:
+        ofile.write("Seq_ID\t" + "\t".join(ranks) + "\n")
+        ofile.writelines(rows)
+    train(base, format, dup)
+    return [open(base + suffix).read() for suffix in ["__RDP_taxonomy_trained.txt", "__RDP_taxonomy_headers.txt"]]
+
+class LinToTaxTest(unittest.TestCase):
+    def test_matches_previous_trainer(self):
+        rng = random.Random(12)
+        for ranks, format, dup in [(UNITE_RANKS, "UNITE", False), (UNITE_RANKS, "UNITE", True), ([F"Rank_{i}" for i in range(1, 9)], "SILVA", False)]:
+            rows = _taxonomy_rows(rng, ranks, 2000)
+            with tempfile.TemporaryDirectory() as tmp:
+                self.assertEqual(_train(tmp, "new", _lin_to_tax, rows, ranks, format, dup),
+                                 _train(tmp, "old", _baseline._lin_to_tax, rows, ranks, format, dup), F"{format} dup={dup}")
+
+    def test_repeated_first_taxon(self):
+        # The previous trainer compared a record's first taxon with the deepest lineage of
+        # the record before it, and left Fungi out of the second header
+        rows = ["SH1\tFungi\t-\t-\t-\t-\t-\t-\n", "SH2\tFungi\tAscomycota\t-\t-\t-\t-\t-\n"]
+        with tempfile.TemporaryDirectory() as tmp:
+            trained, headers = _train(tmp, "new", _lin_to_tax, rows, UNITE_RANKS, "UNITE", False)
+        self.assertEqual(headers, ">SH1\tRoot;Fungi\n>SH2\tRoot;Fungi;Ascomycota\n")
+        self.assertEqual(trained, "0*Root*-1*0*rootrank\n1*Fungi*0*1*Kingdom\n2*Ascomycota*1*2*Phylum\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2020-2022, JAL&GMNB&GMB
+#
+# Distributed under the terms of the MIT License.
+#
+# The full license in the file LICENSE, distributed with this software.
+# -------------------------------------------------------------------------
+
+import os, tempfile, unittest, warnings
+from .._query_cache import (_OUTPUTS, _QueryCache, _dereplicate, _split_queries, _merge_outputs, _expand_outputs)
+
+KINDS = ["rdp", "sintax", "blast", "isolates"]
+
+def _write_fasta(path, records):
+    with open(path, "w") as ofile:
+        ofile.writelines([F">{ID}\n{seq}\n" for ID, seq in records])
+
+def _read_fasta(path):
+    records = []
+    with open(path, "r") as ifile:
+        for line in ifile:
+            if line[0] == ">":
+                records.append([line[1:].strip(), ""])
+            else:
+                records[-1][1] += line.strip()
+    return records
+
+def _classify(fasta, tax, skip=()):
+    # Stand-in for the classifiers: output depends on the sequence, in each tool's layout
+    records = _read_fasta(fasta)
+    with open(os.path.join(tax, _OUTPUTS["rdp"]), "w") as ofile:
+        ofile.writelines([F"{ID}\t\tRoot\trootrank\t1.0\tT_{seq[:4]}\tgenus\t0.9\n" for ID, seq in records if ID not in skip])
+    with open(os.path.join(tax, _OUTPUTS["sintax"]), "w") as ofile:
+        ofile.writelines([F"{ID}\tg:T_{seq[:4]}(0.90)\t+\tg:T_{seq[:4]}\n" for ID, seq in records])
+    for kind in ["blast", "isolates"]:
+        with open(os.path.join(tax, _OUTPUTS[kind]), "w") as ofile:
+            for ID, seq in records:
+                ofile.write(F"# BLASTN 2.12.0+\n# Query: {ID}\n# Database: {kind}\n# 1 hits found\n")
+                ofile.write(F"{ID}\t{kind}_{seq[:4]}\t1e-50\t200\t{len(seq)}.0\t100\t{kind}_{seq[:4]}\n")
+            ofile.write(F"# BLAST processed {len(records)} queries\n")
+
+def _outputs(tax):
+    # BLAST ends each run with a count of the queries in it, which depends on how the
+    # queries were split up and is not part of any query's result
+    outputs = {}
+    for kind in KINDS:
+        with open(os.path.join(tax, _OUTPUTS[kind]), "r") as ifile:
+            outputs[kind] = [line for line in ifile if not line.startswith("# BLAST processed")]
+    return outputs
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.cache = _QueryCache(os.path.join(self.dir, "cache.sqlite"), 2**20)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp.cleanup()
+
+    def _tax(self, name):
+        tax = os.path.join(self.dir, name)
+        os.makedirs(tax)
+        return tax
+
+    def _reference(self, records, name):
+        # Every query classified, without dereplication or the cache
+        tax = self._tax(name)
+        queries = os.path.join(tax, "inputs.fasta")
+        _write_fasta(queries, records)
+        _classify(queries, tax)
+        return _outputs(tax)
+
+    def _cached(self, records, name, skip=()):
+        # The classify pipeline: dereplicate, look up the cache, classify the misses,
+        # merge in the cached results and copy them back to every member
+        tax = self._tax(name)
+        queries = os.path.join(tax, "inputs.fasta")
+        _write_fasta(queries, records)
+        members = _dereplicate(queries, os.path.join(tax, "unique_inputs.fasta"))
+        order, hits, misses = _split_queries(os.path.join(tax, "unique_inputs.fasta"), self.cache, "fingerprint", os.path.join(tax, "uncached_inputs.fasta"))
+        if misses > 0:
+            _classify(os.path.join(tax, "uncached_inputs.fasta"), tax, skip)
+        _merge_outputs(tax, KINDS, order, hits, self.cache)
+        _expand_outputs(tax, KINDS, members)
+        return _outputs(tax), misses
+
+    def test_matches_uncached_run(self):
+        records = [("q1", "ACGTACGTAA"), ("q2", "GGGTACGTAA"), ("q3", "ACGTACGTAA"), ("q4", "TTTTACGTAA"), ("q5", "ACGTACGTAA")]
+        outputs, misses = self._cached(records, "cold")
+        self.assertEqual(misses, 3)
+        self.assertEqual(outputs, self._reference(records, "reference"))
+
+        # The same sequences under other IDs and in another order are all served from the cache
+        renamed = [("s9", "TTTTACGTAA"), ("s1", "ACGTACGTAA"), ("s2", "GGGTACGTAA"), ("s3", "GGGTACGTAA"), ("s4", "CCCCACGTAA")]
+        outputs, misses = self._cached(renamed, "warm")
+        self.assertEqual(misses, 1)
+        self.assertEqual(outputs, self._reference(renamed, "reference_renamed"))
+
+    def test_incomplete_output_not_cached(self):
+        records = [("q1", "ACGTACGTAA"), ("q2", "GGGTACGTAA")]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self._cached(records, "partial", skip=("q2",))
+        self.assertTrue(any(["not cached" in str(w.message) for w in caught]))
+        outputs, misses = self._cached(records, "retry")
+        self.assertEqual(misses, 1)
+        self.assertEqual(outputs, self._reference(records, "reference"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,13 +5,17 @@
 #
 # The full license in the file LICENSE, distributed with this software.
 # -------------------------------------------------------------------------
-import subprocess, os, json
+import subprocess, os, json, functools, glob, shutil
 
 from q2_types.feature_data import (FeatureData, Taxonomy, Sequence, DNAIterator, DNAFASTAFormat)
-from qiime2.plugin import Int, Str, Float, Choices, Range, TextFileFormat, SemanticType, BinaryFileFormat
+from qiime2.plugin import Int, Str, Float, Bool, Choices, Range, TextFileFormat, SemanticType, BinaryFileFormat
 import qiime2.plugin.model as model
 from .plugin_setup import plugin, citations
-from ._format_data import _format_ref_db, _detect_format
+from ._format_data import _format_ref_db, _detect_format, _ref_base, _diff_ref_db, _subset_ref_db
+from ._compressed import _compression
+from ._lineage import _lin_to_tax, _add_full_lineage
+from ._cache import _TrainingCache, _file_digest, _key, _tool_versions
+from ._parallel import _run_logged, _run_stages
 
 # https://github.com/qiime2/q2-types/issues/49
 # From https://github.com/qiime2/q2-feature-classifier/blob/master/q2_feature_classifier/_taxonomic_classifier.py
@@ -55,55 +59,185 @@ def _2(data: dict) -> JSONFormat:
         json.dump(data, fh)
     return result
 
-def train(db : DNAFASTAFormat, tf : str, mem : int) -> dict:
-    db.file.view(DNAFASTAFormat)
-    training_dict = {'sintax_database' : F'{tf}/sintax.db',
-                     'blast_database' : F'{tf}/{db_base}__BLAST',
-                     'rdp_path' : F'{tf}/'}
-    #python "$CONSTAXPATH"/FormatRefDB.py -d "$DB" -t "$TFILES" -f $FORMAT -p "$CONSTAXPATH"
-    format = _detect_format(db)
-    training_dict["format" : format]
-    _format_ref_db(db, tf, format, dup=False)
-    db_base = os.path.basename(db).split(".")[0]
-    print("__________________________________________________________________________\nTraining SINTAX Classifier")
-
+def _train_sintax(tf, db_base, cache, key):
     #  "$SINTAXPATH" -makeudb_usearch "${TFILES}/${base}"__UTAX.fasta -output ${TFILES}/sintax.db
     cmd = ['vsearch', '-makeudb_usearch', F'{tf}/{db_base}__UTAX.fasta', '-output', F'{tf}/sintax.db']
-    subprocess.run(cmd, check=True)
+    _run_logged(cmd, F'{tf}/sintax_train.log')
+    cache.update("sintax", key)
 
-    print("__________________________________________________________________________\nTraining BLAST Classifier")
+def _write_blast_alias(tf, db_base, volumes):
+    # Classification always opens {db_base}__BLAST, an alias over the volumes built so far
+    with open(F'{tf}/{db_base}__BLAST.nal', 'w') as ofile:
+        ofile.write(F"TITLE {db_base}__BLAST\nDBLIST " + " ".join([F'{db_base}__BLAST_{n}' for n in range(volumes)]) + "\n")
+
+def _train_blast(tf, db_base, cache, key):
     # makeblastdb -in "${TFILES}/${base}"__RDP_trained.fasta -dbtype nucl -out "${TFILES}/${base}"__BLAST
-    cmd = ['makeblastdb', '-in', F'{tf}/{db_base}__RDP_trained.fasta', '-dbtype', 'nucl', '-out', F'{tf}/{db_base}__BLAST']
+    cmd = ['makeblastdb', '-in', F'{tf}/{db_base}__RDP_trained.fasta', '-dbtype', 'nucl', '-out', F'{tf}/{db_base}__BLAST_0']
     try:
-        subprocess.run(cmd, check=True)
+        _run_logged(cmd, F'{tf}/blast_train.log')
+        for stale in glob.glob(F'{tf}/{db_base}__BLAST.*') + glob.glob(F'{tf}/{db_base}__BLAST_[1-9]*'):
+            os.remove(stale)
+        _write_blast_alias(tf, db_base, 1)
+        cache.update("blast", key, blast_volumes=1)
     except subprocess.CalledProcessError as e:
         print(str(e))
-    print("__________________________________________________________________________\nTraining RDP Classifier")
+
+def _extend_blast(tf, db_base, fasta, cache, key):
+    volume = cache.entries.get("blast_volumes", 1)
+    cmd = ['makeblastdb', '-in', fasta, '-dbtype', 'nucl', '-out', F'{tf}/{db_base}__BLAST_{volume}']
+    try:
+        _run_logged(cmd, F'{tf}/blast_train.log')
+        _write_blast_alias(tf, db_base, volume + 1)
+        cache.update("blast", key, blast_volumes=volume + 1)
+    except subprocess.CalledProcessError as e:
+        print(str(e))
+
+def _train_rdp(tf, db_base, mem, cache, key, rdp_version, errors):
     #"$RDPPATH" train -o "${TFILES}/." -s "${TFILES}/${base}"__RDP_trained.fasta -t "${TFILES}/${base}"__RDP_taxonomy_trained.txt -Xmx"$MEM"m > rdp_train.out 2>&1
     cmd = ['classifier', 'train', '-o', F'{tf}/.', '-s', F'{tf}/{db_base}__RDP_trained.fasta', '-t', F'{tf}/{db_base}__RDP_taxonomy_trained.txt', F'-Xmx{mem}m']
-    rdp_out = subprocess.run(cmd, capture_output = True)
-    #Duplicate taxa (a given taxon in more than one higher taxa) occur in some UNITE and SILVA datasets
-    if "duplicate taxon name" in rdp_out:
-        print("RDP training error, redoing with duplicate taxa")
-        _format_ref_db(db, tfiles, format, constax_path, dup=True)
-        rdp_out = subprocess.run(cmd, capture_output = True)
-        if len(rdp.stderr.decode('utf-8')) == 0:
-            print("RDP training error overcome, continuing with classification after SINTAX is retrained")
-            cmd = ['vsearch', '-makeudb_usearch', F'{tf}/{db_base}__UTAX.fasta', '-output', F'{tf}/sintax.db']
-            subprocess.run(cmd, check=True)
+    # Failure is decided on the exit status, so JVM warnings on stderr do not abort
+    # training. Duplicate taxa are also caught if RDP reports them without failing.
+    try:
+        rdp_err = _run_logged(cmd, F'{tf}/rdp_train.log')
+    except subprocess.CalledProcessError as e:
+        errors.append(e.stderr.decode('utf-8') or F"classifier train exited with status {e.returncode}")
+        return
+    if "duplicate taxon name" in rdp_err:
+        errors.append(rdp_err)
+        return
+    _write_rdp_properties(tf, rdp_version)
+    cache.update("rdp", key)
+
+def _write_rdp_properties(tf, rdp_version):
+    with open(F"{tf}/rRNAClassifier.properties", "w") as ofile:
+        ofile.write(F"# Sample ResourceBundle properties file\nbergeyTree=bergeyTrainingTree.xml\n\nprobabilityList=genus_wordConditionalProbList.txt\n\nprobabilityIndex=wordConditionalProbIndexArr.txt\n\nwordPrior=logWordPrior.txt\n\nclassifierVersion=RDP Naive Bayesian rRNA Classifier Version {rdp_version}")
+
+def _format_outputs(tf, db_base):
+    return [F'{tf}/{db_base}__UTAX.fasta', F'{tf}/{db_base}__RDP_trained.fasta', F'{tf}/{db_base}__RDP_taxonomy_trained.txt']
+
+def _update_reference(db, tf, db_base, format, dup, cache, compress):
+    # Format a new release of the reference beside the training files and append the
+    # records it adds to them, extending the taxonomy tree. Returns the FASTA of the
+    # added records, or None if records were removed or changed, which needs a full retrain.
+    # The extended files are written beside the old ones and only swapped in once all of
+    # them are complete, with the format entry dropped first, so a run stopped part way
+    # leaves either the old files or a full retrain for the next run.
+    # Compressed files are extended with added gzip members, and files compressed otherwise
+    # than asked for are formatted again in full.
+    base = F'{tf}/{db_base}'
+    if (_compression(base+"__RDP.fasta") is not None) != compress:
+        print("Training files were formatted with a different compress setting, training from scratch")
+        return None
+    staging = F'{tf}/update'
+    os.makedirs(staging, exist_ok=True)
+    _format_ref_db(db, staging, format, dup=dup, lineage=False, compress=compress)
+    new_base = _ref_base(db, staging)
+    new_ids = _diff_ref_db(base, new_base)
+    if new_ids is None:
+        print("Reference records were removed or changed, training from scratch")
+        return None
+    print(F"{len(new_ids)} new reference records, extending the existing training files")
+    _subset_ref_db(new_base, new_ids)
+    _lin_to_tax(new_base, format, dup, previous=base+"__RDP_taxonomy.txt")
+    _add_full_lineage(new_base, format, compress)
+    suffixes = ["__RDP_taxonomy.txt", "__RDP_taxonomy_headers.txt", "__RDP_taxonomy_trained.txt", "__RDP.fasta", "__RDP_trained.fasta", "__UTAX.fasta"]
+    for suffix in suffixes:
+        shutil.copyfile(base+suffix, new_base+suffix+".extended")
+        with open(new_base+suffix, 'rb') as ifile, open(new_base+suffix+".extended", 'ab') as ofile:
+            if suffix == "__RDP_taxonomy.txt":
+                ifile.readline() # rank header
+            shutil.copyfileobj(ifile, ofile)
+    cache.update("format", None)
+    for suffix in suffixes:
+        os.replace(new_base+suffix+".extended", base+suffix)
+    return new_base+"__RDP_trained.fasta"
+
+def _format_key(db_digest, format, dup, compress):
+    # Compressed and plain formatted files are not interchangeable for the builds using them
+    return _key(db_digest, format, dup, "gzip") if compress else _key(db_digest, format, dup)
+
+def train(db : DNAFASTAFormat, tf : str, mem : int, incremental : bool = False, compress : bool = False) -> dict:
+    db.file.view(DNAFASTAFormat)
+    db_base = os.path.basename(_ref_base(db, tf))
+    os.makedirs(tf, exist_ok=True)
+    #python "$CONSTAXPATH"/FormatRefDB.py -d "$DB" -t "$TFILES" -f $FORMAT -p "$CONSTAXPATH"
+    format = _detect_format(db)
+
+    # Every build is keyed on the reference it came from, so an unchanged reference
+    # reuses the training files and a new tool version only rebuilds its classifier
+    cache = _TrainingCache(tf)
+    versions = _tool_versions()
+    db_digest = _file_digest(db)
+    same_db = cache.entries.get("database") == db_digest
+    if same_db:
+        db_base = cache.entries.get("base", db_base)
+    dup = cache.entries.get("dup", False) if same_db or incremental else False
+    format_key = _format_key(db_digest, format, dup, compress)
+    new_records = None
+    if not cache.fresh("format", format_key, _format_outputs(tf, db_base)):
+        # An incremental update appends to the training files of the earlier release, which
+        # keep its name, and adds a BLAST volume if the current database is up to date
+        old_base = cache.entries.get("base")
+        extend_blast = False
+        if incremental and old_base is not None and cache.fresh("format", cache.entries.get("format"), _format_outputs(tf, old_base)):
+            extend_blast = cache.fresh("blast", _key(cache.entries.get("format"), versions["blast"]), [F'{tf}/{old_base}__BLAST.nal'])
+            new_records = _update_reference(db, tf, old_base, format, dup, cache, compress)
+            if new_records is not None:
+                db_base = old_base
+        if new_records is None:
+            _format_ref_db(db, tf, format, dup=dup, compress=compress)
+        elif not extend_blast:
+            new_records = None
+        cache.update("format", format_key, database=db_digest, dup=dup, base=db_base)
+
+    # The three builds only read the formatted files, so they run side by side with RDP
+    # holding the memory budget. Duplicate taxa reported by RDP mean reformatting with
+    # dup, after which every build is redone.
+    while True:
+        rdp_outputs = [F'{tf}/bergeyTrainingTree.xml', F'{tf}/genus_wordConditionalProbList.txt', F'{tf}/wordConditionalProbIndexArr.txt',
+                       F'{tf}/logWordPrior.txt', F'{tf}/rRNAClassifier.properties']
+        keys = {name : _key(format_key, versions[name]) for name in versions}
+        rdp_errors = []
+        stages = []
+        if not cache.fresh("rdp", keys["rdp"], rdp_outputs):
+            stages.append(('RDP training', functools.partial(_train_rdp, tf, db_base, mem, cache, keys["rdp"], versions["rdp"], rdp_errors), 1, mem))
+        if not cache.fresh("sintax", keys["sintax"], [F'{tf}/sintax.db']):
+            stages.append(('SINTAX training', functools.partial(_train_sintax, tf, db_base, cache, keys["sintax"]), 1, 0))
+        if not cache.fresh("blast", keys["blast"], [F'{tf}/{db_base}__BLAST.*n*']):
+            if new_records is not None:
+                stages.append(('BLAST update', functools.partial(_extend_blast, tf, db_base, new_records, cache, keys["blast"]), 1, 0))
+            else:
+                stages.append(('BLAST training', functools.partial(_train_blast, tf, db_base, cache, keys["blast"]), 1, 0))
+        if len(stages) == 0:
+            print("Training files are up to date, skipping classifier training")
+            break
+        print("__________________________________________________________________________\nTraining " + ", ".join([stage[0].split()[0] for stage in stages]) + F" classifiers, logs are written to {tf}")
+        _run_stages(stages, nthreads=len(stages), mem=mem)
+        if len(rdp_errors) == 0:
+            break
+        #Duplicate taxa (a given taxon in more than one higher taxa) occur in some UNITE and SILVA datasets
+        if "duplicate taxon name" in rdp_errors[0] and not dup:
+            print("RDP training error, redoing with duplicate taxa")
+            dup = True
+            format_key = _format_key(db_digest, format, dup, compress)
+            db_base = os.path.basename(_ref_base(db, tf))
+            new_records = None
+            _format_ref_db(db, tf, format, dup=dup, compress=compress)
+            cache.update("format", format_key, database=db_digest, dup=dup, base=db_base)
         else:
-            raise RuntimeError("RDP training with duplicate taxa failed:\n" + rdp.stderr.decode('utf-8'))
+            raise RuntimeError("RDP training failed:\n" + rdp_errors[0])
+    shutil.rmtree(F'{tf}/update', ignore_errors=True)
 
+    training_dict = {'sintax_database' : F'{tf}/sintax.db',
+                     'blast_database' : F'{tf}/{db_base}__BLAST',
+                     'rdp_path' : F'{tf}/',
+                     'format' : format}
     blast_ver = subprocess.run(['blastn', '-version'], capture_output = True).stdout.decode('utf-8').split("\n")[0].split(" ")[1]
     training_dict["blast_version"] = blast_ver
 
-    rdp_version = subprocess.run(['conda', 'list', 'rdptools'], capture_output = True).stdout.decode('utf-8').split("\n")[-2].split()[1]
-    with open(F"{tfiles}/rRNAClassifier.properties", "w") as ofile:
-        ofile.write(F"# Sample ResourceBundle properties file\nbergeyTree=bergeyTrainingTree.xml\n\nprobabilityList=genus_wordConditionalProbList.txt\n\nprobabilityIndex=wordConditionalProbIndexArr.txt\n\nwordPrior=logWordPrior.txt\n\nclassifierVersion=RDP Naive Bayesian rRNA Classifier Version {rdp_version}")
-
-    json.dump(training_dict, F"{tfiles}/training_result.json")
-    training_result = JSONFormat(F"{tfiles}/training_result.json")
-    return training_result
+    with open(F"{tf}/training_result.json", "w") as ofile:
+        json.dump(training_dict, ofile)
+    return training_dict
 
 plugin.register_semantic_types(CONSTAXTaxonomicClassifier)
 plugin.register_semantic_type_to_format(CONSTAXTaxonomicClassifier,
@@ -113,11 +247,15 @@ plugin.methods.register_function(
     function=train,
     inputs={'db' : FeatureData[Sequence]},
     parameters={'mem' : Int % Range(0, None),
-                'tf' : Str},
+                'tf' : Str,
+                'incremental' : Bool,
+                'compress' : Bool},
     outputs=[('training_result', CONSTAXTaxonomicClassifier)],
     input_descriptions={'db' : 'Database to train classifiers, in FASTA format.'},
     parameter_descriptions={'mem' : 'Memory available for RDP classification, in MB. Must be in range [1, infinity].',
-                            'tf' : 'Path to which training files will be written'},
+                            'tf' : 'Path to which training files will be written',
+                            'incremental' : 'If tf holds training files for an earlier release of the reference, append the records new in db to them instead of training from scratch. Falls back to full training if records were removed or changed.',
+                            'compress' : 'Store the formatted reference FASTAs kept in tf (__RDP.fasta and __UTAX.fasta) gzip compressed. The files read by makeblastdb and RDP training stay uncompressed.'},
     output_descriptions={'training_result': 'JSON with attributes describing model training to allow for classification.'},
     name='CONSTAX2 consensus taxonomy classifier',
     description='Function to train the CONSTAX classifiers on a reference database',